@@ -7,20 +7,17 @@ modelr.EarthModel.py
 Container for handling earth models.
 '''
 
-from bruges.transform import depth_to_time
-import requests
-
-from modelr.reflectivity import get_reflectivity
+from modelr.reflectivity import label_image, label_reflectivity
+from modelr.store import ModelStore, model_cache
+from modelr.images import image_fetcher
+from modelr.timedepth import time_maps
 
 import numpy as np
 from scipy.interpolate import interp1d
-
-from PIL import Image
-from io import StringIO
+from svgwrite import rgb
 
 from modelr.web.urlargparse import SendHelp,\
     URLArgumentParser, rock_properties_type
-import h5py
 
 import os
 
@@ -48,21 +45,17 @@ class EarthModel(object):
         except SendHelp:
             raise SendHelp
 
-        self.reflect_file = str(earth_structure["datafile"])
+        # Datafiles are kept in the managed cache directory
+        self.reflect_file = model_cache.path(earth_structure["datafile"])
 
         self.property_map = {}
         # Load the image data
         if earth_structure.get('update_model', None):
-            response = requests.get(earth_structure["image"])
+            image = image_fetcher.array(earth_structure["image"])
 
             if os.path.exists(self.reflect_file):
                 os.remove(self.reflect_file)
 
-            image = Image.open(StringIO(response.content))\
-                         .convert("RGB")
-            image.load()
-
-            self.image = np.asarray(image, dtype="int32")
             self.units = args.units
             self.depth = args.depth
             self.reflectivity_method = args.reflectivity_method
@@ -71,19 +64,18 @@ class EarthModel(object):
             # attribute we are going to ignore
             mapping = earth_structure["mapping"]
 
-            # Make a lookup table for vp. This is terribly
-            # inefficient for memory, but quicker than looping
-            # dictionaries. There is for sure a better way
-            self.vp_lookup = np.zeros((256, 256, 256))
             for colour in mapping:
                 rock = rock_properties_type(mapping[colour]["property"])
                 rock.name = mapping[colour]["name"]
 
-                rgb = colour.split('(')[1].split(')')[0].split(',')
-                self.vp_lookup[int(rgb[0]), int(rgb[1]),
-                               int(rgb[2])] = rock.vp
+                r, g, b = colour.split('(')[1].split(')')[0].split(',')
+                self.property_map[rgb(int(r), int(g), int(b))] = rock
 
-                self.property_map[colour] = rock
+            # Store the model as a label per pixel and a small table
+            # of rock properties per label, so memory scales with the
+            # image rather than the colour space.
+            self.image, self.properties = label_image(
+                image, self.property_map)
 
     def get_rocks(self):
 
@@ -104,10 +96,13 @@ class EarthModel(object):
         model_time = np.arange(0, depth, res)
         new_time = np.arange(0, depth, dt)
 
+        # Samples outside of the model get a label with no rock
+        fill = self._add_label()
+
         f = interp1d(model_time, self.image, kind='nearest',
                      axis=0, bounds_error=False,
-                     fill_value=-1)
-        self.image = f(new_time)
+                     fill_value=fill)
+        self.image = f(new_time).astype(self.image.dtype)
 
     def depth2time(self, dt, samples=None):
 
@@ -117,50 +112,57 @@ class EarthModel(object):
         vp_data = self.vp_data(samples=samples)
         data = self.get_data(samples=samples)
 
-        indices = np.array([np.arange(vp_data.shape[0])
-                            for i in range(vp_data.shape[1])])\
-                    .transpose()
-
         dz = self.depth / data.shape[0]
 
-        time_index = depth_to_time(indices, vp_data,
-                                   dz, dt).astype(int)
-
-        self.image = np.asarray([data[time_index[:, i], i, :]
-                                 for i in range(data.shape[1])])\
-                       .transpose(1, 0, 2)
+        self.image = time_maps.get(vp_data, dz, dt).apply(data)
 
     def vp_data(self, samples=None):
 
-        data = self.get_data(samples=samples).astype(int)
-        vp_data = self.vp_lookup[data[:, :, 0],
-                                 data[:, :, 1],
-                                 data[:, :, 2]]
-        return vp_data
+        # Colours without a rock have no velocity
+        vp = np.nan_to_num(self.properties.vp)
+
+        return vp[self.get_data(samples=samples)]
 
     def update_reflectivity(self, offset_angles,
                             samples=None):
 
-        reflectivity = get_reflectivity(
-            data=self.get_data(samples=samples),
-            colourmap=self.property_map,
+        reflectivity = label_reflectivity(
+            labels=self.get_data(samples=samples),
+            properties=self.properties,
             theta=offset_angles,
             reflectivity_method=self.reflectivity_method)
 
-        with h5py.File(self.reflect_file, 'w') as f:
-            f.create_dataset("reflectivity", data=reflectivity)
+        try:
+            ModelStore(self.reflect_file, cache=model_cache).write(
+                "rpp", np.atleast_3d(reflectivity),
+                theta=np.atleast_1d(offset_angles))
+        except (IOError, OSError):
+            # reflectivity() will find nothing stored
+            pass
+
+    def reflectivity(self, theta=None, traces=None, samples=None):
+        """
+        Read the stored reflectivity, or part of it.
 
-    def reflectivity(self, theta=None):
+        :keyword theta: Index of the angle to read.
+        :keyword traces: Index, slice or list of traces to read.
+        :keyword samples: Index, slice or list of samples to read.
 
-        try:
-            with h5py.File(self.reflect_file) as f:
-                data = f["reflectivity"].value
-                if theta:
-                    data = data[:, :, [theta]]
-        except:
-            data = None
+        :returns: the reflectivity indexed as [sample, trace, theta],
+                  less any axis picked by an integer, or None if none
+                  is stored.
+        """
 
-        return data
+        store = ModelStore(self.reflect_file, cache=model_cache)
+
+        if theta is not None:
+            theta = [theta]
+
+        try:
+            return store.read("rpp", samples=samples, traces=traces,
+                              theta=theta)
+        except (IOError, OSError, KeyError):
+            return None
 
     def get_data(self, samples=None):
 
@@ -174,8 +176,28 @@ class EarthModel(object):
                               self.image, kind="nearest", axis=1)
             data = interp(np.linspace(0, self.image.shape[1] - 1,
                                       samples))
-            return data
+            return data.astype(self.image.dtype)
         else:
             return self.image[:,
-                              np.arange(0, self.image.shape[1], int(step)),
-                              :]
+                              np.arange(0, self.image.shape[1], int(step))]
+
+    def _add_label(self):
+        """
+        Returns a label with no rock properties, adding one to the
+        table if needed and upcasting the image if it no longer fits.
+        """
+
+        empty = np.flatnonzero(np.isnan(self.properties.vp))
+        if empty.size:
+            return empty[0]
+
+        label = self.properties.size
+        self.properties = np.rec.array(
+            np.append(self.properties,
+                      np.full(1, np.nan, dtype=self.properties.dtype)))
+
+        dtype = np.promote_types(self.image.dtype,
+                                 np.min_scalar_type(label))
+        self.image = self.image.astype(dtype, copy=False)
+
+        return label
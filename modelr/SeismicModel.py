@@ -5,11 +5,11 @@ modelr.SeismicModel.py
 
 Container for handling seismic models.
 '''
-from modelr.constants import WAVELETS, wavelet_duration
+from modelr.constants import wavelet_duration
 import numpy as np
 from modelr.web.urlargparse import SendHelp, URLArgumentParser
 
-from bruges.filters import rotate_phase
+from modelr.wavelets import wavelet_bank
 
 
 class SeismicModel(object):
@@ -63,16 +63,9 @@ class SeismicModel(object):
 
         f = self.wavelet_cf()
 
-        if ((self.wavelet_model == WAVELETS['ormsby']) and (np.size(f) > 1)):
-            wavelet = np.zeros((wavelet_duration / self.dt, np.size(f)))
-            for ind, freq in enumerate(f):
-                wavelet[:, ind] = self.wavelet_model(wavelet_duration,
-                                                     self.dt, freq)
-        else:
-            wavelet = self.wavelet_model(wavelet_duration,
-                                         self.dt, f)
-
-        return rotate_phase(wavelet, self.phase)
+        return wavelet_bank.wavelets(self.wavelet_model,
+                                     wavelet_duration, self.dt, f,
+                                     phase=self.phase)
 
     def offset_angles(self):
         return np.linspace(self.theta1, self.theta2, self.stack)
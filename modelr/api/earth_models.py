@@ -1,16 +1,245 @@
 from .modelrAPI import modelrAPI, Rock
-from modelr.reflectivity import reflectivity_array
+from modelr.reflectivity import reflectivity_array, do_convolve
+from modelr.stats import StreamingStats
+from modelr.montecarlo import MonteCarloRunner
 from PIL import Image
 import numpy as np
-from numpy.random import randn
-import requests
 from scipy.interpolate import interp1d
-import h5py
-from io import StringIO
 from hashlib import md5
 import json
 
-from bruges.transform import depth_to_time
+from modelr.store import ModelStore, model_cache
+from modelr.images import image_fetcher
+
+from modelr.timedepth import TimeMap, time_maps
+from bruges.reflection import zoeppritz_rpp
+
+
+NAMES = ('vp', 'vs', 'rho')
+
+
+def property_tables(image, rocks):
+    """
+    Returns the (mean, std) of vp, vs and rho for each label, as
+    arrays indexed as [property, label]. Unmapped labels are zero.
+
+    :param image: An integer array of labels.
+    :param rocks: A dict mapping labels to Rock objects.
+    """
+
+    size = max(int(np.amax(image)), max(rocks) if rocks else 0) + 1
+    mean = np.zeros((len(NAMES), size))
+    std = np.zeros((len(NAMES), size))
+
+    for label, rock in rocks.items():
+        for i, name in enumerate(NAMES):
+            mean[i, label] = getattr(rock, name)
+            std[i, label] = getattr(rock, name + "_std")
+
+    return mean, std
+
+
+def draw_properties(image, tables, rng, correlation=0.0):
+    """
+    Draws vp, vs and rho over a label image in one pass.
+
+    :param image: An integer array of labels, indexed as [z, x].
+    :param tables: The (mean, std) from property_tables.
+    :param rng: A numpy Generator.
+    :keyword correlation: The correlation between the vp, vs and rho
+                          deviations at each pixel.
+
+    :returns: an array indexed as [property, z, x].
+    """
+
+    mean, std = tables
+    noise = rng.standard_normal((len(NAMES),) + image.shape)
+
+    if correlation:
+        matrix = np.full((len(NAMES), len(NAMES)), float(correlation))
+        np.fill_diagonal(matrix, 1.0)
+        noise = np.tensordot(np.linalg.cholesky(matrix), noise, axes=1)
+
+    return mean[:, image] + std[:, image] * noise
+
+
+class Realization(object):
+    """
+    One realization of the rock properties of a labelled image. The
+    vp, vs and rho grids are drawn together, once, from the mean and
+    standard deviation of the rock mapped to each label.
+
+    :param image: An integer array of labels, indexed as [z, x].
+    :param rocks: A dict mapping labels to Rock objects. Unmapped
+                  labels get zero properties.
+    :param seed: Seed for the random generator. The same seed gives
+                 the same grids.
+    :keyword correlation: The correlation between the vp, vs and rho
+                          deviations.
+    """
+
+    def __init__(self, image, rocks, seed, correlation=0.0):
+
+        self.seed = seed
+
+        grids = draw_properties(image, property_tables(image, rocks),
+                                np.random.default_rng(seed),
+                                correlation=correlation)
+        grids.flags.writeable = False
+
+        self.vp, self.vs, self.rho = grids
+
+
+def _draw_stack(image, tables, seeds, correlation):
+
+    grids = np.stack([
+        draw_properties(image, tables, np.random.default_rng(seed),
+                        correlation=correlation)
+        for seed in seeds], axis=1)
+
+    return grids[0], grids[1], grids[2]
+
+
+def _synthetics(image, tables, dz, seeds, correlation, times, wavelet,
+                theta, reflectivity_method):
+
+    vp, vs, rho = _draw_stack(image, tables, seeds, correlation)
+    count, nz, nx = vp.shape
+
+    if times is not None:
+        converted = [TimeMap(vp[i], dz, times)
+                     .apply(vp[i], vs[i], rho[i])
+                     for i in range(count)]
+        vp, vs, rho = [np.stack(grids)
+                       for grids in zip(*converted)]
+
+    # Realizations side by side as one section of traces
+    vp, vs, rho = [np.moveaxis(prop, 0, 1)
+                   .reshape(prop.shape[1], count * nx)
+                   for prop in (vp, vs, rho)]
+
+    rpp = reflectivity_array(vp, vs, rho, theta,
+                             reflectivity_method)
+
+    synthetic = do_convolve(wavelet, rpp[..., np.newaxis])
+
+    return np.moveaxis(
+        synthetic[..., 0, 0].reshape(-1, count, nx), 1, 0)
+
+
+def _synthetic_part(template, *args):
+
+    # Only the arrays go to the pool, never the model or its store
+    stats = template.empty()
+    stats.add(_synthetics(*args))
+
+    return stats
+
+
+class Ensemble(object):
+    """
+    A set of realizations of an ImageModel, summarized a chunk at a
+    time.
+
+    Realization i is drawn from its own stream spawned from the seed,
+    so the results don't depend on the chunk size.
+
+    :param model: An ImageModel.
+    :param n: The number of realizations.
+    :keyword seed: The ensemble seed. Defaults to the model seed.
+    :keyword correlation: The correlation between the vp, vs and rho
+                          deviations of each realization.
+    """
+
+    def __init__(self, model, n, seed=None, correlation=0.0):
+
+        self.model = model
+        self.n = n
+        self.seed = model.seed if seed is None else seed
+        self.correlation = correlation
+
+        self._tables = property_tables(model.image, model.map)
+        self._seeds = np.random.SeedSequence(self.seed).spawn(n)
+
+    def properties(self, start=0, stop=None):
+        """
+        Draws a range of realizations.
+
+        :returns: vp, vs and rho stacks indexed as
+                  [realization, z, x].
+        """
+
+        if stop is None:
+            stop = self.n
+
+        return _draw_stack(self.model.image, self._tables,
+                           self._seeds[start:stop], self.correlation)
+
+    def _times(self, dt):
+
+        # Every realization is sampled at the times of the mean model
+        mean, _ = self._tables
+
+        return time_maps.get(mean[0][self.model.image], self.model.dz,
+                             dt).times
+
+    def _chunk(self, start, stop):
+
+        return (self.model.image, self._tables, self.model.dz,
+                self._seeds[start:stop], self.correlation)
+
+    def synthetic_stats(self, wavelet, dt, theta=None,
+                        reflectivity_method=zoeppritz_rpp,
+                        chunk_size=8, percentiles=(10, 50, 90),
+                        bins=32, workers=1):
+        """
+        Summarizes the synthetic sections of every realization.
+        Each chunk of realizations is time converted, then its
+        reflectivity and convolution are computed as one batch of
+        traces and added to running statistics.
+
+        The first chunk sets the histogram range. The other chunks
+        can be spread over processes, and their statistics are merged
+        in order, so the results don't depend on the workers.
+
+        :param wavelet: A single wavelet, e.g. Seismic.src.
+        :param dt: The sample interval [s].
+        :keyword theta: The angle [deg]. Defaults to the first angle
+                        of the model.
+        :keyword reflectivity_method: The reflectivity algorithm.
+        :keyword chunk_size: Realizations computed at once.
+        :keyword percentiles: Percentiles to report.
+        :keyword bins: Histogram bins for the percentiles. See
+                       modelr.stats.StreamingStats.
+        :keyword workers: Processes for the chunks. See
+                          modelr.montecarlo.MonteCarloRunner.
+
+        :returns: a dict with count, mean, std, min, max and p10,
+                  p50, ... amplitude sections indexed as [time, x].
+        """
+
+        if theta is None:
+            theta = np.atleast_1d(self.model.theta)[0]
+
+        times = None if self.model.domain == 'time' else \
+            self._times(dt)
+
+        args = (times, wavelet, theta, reflectivity_method)
+
+        synthetic = _synthetics(*self._chunk(0, chunk_size) + args)
+        stats = StreamingStats(synthetic.shape[1:],
+                               percentiles=percentiles, bins=bins)
+        stats.add(synthetic)
+
+        template = stats.empty()
+        tasks = [(template,) + self._chunk(start, start + chunk_size) +
+                 args for start in range(chunk_size, self.n, chunk_size)]
+
+        runner = MonteCarloRunner(workers)
+        for part in runner.map(_synthetic_part, tasks):
+            stats.merge(part)
+
+        return stats.summary()
 
 
 class ImageModel(modelrAPI):
@@ -22,7 +251,7 @@ class ImageModel(modelrAPI):
 
         # Change from rock keys to rock objects in the mapping
         new_map = {colour: Rock.from_json(rock) for
-                   colour, rock in mapping.iteritems()}
+                   colour, rock in mapping.items()}
 
         return new_map
     
@@ -34,7 +263,7 @@ class ImageModel(modelrAPI):
                  units="SI",
                  domain='depth',
                  theta=np.linspace(0, 45, 15),
-                 resample=None):
+                 resample=None, seed=None):
 
         self.theta = theta
         self.units = units
@@ -44,12 +273,13 @@ class ImageModel(modelrAPI):
         self.xrange = xrange
 
         # Change the mapping from RGB to index
-        image = Image.open(image)
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
         if resample is not None:
             image = image.resize(resample, Image.NEAREST)
         
         index_mapping = {}
-        for colour, rock in mapping.iteritems():
+        for colour, rock in mapping.items():
             rgb = np.array([[colour.split('(')[1].split(')')[0]
                              .split(',')]], 'uint8')
             
@@ -64,6 +294,12 @@ class ImageModel(modelrAPI):
         self.dz = self.zrange / float(self.image.shape[0])
         self.dx = self.xrange / float(self.image.shape[1])
 
+        # Keep the seed so the realization can be made again
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self._realization = None
+
     @classmethod
     def from_json(cls, data):
         """
@@ -73,6 +309,7 @@ class ImageModel(modelrAPI):
               image: Link to rgb formatted png
               mapping: Mapping from rgb colour string to a database key for the
                        corresponding rock.
+              seed: Optional seed for the property realization.
 
             example:
                     {"image": "https://www.modelr.io/_gh/testimg.png,
@@ -81,24 +318,44 @@ class ImageModel(modelrAPI):
                      "z": }
         """
 
-        response = requests.get(data["image"])
-        image = StringIO(response.content)
+        image = image_fetcher.open(data["image"])
 
         mapping = cls.fill_mapping(image, data["mapping"])
 
-        return cls(image, mapping)
+        return cls(image, mapping, seed=data.get("seed"))
+
+    def realization(self, seed=None):
+        """
+        Get a realization of the property grids. The one for the
+        model seed is kept, so vp, vs and rho all come from it.
+
+        :keyword seed: Seed of the realization. Defaults to the seed
+                       of the model.
+        """
+
+        if seed is None:
+            seed = self.seed
+
+        if (self._realization is not None and
+                self._realization.seed == seed):
+            return self._realization
+
+        realization = Realization(self.image, self.map, seed)
+        if seed == self.seed:
+            self._realization = realization
+
+        return realization
 
     def _make_data(self, var):
 
-        data = np.zeros(self.image.shape)
-        for i, rock in self.map.iteritems():
-            index = self.image == i
-            layer = (randn(np.sum(index)) *
-                     getattr(rock, var + "_std") + getattr(rock, var))
+        return getattr(self.realization(), var)
 
-            np.place(data, index, layer)
+    def ensemble(self, n, seed=None, correlation=0.0):
+        """
+        Get an Ensemble of n realizations of the model.
+        """
 
-        return data
+        return Ensemble(self, n, seed=seed, correlation=correlation)
 
     def _get_data(self, var):
 
@@ -134,8 +391,9 @@ class ImageModel(modelrAPI):
 
         f = interp1d(z1, self.image, kind='nearest',
                      axis=0)
-        self.image = f(z2)
+        self.image = f(z2).astype(self.image.dtype)
         self.dz = dz
+        self._realization = None
 
         
     def rpp_t(self, dt):
@@ -147,78 +405,73 @@ class ImageModel(modelrAPI):
                 raise Exception('sampling mismatch')
             
         
-        vpt = depth_to_time(self.vp, self.vp, self.dz, dt)
-        times = np.arange(vpt.shape[0]) * dt
-        vst = depth_to_time(self.vs, self.vp, self.dz, times)
-        rhot = depth_to_time(self.rho, self.vp, self.dz, times)
+        # One sample map converts all three grids
+        vpt, vst, rhot = time_maps.get(self.vp, self.dz, dt)\
+            .apply(self.vp, self.vs, self.rho)
 
         rpp = reflectivity_array(vpt, vst, rhot, self.theta)
         return rpp
 
 
 class ImageModelPersist(ImageModel):
+    """
+    An ImageModel that keeps its property grids and reflectivities in
+    a ModelStore, so they are only computed once per datafile.
+    Parts of them can be read back with read().
+    """
 
     def __init__(self, datafile, *args, **kwargs):
 
         super(self.__class__, self).__init__(*args, **kwargs)
 
         self.datafile = datafile
+        self.store = ModelStore(datafile, cache=model_cache)
 
     def _get_data(self, arg):
 
-        with h5py.File(self.datafile) as f:
-            if arg in f:
-                return f[arg].value
-
-        # Create field
-        with h5py.File(self.datafile, 'w') as f:
-            data = self._make_data(arg)
-            f.create_dataset(arg, data=data)
-
-            return data
+        return self.store.get(arg, lambda: self._make_data(arg))
 
     @property
     def rpp(self):
-        
-        with h5py.File(self.datafile) as f:
 
-            if 'rpp' in f:
-                return f['rpp'].value
+        parent = super(self.__class__, self)
 
-        rpp = rpp = super(self.__class__, self).rpp
-        with h5py.File(self.datafile, 'w') as f:
-            f.create_dataset('rpp', data=rpp)
+        return self.store.get('rpp', lambda: parent.rpp,
+                              theta=self.theta)
 
-        return rpp
-            
     def rpp_t(self, dt):
 
-        with h5py.File(self.datafile) as f:
+        parent = super(self.__class__, self)
 
-            if 'rpp_t' in f:
-                return f['rpp_t'].value
+        return self.store.get('rpp_t', lambda: parent.rpp_t(dt),
+                              theta=self.theta, dt=dt)
 
-        rpp_t = super(self.__class__, self).rpp_t(dt)
-        
-        with h5py.File(self.datafile, 'w') as f:
+    def read(self, name, samples=None, traces=None, theta=None):
+        """
+        Read part of a stored field. See ModelStore.read.
 
-            f.create_dataset('rpp_t', data=rpp_t)
+        :param name: One of vp, vs, rho, rpp or rpp_t. The field must
+                     have been computed already.
+        """
 
-            return rpp_t
+        return self.store.read(name, samples=samples, traces=traces,
+                               theta=theta)
 
     @classmethod
     def from_json(cls, data):
 
-        m = md5.new()
-        m.update(json.dumps(data))
+        # The image can change behind the same URL
+        m = md5()
+        m.update(json.dumps(data, sort_keys=True).encode())
+        m.update(image_fetcher.version(data["image"]).encode())
 
-        datafile = m.hexdigest() + '.tmp'
-        response = requests.get(data["image"])
-        image = StringIO(response.content)
+        datafile = model_cache.path(m.hexdigest() + '.h5')
+        image = image_fetcher.open(data["image"])
         mapping = cls.fill_mapping(image, data["mapping"])
 
         return cls(datafile, image, mapping, zrange=data["zrange"],
-                   theta=data["theta"], domain=data["domain"])
+                   theta=data["theta"], domain=data["domain"],
+                   seed=data.get("seed"))
 
 
 
@@ -3,7 +3,7 @@ import numpy as np
 from numpy.random import randn
 from bruges.rockphysics import smith_fluidsub
 from modelr.constants import WAVELETS
-from bruges.filters import rotate_phase
+from modelr.wavelets import wavelet_bank
 from bruges.rockphysics import moduli_dict as moduli
 
 class modelrAPIException(Exception):
@@ -138,6 +138,14 @@ class Fluid(modelrAPI):
                    data["sw"])
 
 
+# Layer columns of FluidSub1D and the attributes they come from
+ROCK_COLUMNS = [('vp', 'vp'), ('vs', 'vs'), ('rho', 'rho'),
+                ('phi', 'phi'), ('vclay', 'vclay'),
+                ('Kclay', 'kclay'), ('Kqtz', 'kqtz')]
+FLUID_COLUMNS = [('rhow', 'rho_w'), ('rhohc', 'rho_hc'), ('Kw', 'Kw'),
+                 ('Khc', 'Khc'), ('Sw', 'Sw')]
+
+
 class FluidSub1D(modelrAPI):
     handler = None
 
@@ -155,62 +163,58 @@ class FluidSub1D(modelrAPI):
 
         self.z = np.arange(n_samps) * self.dz
 
-        names = ['vp', 'vs', 'rho', 'phi', 'vclay',
-                 'Kclay', 'Kqtz',
-                 'rhow', 'rhohc', 'Kw', 'Khc', 'Sw',
-                 'rhow_sub', 'rhohc_sub', 'Kw_sub',
-                 'Khc_sub', 'Sw_sub']
-        output = np.zeros((n_samps,),
-                          dtype={"names": names,
-                                 "formats": ['f4' for item in names]})
-
-        i = 0
-        for layer in self.layers:
-
-            j = i + np.ceil(layer["thickness"] / self.dz)
-            if j > n_samps:
-                j = n_samps
-
-            rock = layer["rock"]
-            output["vp"][i:j] = randn(j - i) * rock.vp_std + rock.vp
-            output["vs"][i:j] = randn(j - i) * rock.vs_std + rock.vs
-            output["rho"][i:j] = randn(j - i) * rock.rho_std + rock.rho
-            output["phi"][i:j] = rock.phi
-            output["vclay"][i:j] = rock.vclay
-            output["Kclay"] = rock.kclay
-            output["Kqtz"] = rock.kqtz
-
-            if rock.fluid:
-                output["rhow"][i:j] = rock.fluid.rho_w
-                output["rhohc"][i:j] = rock.fluid.rho_hc
-                output["Kw"][i:j] = rock.fluid.Kw
-                output["Khc"][i:j] = rock.fluid.Khc
-                output["Sw"][i:j] = rock.fluid.Sw
-
-                output["rhow"][i:j] = rock.fluid.rho_w
-                output["rhohc"][i:j] = rock.fluid.rho_hc
-                output["Kw"][i:j] = rock.fluid.Kw
-                output["Khc"][i:j] = rock.fluid.Khc
-                output["Sw"][i:j] = rock.fluid.Sw
-
-                # fill in the substitution fluids
-                k = i
+        # Samples in each layer, cut off at the bottom of the model
+        ends = np.minimum(np.cumsum(
+            [int(np.ceil(layer["thickness"] / self.dz))
+             for layer in self.layers], dtype=int), n_samps)
+        counts = np.diff(ends, prepend=0)
+
+        rocks = [layer["rock"] for layer in self.layers]
+        data = {}
+
+        def column(values, counts):
+            return np.repeat(np.array(values, dtype=float), counts)
+
+        for name, attr in ROCK_COLUMNS:
+            data[name] = column([getattr(rock, attr) for rock in rocks],
+                                counts)
+
+        noise = randn(3, n_samps)
+        for k, name in enumerate(('vp', 'vs', 'rho')):
+            std = column([getattr(rock, name + '_std') for rock in rocks],
+                         counts)
+            data[name] += noise[k] * std
+
+        for name, attr in FLUID_COLUMNS:
+            data[name] = column([getattr(rock.fluid, attr)
+                                 if rock.fluid else 0.0
+                                 for rock in rocks], counts)
+
+        # Substitution fluids fill each layer from the top, and the
+        # rest of the layer, or a layer without fluid, is left empty
+        segments = []
+        for layer, count in zip(self.layers, counts):
+            if layer["rock"].fluid:
                 for subfluid in layer["subfluids"]:
-                    l = k + np.ceil(subfluid["thickness"] / self.dz)
-                    fluid = subfluid["fluid"]
-                    output["rhow_sub"][k:l] = fluid.rho_w
-                    output["rhohc_sub"][k:l] = fluid.rho_hc
-                    output["Kw_sub"][k:l] = fluid.Kw
-                    output["Khc_sub"][k:l] = fluid.Khc
-                    output["Sw_sub"][k:l] = fluid.Sw
+                    size = min(int(np.ceil(subfluid["thickness"] /
+                                           self.dz)), count)
+                    segments.append((size, subfluid["fluid"]))
+                    count -= size
+            segments.append((count, None))
+
+        sizes = [size for size, _ in segments]
+        fluids = [fluid for _, fluid in segments]
 
-                    # TODO use a generator
-                    k = l
+        for name, attr in FLUID_COLUMNS:
+            data[name + '_sub'] = column([getattr(fluid, attr)
+                                          if fluid else 0.0
+                                          for fluid in fluids], sizes)
 
-            # TODO use a generator
-            i = j
+        self.substituted = np.repeat([fluid is not None
+                                      for fluid in fluids], sizes)
 
-        self.data = output
+        self.data = {name: np.ascontiguousarray(values, dtype=np.float32)
+                     for name, values in data.items()}
 
     def get(self, keys):
         """
@@ -254,19 +258,66 @@ class FluidSub1D(modelrAPI):
         Returns vp, vs, rho using smith fluid substition
         """
 
-        vp, vs, rho = smith_fluidsub(
-            self.vp, self.vs, self.rho, self.phi,
-            self.rhow, self.rhohc, self.Sw,
-            self.Sw_sub, self.Kw, self.Khc,
-            self.Kclay, self.Kqtz,
-            vclay=self.vclay,
-            rhownew=self.rhow_sub,
-            rhohcnew=self.rhohc_sub,
-            kwnew=self.Kw_sub, khcnew=self.Khc_sub)
+        vp, vs, rho = self.substitute()
 
-        vp[~np.isfinite(vp)] = self.vp[~np.isfinite(vp)]
-        vs[~np.isfinite(vs)] = self.vs[~np.isfinite(vs)]
-        rho[~np.isfinite(rho)] = self.rho[~np.isfinite(rho)]
+        return (vp[0], vs[0], rho[0])
+
+    def substitute(self, Sw=None, fluids=None):
+        """
+        Smith fluid substitution for a set of scenarios, computed as
+        one batch with the scenarios as an extra axis.
+
+        :keyword Sw: New water saturations, applied wherever there
+                     is a substitution fluid. Defaults to the
+                     saturations of the substitution fluids.
+        :keyword fluids: Fluid objects to substitute wherever there
+                         is a substitution fluid. Defaults to the
+                         substitution fluids of the model.
+
+        :returns: vp, vs, rho indexed as [scenario, sample]. With
+                  both fluids and Sw there is a scenario for each
+                  saturation of each fluid, in that order. Samples
+                  that can't be substituted keep their properties.
+        """
+
+        n = self.vp.size
+        where = self.substituted
+
+        if fluids is None:
+            sub = [[self.data[name + '_sub'] for name, _ in FLUID_COLUMNS]]
+        else:
+            sub = [[np.where(where, np.float32(getattr(fluid, attr)),
+                             self.data[name + '_sub'])
+                    for name, attr in FLUID_COLUMNS]
+                   for fluid in fluids]
+
+        # Columns of rhow, rhohc, Kw, Khc, Sw indexed as
+        # [scenario, sample]
+        sub = np.array(sub, dtype=np.float32).reshape(-1, 5, n)
+
+        if Sw is not None:
+            Sw = np.asarray(Sw, dtype=np.float32).reshape(1, -1, 1)
+            saturation = np.where(where, Sw, sub[:, np.newaxis, 4])
+            sub = np.repeat(sub, Sw.shape[1], axis=0)
+            sub[:, 4] = saturation.reshape(-1, n)
+
+        rhow_sub, rhohc_sub, Kw_sub, Khc_sub, Sw_sub = \
+            np.moveaxis(sub, 1, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vp, vs, rho = smith_fluidsub(
+                self.vp, self.vs, self.rho, self.phi,
+                self.rhow, self.rhohc, self.Sw,
+                Sw_sub, self.Kw, self.Khc,
+                self.Kclay, self.Kqtz,
+                vclay=self.vclay,
+                rhownew=rhow_sub,
+                rhohcnew=rhohc_sub,
+                kwnew=Kw_sub, khcnew=Khc_sub)
+
+        vp = np.where(np.isfinite(vp), vp, self.vp)
+        vs = np.where(np.isfinite(vs), vs, self.vs)
+        rho = np.where(np.isfinite(rho), rho, self.rho)
 
         return (vp, vs, rho)
 
@@ -362,6 +413,6 @@ class Seismic(modelrAPI):
     @property
     def src(self):
 
-        return rotate_phase(
-            self.wavelet(self.wavelet_duration, self.dt, self.f), self.phase)
+        return wavelet_bank.wavelets(self.wavelet, self.wavelet_duration,
+                                     self.dt, self.f, phase=self.phase)
 
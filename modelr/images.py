@@ -0,0 +1,205 @@
+'''
+===============
+modelr.images
+===============
+
+Fetches earth model images over HTTP, keeping the decoded images so
+repeated renders of a model skip both the download and the decode.
+'''
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+
+class _Entry(object):
+
+    def __init__(self, image, digest, etag, last_modified):
+
+        self.image = image
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked = time.time()
+        self.arrays = {}
+
+    @property
+    def nbytes(self):
+
+        width, height = self.image.size
+        return (width * height * len(self.image.getbands()) +
+                sum(a.nbytes for a in self.arrays.values()))
+
+
+class ImageFetcher(object):
+    '''
+    Downloads images through a pooled requests.Session and caches
+    them decoded, keyed by URL and the validator (ETag or
+    Last-Modified) the server sent with them.
+
+    An image fetched less than max_age seconds ago is used without
+    asking the server. After that it is revalidated with a
+    conditional GET, and only downloaded and decoded again if it
+    changed.
+
+    :keyword max_bytes: Size limit of the decoded images.
+    :keyword max_age: Time to use an image without revalidating [s].
+    :keyword timeout: (connect, read) timeouts for a request [s].
+    :keyword pool_size: Connections kept open for each host.
+    '''
+
+    def __init__(self, max_bytes=128 * 2**20, max_age=30.0,
+                 timeout=(3.05, 10.0), pool_size=16):
+
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self):
+
+        nbytes = sum(e.nbytes for e in self._entries.values())
+
+        while nbytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            nbytes -= entry.nbytes
+            self.evictions += 1
+
+    def _fetch(self, url):
+
+        with self._lock:
+            entry = self._entries.get(url)
+
+            if entry is not None:
+                self._entries.move_to_end(url)
+
+                if time.time() - entry.checked < self.max_age:
+                    self.hits += 1
+                    return entry
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        response = self.session.get(url, headers=headers,
+                                    timeout=self.timeout)
+
+        if entry is not None and response.status_code == 304:
+            with self._lock:
+                entry.checked = time.time()
+                self.revalidated += 1
+            return entry
+
+        response.raise_for_status()
+
+        image = Image.open(BytesIO(response.content))
+        image.load()
+
+        entry = _Entry(image, hashlib.sha1(response.content).hexdigest(),
+                       response.headers.get('ETag'),
+                       response.headers.get('Last-Modified'))
+
+        with self._lock:
+            self.misses += 1
+            self._entries[url] = entry
+            self._evict()
+
+        return entry
+
+    def open(self, url):
+        '''
+        Get an image as a PIL Image. The image is a copy, so callers
+        may change it.
+
+        :param url: The URL of the image.
+        '''
+
+        return self._fetch(url).image.copy()
+
+    def version(self, url):
+        '''
+        Returns a digest of the current content of an image, checked
+        with the server like open(), to key results derived from it.
+
+        :param url: The URL of the image.
+        '''
+
+        return self._fetch(url).digest
+
+    def array(self, url, mode="RGB"):
+        '''
+        Get an image as a numpy array.
+
+        :param url: The URL of the image.
+        :keyword mode: The PIL mode to convert the image to.
+
+        :returns: a read only array indexed as [row, column, band],
+                  shared with other callers.
+        '''
+
+        entry = self._fetch(url)
+
+        with self._lock:
+            array = entry.arrays.get(mode)
+
+        if array is None:
+            array = np.asarray(entry.image.convert(mode))
+            array.flags.writeable = False
+
+            with self._lock:
+                entry.arrays[mode] = array
+                self._evict()
+
+        return array
+
+    def clear(self):
+        '''
+        Drop the cached images and reset the counters.
+        '''
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.revalidated = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        '''
+        Returns a dictionary of the fetcher counters.
+        '''
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "revalidated": self.revalidated,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "size": len(self._entries),
+                    "bytes": sum(e.nbytes
+                                 for e in self._entries.values())}
+
+
+image_fetcher = ImageFetcher()
@@ -322,6 +322,157 @@ def body_svg(pad, margin, left, right, traces, layers):
     
     return outfile
 
+###########################################
+# Rasterizers. These fill the same shapes as the SVG geometries
+# straight into an array of layer indices, testing the centre of each
+# pixel, so there is no anti-aliasing and no colours outside the
+# layers.
+
+def _pixel_centres(height, width):
+    """
+    Returns the y and x coordinates of the pixel centres, shaped to
+    broadcast against each other.
+    """
+
+    y = np.arange(height, dtype=float)[:, np.newaxis] + 0.5
+    x = np.arange(width, dtype=float)[np.newaxis, :] + 0.5
+
+    return y, x
+
+
+def polygon_mask(points, height, width):
+    """
+    Finds the pixels inside a polygon, using the nonzero winding rule
+    as SVG does.
+
+    :param points: The (x, y) vertices of the polygon.
+    :param height: The number of rows in the image.
+    :param width: The number of columns in the image.
+
+    :returns: a boolean array indexed as [row, column].
+    """
+
+    y, x = _pixel_centres(height, width)
+    winding = np.zeros((height, width), dtype=int)
+
+    points = [(float(px), float(py)) for px, py in points]
+
+    for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+        if y0 == y1:
+            continue
+
+        upward = (y0 <= y) & (y1 > y)
+        downward = (y1 <= y) & (y0 > y)
+
+        # Where the edge crosses each row
+        crossing = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        left = x < crossing
+
+        winding += upward & left
+        winding -= downward & left
+
+    return winding != 0
+
+
+def ellipse_mask(centre, radii, height, width):
+    """
+    Finds the pixels inside an ellipse.
+
+    :param centre: The (x, y) centre of the ellipse.
+    :param radii: The (x, y) radii of the ellipse.
+    :param height: The number of rows in the image.
+    :param width: The number of columns in the image.
+
+    :returns: a boolean array indexed as [row, column].
+    """
+
+    y, x = _pixel_centres(height, width)
+
+    return (((x - centre[0]) / float(radii[0])) ** 2 +
+            ((y - centre[1]) / float(radii[1])) ** 2) <= 1.0
+
+
+def body_labels(pad, margin, left, right, traces, nlayers=3):
+    """
+    Makes an array of layer indices for the body model. See body for
+    the parameters.
+
+    :param nlayers: 2 or 3. With 2 layers nothing is drawn below the
+                    slab.
+
+    Pixels outside all the shapes are given the index 3.
+
+    :returns: a uint8 array indexed as [sample, trace].
+    """
+
+    width = int(traces)
+    height = int(np.ceil(2 * pad + max(left[1], right[1])))
+
+    labels = np.full((height, width), 3, dtype=np.uint8)
+
+    labels[polygon_mask(((0, 0), (width, 0),
+                         (width, pad + right[0]),
+                         (0, pad + right[0])), height, width)] = 0
+
+    p1 = (0, pad + left[0])
+    p2 = (margin, pad + left[0])
+    p3 = (width - margin, pad + right[0])
+    p4 = (width, pad + right[0])
+    p5 = (width, pad + right[1])
+    p6 = (width - margin, pad + right[1])
+    p7 = (margin, pad + left[1])
+    p8 = (0, pad + left[1])
+
+    if nlayers > 2:
+        labels[polygon_mask((p8, p7, p6, p5, (width, height),
+                             (0, height)), height, width)] = 2
+
+    labels[polygon_mask((p1, p2, p3, p4, p5, p6, p7, p8),
+                        height, width)] = 1
+
+    return labels
+
+
+def channel_labels(pad, thickness, traces):
+    """
+    Makes an array of layer indices for the channel model. See channel
+    for the parameters.
+
+    :returns: a uint8 array indexed as [sample, trace].
+    """
+
+    width = int(traces)
+    height = int(np.ceil(2.5 * pad + thickness))
+
+    labels = np.full((height, width), 2, dtype=np.uint8)
+
+    labels[ellipse_mask((width / 2.0, pad / 2.0),
+                        (0.3 * width, pad + thickness),
+                        height, width)] = 1
+
+    labels[:int(np.ceil(pad - 0.5)), :] = 0
+
+    return labels
+
+
+def colour_labels(labels, layers):
+    """
+    Turns an array of layer indices into RGB values. Indices past the
+    end of the layers are black, as the transparent parts of an SVG
+    render.
+
+    :param labels: An array of layer indices.
+    :param layers: The RGB value of each layer.
+
+    :returns: a uint8 array of RGB values.
+    """
+
+    colours = np.zeros((max(len(layers), labels.max() + 1), 3),
+                       dtype=np.uint8)
+    colours[:len(layers)] = layers
+
+    return colours[labels]
+
 ###########################################
 # Wrappers
 
@@ -353,10 +504,10 @@ def body(pad, margin, left, right, traces, layers):
     :returns: A numpy array of RGB values for the earth model.
     """
 
-    infile = body_svg( pad, margin, left, right, traces, layers )
-    arr = svg2array(infile, layers)
-    infile.close()
-    return arr
+    labels = body_labels(pad, margin, left, right, traces,
+                         nlayers=len(layers))
+
+    return colour_labels(labels, layers)
     
 def channel(pad, thickness, traces, layers):
     """
@@ -374,8 +525,4 @@ def channel(pad, thickness, traces, layers):
     :returns: a numpy array of the RGB values for the data model.
     """
 
-    infile = channel_svg( pad, thickness, traces, layers )
-    arr = svg2array( infile, layers )
-    infile.close()
-
-    return arr
+    return colour_labels(channel_labels(pad, thickness, traces), layers)
@@ -0,0 +1,407 @@
+'''
+===================
+modelr.montecarlo
+===================
+
+Monte Carlo simulation of the reflectivity of an interface between
+two rocks with uncertain properties. Samples are drawn and evaluated
+a chunk at a time and only running summaries are kept, so the memory
+used doesn't grow with the number of iterations.
+
+MonteCarloRunner spreads the chunks over a process pool, each drawing
+from its own random stream, and merges their summaries.
+'''
+
+import atexit
+import functools
+import multiprocessing as mp
+import os
+import threading
+
+import numpy as np
+from bruges import reflection
+
+from modelr.reflectivity import reflectivity_array
+from modelr.stats import StreamingStats
+
+NAMES = ('vp', 'vs', 'rho')
+
+
+@functools.lru_cache(maxsize=32)
+def _cholesky(correlation):
+
+    matrix = np.full((3, 3), correlation)
+    np.fill_diagonal(matrix, 1.0)
+
+    factor = np.linalg.cholesky(matrix)
+    factor.flags.writeable = False
+
+    return factor
+
+
+def correlated_normal(rock, size, correlation=0.8, rng=None):
+    """
+    Draws vp, vs and rho around the properties of a rock with
+    correlated uncertainties.
+
+    :param rock: A RockProperties with vp_sig, vs_sig and rho_sig.
+    :param size: The number of samples.
+    :keyword correlation: The correlation between the uncertainties of
+                          each property.
+    :keyword rng: A numpy Generator. Defaults to a fresh one.
+
+    :returns: arrays of vp, vs and rho.
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    data = _cholesky(float(correlation)).dot(
+        rng.standard_normal((3, size)))
+
+    return (data[0] * rock.vp_sig + rock.vp,
+            data[1] * rock.vs_sig + rock.vs,
+            data[2] * rock.rho_sig + rock.rho)
+
+
+class _Star(object):
+
+    def __init__(self, function):
+
+        self.function = function
+
+    def __call__(self, args):
+
+        return self.function(*args)
+
+
+# Pools shared by every run in this process, by number of processes
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def default_workers():
+    '''
+    The number of processes for Monte Carlo runs, from
+    MODELR_MONTE_CARLO_WORKERS so worker processes use the same
+    setting as the server. Defaults to 1, running in this process.
+    '''
+
+    return max(1, int(os.environ.get('MODELR_MONTE_CARLO_WORKERS', 1)))
+
+
+def shared_pool(processes):
+    '''
+    Returns the process pool of a given size, starting it on first
+    use. Concurrent runs share it, so requests never start pools of
+    their own.
+    '''
+
+    with _pools_lock:
+        pool = _pools.get(processes)
+        if pool is None:
+            pool = mp.get_context('spawn').Pool(processes)
+            _pools[processes] = pool
+
+    return pool
+
+
+@atexit.register
+def _close_pools():
+
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.terminate()
+        _pools.clear()
+
+
+def _run_block(simulate, size, seed):
+
+    return simulate(size, np.random.default_rng(seed))
+
+
+class MonteCarloRunner(object):
+    """
+    Runs a simulation in blocks over a process pool.
+
+    Block i draws from stream i spawned from the seed, and the
+    partial results are merged in block order. A seed gives
+    bit-identical results whatever the number of workers, including
+    when it runs in this process.
+
+    The pool is the shared_pool of that size, kept for the life of the
+    process. Worker processes of the web server are daemons, which
+    can't start a pool of their own, so there everything runs in this
+    process.
+
+    :keyword workers: The number of processes, capped at the number of
+                      CPUs. Defaults to default_workers(), and 1 runs
+                      in this process.
+    :keyword block_size: Iterations in a block.
+    """
+
+    def __init__(self, workers=None, block_size=10000):
+
+        if workers is None:
+            workers = default_workers()
+
+        self.workers = max(1, min(workers, os.cpu_count() or 1))
+        self.block_size = block_size
+
+    @property
+    def parallel(self):
+
+        return self.workers > 1 and not mp.current_process().daemon
+
+    def map(self, function, tasks):
+        """
+        Apply function to each tuple of arguments in tasks.
+
+        :returns: an iterator of the results, in the order of tasks.
+        """
+
+        tasks = list(tasks)
+
+        if not self.parallel or len(tasks) < 2:
+            for task in tasks:
+                yield function(*task)
+            return
+
+        pool = shared_pool(self.workers)
+        for result in pool.imap(_Star(function), tasks):
+            yield result
+
+    def blocks(self, iterations, seed=None):
+        """
+        Splits a simulation into blocks.
+
+        :returns: a list of (size, SeedSequence) tuples.
+        """
+
+        sizes = [min(self.block_size, iterations - start)
+                 for start in range(0, iterations, self.block_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+        return list(zip(sizes, seeds))
+
+    def run(self, simulate, iterations, seed=None):
+        """
+        Run a simulation.
+
+        :param simulate: A picklable function of (size, rng) that
+                         returns a partial result with a merge method,
+                         e.g. an AVOSummary.
+        :param iterations: The total number of iterations.
+        :keyword seed: The seed. Defaults to fresh entropy.
+
+        :returns: the merged result, or None for no iterations.
+        """
+
+        result = None
+        tasks = [(simulate, size, child)
+                 for size, child in self.blocks(iterations, seed)]
+
+        for partial in self.map(_run_block, tasks):
+            result = partial if result is None else result.merge(partial)
+
+        return result
+
+
+class AVOSummary(object):
+    """
+    Running summary of a Monte Carlo AVO simulation.
+
+    :param rocks: The (upper, lower) RockProperties.
+    :param theta: The angles [deg].
+
+    :keyword bins: Histogram bins for each rock property, spanning
+                   four standard deviations either side of the mean.
+    :keyword curve_bins: Histogram bins over [-1, 1] for the
+                         reflectivity percentiles.
+    :keyword percentiles: Reflectivity percentiles to report.
+    :keyword keep: The number of curves kept for plotting.
+    """
+
+    def __init__(self, rocks, theta, bins=15, curve_bins=400,
+                 percentiles=(10, 50, 90), keep=200):
+
+        self.theta = np.atleast_1d(theta)
+        self.keep = keep
+
+        self.curves = StreamingStats(self.theta.shape,
+                                     percentiles=percentiles,
+                                     bins=curve_bins, range=(-1.0, 1.0))
+
+        # Edges for vp, vs, rho of the upper then the lower rock
+        self.edges = []
+        for rock in rocks:
+            for name in NAMES:
+                mean = getattr(rock, name)
+                sigma = getattr(rock, name + '_sig') or 1.0
+                self.edges.append(np.linspace(mean - 4 * sigma,
+                                              mean + 4 * sigma,
+                                              bins + 1))
+        self.edges = np.array(self.edges)
+        self.counts = np.zeros((len(self.edges), bins), dtype=np.int64)
+
+        self.critical_sum = 0.0
+        self.critical_count = 0
+
+        self.samples = np.zeros((0, self.theta.size))
+        self.properties = np.zeros((len(self.edges), 0))
+
+    @property
+    def count(self):
+
+        return self.curves.count
+
+    def add(self, properties, reflect):
+        """
+        Add a chunk of samples.
+
+        :param properties: vp, vs, rho of the upper rock then the
+                           lower rock, each an array of samples.
+        :param reflect: Reflectivities indexed as [sample, theta].
+        """
+
+        properties = np.asarray(properties)
+        bins = self.counts.shape[1]
+
+        for i, values in enumerate(properties):
+            edges = self.edges[i]
+            index = np.searchsorted(edges, values, side='right') - 1
+            index = np.clip(index, 0, bins - 1)
+            self.counts[i] += np.bincount(index, minlength=bins)
+
+        self.curves.add(reflect)
+
+        vp0, vp1 = properties[0], properties[3]
+        faster = vp1 > vp0
+        self.critical_sum += np.sum(
+            np.degrees(np.arcsin(vp0[faster] / vp1[faster])))
+        self.critical_count += int(np.count_nonzero(faster))
+
+        room = self.keep - len(self.samples)
+        if room > 0:
+            self.samples = np.concatenate((self.samples, reflect[:room]))
+            self.properties = np.concatenate(
+                (self.properties, properties[:, :room]), axis=1)
+
+    def merge(self, other):
+        """
+        Add the samples summarized by other, an AVOSummary of the
+        same rocks and angles.
+
+        :returns: self.
+        """
+
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('summaries have different histograms')
+
+        self.curves.merge(other.curves)
+        self.counts += other.counts
+
+        self.critical_sum += other.critical_sum
+        self.critical_count += other.critical_count
+
+        room = self.keep - len(self.samples)
+        if room > 0:
+            self.samples = np.concatenate(
+                (self.samples, other.samples[:room]))
+            self.properties = np.concatenate(
+                (self.properties, other.properties[:, :room]), axis=1)
+
+        return self
+
+    @property
+    def critical_angle(self):
+        """
+        The mean critical angle of the samples with a faster lower
+        rock, or None if there were none.
+        """
+
+        if self.critical_count == 0:
+            return None
+
+        return self.critical_sum / self.critical_count
+
+    def density(self, i):
+        """
+        Returns the (density, edges) histogram of property i, in the
+        order vp, vs, rho of the upper rock then the lower rock.
+        """
+
+        edges = self.edges[i]
+        total = max(self.counts[i].sum(), 1)
+
+        return self.counts[i] / (total * np.diff(edges)), edges
+
+
+def _avo_block(rock0, rock1, theta, method, correlation, kwargs,
+               size, rng):
+
+    return avo_monte_carlo(rock0, rock1, size, theta, method,
+                           correlation, chunk_size=size, rng=rng,
+                           **kwargs)
+
+
+def avo_monte_carlo(rock0, rock1, iterations, theta=np.arange(90),
+                    method=reflection.zoeppritz_rpp, correlation=0.8,
+                    chunk_size=10000, rng=None, seed=None, workers=1,
+                    **kwargs):
+    """
+    Simulates the reflectivity of an interface for rock properties
+    drawn around their uncertainties. Each chunk of samples is
+    evaluated at every angle in one call.
+
+    With a single random generator the chunks run in turn. Otherwise
+    they run as the blocks of a MonteCarloRunner, reproducible from
+    the seed.
+
+    :param rock0: The upper RockProperties.
+    :param rock1: The lower RockProperties.
+    :param iterations: The number of samples.
+
+    :keyword theta: The angles [deg].
+    :keyword method: The reflectivity method. See
+                     constants.REFLECTION_MODELS.
+    :keyword correlation: Correlation between the uncertainties of
+                          each rock's properties.
+    :keyword chunk_size: Samples evaluated at once.
+    :keyword rng: A numpy Generator to draw every sample from.
+    :keyword seed: The seed of the block streams when rng isn't
+                   given. Defaults to fresh entropy.
+    :keyword workers: Processes for the blocks, or None for the
+                      default. See MonteCarloRunner.
+    :keyword kwargs: Passed to AVOSummary.
+
+    :returns: an AVOSummary.
+    """
+
+    if rng is None:
+        simulate = functools.partial(_avo_block, rock0, rock1, theta,
+                                     method, correlation, kwargs)
+        runner = MonteCarloRunner(workers, block_size=chunk_size)
+        summary = runner.run(simulate, iterations, seed)
+
+        if summary is None:
+            summary = AVOSummary((rock0, rock1), theta, **kwargs)
+
+        return summary
+
+    summary = AVOSummary((rock0, rock1), theta, **kwargs)
+
+    for start in range(0, iterations, chunk_size):
+
+        size = min(chunk_size, iterations - start)
+
+        upper = correlated_normal(rock0, size, correlation, rng)
+        lower = correlated_normal(rock1, size, correlation, rng)
+
+        # Upper and lower rock as two samples of one interface
+        vp, vs, rho = (np.stack((u, l)) for u, l in zip(upper, lower))
+        reflect = reflectivity_array(vp, vs, rho, theta, method)[0]
+
+        summary.add(upper + lower, reflect)
+
+    return summary
@@ -0,0 +1,127 @@
+'''
+=================
+modelr.pipeline
+=================
+
+A chain of modelling stages that are only recomputed when their own
+parameters or an upstream stage change.
+'''
+
+import threading
+from collections import OrderedDict
+
+from modelr.web.cache import result_key
+
+
+class Stage(object):
+    '''
+    One step of a pipeline.
+
+    :param name: The name of the stage.
+    :param func: Called with the values of the input stages, in order,
+                 followed by the parameters as keyword arguments.
+    :keyword inputs: Names of the stages this one depends on.
+    :keyword params: Names of the parameters this stage reads.
+    '''
+
+    def __init__(self, name, func, inputs=(), params=()):
+
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = tuple(params)
+
+
+class Pipeline(object):
+    '''
+    Runs a graph of stages, keeping the last few results of each.
+
+    The key of a stage is a hash of its parameters and the keys of its
+    inputs, so it can be worked out without running anything. A stage
+    is only run when no result is held for its key, and its inputs are
+    only run if it is.
+
+    Results are shared between runs and must not be modified by the
+    stages downstream.
+
+    :param stages: A list of Stage objects.
+    :keyword size: The number of results to keep for each stage.
+    '''
+
+    def __init__(self, stages, size=2):
+
+        self.stages = OrderedDict((stage.name, stage) for stage in stages)
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._results = dict((name, OrderedDict())
+                             for name in self.stages)
+
+        self.computed = dict((name, 0) for name in self.stages)
+        self.reused = dict((name, 0) for name in self.stages)
+
+    def key(self, name, params):
+        '''
+        Returns the key of a stage for a set of parameters.
+        '''
+
+        stage = self.stages[name]
+
+        return result_key(name,
+                          [(p, params[p]) for p in stage.params],
+                          [self.key(up, params) for up in stage.inputs])
+
+    def run(self, name, params):
+        '''
+        Get the result of a stage, running it and any stale upstream
+        stages as needed.
+
+        :param name: The stage to run.
+        :param params: A dictionary holding every parameter read by
+                       the stage and its inputs.
+        '''
+
+        stage = self.stages[name]
+        key = self.key(name, params)
+        results = self._results[name]
+
+        with self._lock:
+            if key in results:
+                results.move_to_end(key)
+                self.reused[name] += 1
+                return results[key]
+
+        values = [self.run(up, params) for up in stage.inputs]
+        kwargs = dict((p, params[p]) for p in stage.params)
+
+        value = stage.func(*values, **kwargs)
+
+        with self._lock:
+            self.computed[name] += 1
+            results[key] = value
+            while len(results) > self.size:
+                results.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        '''
+        Drop all the results and reset the counters.
+        '''
+
+        with self._lock:
+            for name in self.stages:
+                self._results[name].clear()
+                self.computed[name] = 0
+                self.reused[name] = 0
+
+    def stats(self):
+        '''
+        Returns the number of times each stage was computed and
+        reused.
+        '''
+
+        with self._lock:
+            return dict((name, {"computed": self.computed[name],
+                                "reused": self.reused[name]})
+                        for name in self.stages)
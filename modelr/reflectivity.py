@@ -7,12 +7,17 @@ modelr.reflectivity
 Basic methods for creating models.
 '''
 
+import hashlib
+import threading
+from collections import OrderedDict
+
 import numpy as np
-import scipy
+from scipy.fftpack import next_fast_len
 from bruges import reflection
-from itertools import product
 from svgwrite import rgb
 
+from modelr.wavelets import wavelet_bank
+
 ###################
 # New style functions
 
@@ -60,27 +65,447 @@ def rock_reflectivity(Rp0, Rp1, theta=0.0,
     return np.nan_to_num(ref)
 
 
-def reflectivity_array(vp, vs, rho, theta,
-                       reflectivity_method=reflection.zoeppritz_rpp):
-    if np.ndim(theta) > 0:
-        ref = np.array([reflectivity_method(vp[:-1, ...], vs[:-1, ...],
-                                            rho[:-1, ...],
-                                            vp[1:, ...], vs[:1, ...],
-                                            rho[1:, ...], angle)
-                        for angle in theta])
-        ref = np.rollaxis(ref, 0, np.ndim(vp) + 1)
-    else:
-        ref = reflectivity_method(vp[:-1, ...], vs[:-1, ...],
-                                  rho[:-1, ...],
-                                  vp[1:, ...], vs[:1, ...],
-                                  rho[1:, ...], theta)
-    return np.nan_to_num(ref)
+# Where each reflection method puts the angle axis, see _theta_axis
+_THETA_AXIS = {}
+
+# Methods that only take single rock properties, and a method that
+# gives the same real part for arrays of them
+_BROADCASTABLE = {reflection.zoeppritz: reflection.zoeppritz_rpp}
+
+
+def _theta_axis(method):
+    """
+    Finds out how a reflection method broadcasts an array of angles
+    against property arrays with a trailing axis of length one.
+
+    :returns: -1 if the angles come out as the trailing axis, 0 if
+              they come out first, or None if the method can't
+              broadcast angles against arrays.
+    """
+
+    if method not in _THETA_AXIS:
+        props = np.array([[2000.], [2500.]])
+
+        try:
+            shape = np.shape(method(props, props / 2, props,
+                                    props + 100, props / 2, props,
+                                    np.array([0., 10., 20.])))
+        except (ValueError, IndexError):
+            shape = None
+
+        _THETA_AXIS[method] = {(2, 3): -1, (3, 2): 0}.get(shape)
+
+    return _THETA_AXIS[method]
+
+
+def reflectivity_array(vp, vs, rho, theta=0.0,
+                       reflectivity_method=reflection.zoeppritz_rpp,
+                       dtype=np.float64, chunk_size=None):
+    """
+    Calculates the reflectivity at every interface of a grid of rock
+    properties.
+
+    The angles are broadcast as a trailing axis through the reflection
+    method, a block of samples at a time, and written straight into
+    the output array.
+
+    :param vp: P-wave velocities, indexed as [sample, ...].
+    :param vs: S-wave velocities, the same shape as vp.
+    :param rho: Densities, the same shape as vp.
+    :keyword theta: A single angle or an array of angles.
+    :keyword reflectivity_method: A method from
+                                  constants.REFLECTION_MODELS.
+    :keyword dtype: The float type of the output, e.g. np.float32.
+    :keyword chunk_size: The number of samples to calculate at once.
+                         Defaults to about a million values per block.
+
+    :returns: the real part of the reflectivity, indexed as
+              [sample, ..., theta] with one less sample than the
+              input. The theta axis is left off for a single angle.
+    """
+
+    vp, vs, rho = (np.asarray(prop, dtype=float)
+                   for prop in (vp, vs, rho))
+    angles = np.atleast_1d(np.asarray(theta, dtype=float))
+
+    shape = (vp.shape[0] - 1,) + vp.shape[1:]
+    output = np.empty(shape + (angles.size,), dtype=dtype)
+
+    reflectivity_method = _BROADCASTABLE.get(reflectivity_method,
+                                             reflectivity_method)
+
+    if chunk_size is None:
+        row_size = max(1, output[0].size)
+        chunk_size = max(1, 2**20 // row_size)
+
+    axis = _theta_axis(reflectivity_method)
+
+    for i in range(0, shape[0], chunk_size):
+        stop = min(i + chunk_size, shape[0])
+        upper = slice(i, stop)
+        lower = slice(i + 1, stop + 1)
+        out = output[upper]
+
+        if axis is None:
+            # Fall back to one call per angle
+            for j, angle in enumerate(angles):
+                out[..., j] = np.real(
+                    reflectivity_method(vp[upper], vs[upper],
+                                        rho[upper], vp[lower],
+                                        vs[lower], rho[lower],
+                                        angle))
+        else:
+            ref = reflectivity_method(vp[upper, ..., np.newaxis],
+                                      vs[upper, ..., np.newaxis],
+                                      rho[upper, ..., np.newaxis],
+                                      vp[lower, ..., np.newaxis],
+                                      vs[lower, ..., np.newaxis],
+                                      rho[lower, ..., np.newaxis],
+                                      angles)
+            ref = np.real(ref)
+
+            if axis == 0 and angles.size > 1:
+                ref = np.moveaxis(ref, 0, -1)
+
+            out[...] = ref.reshape(out.shape)
+
+    np.nan_to_num(output, copy=False)
+
+    if np.ndim(theta) == 0:
+        return output[..., 0]
+
+    return output
+
+
+def label_image(data, colourmap):
+    """
+    Converts an RGB earth model into an array of integer labels and a
+    small table of rock properties indexed by label.
+
+    Every distinct colour in the image gets its own label. Colours
+    that are not in the colourmap are given NaN properties.
+
+    :param data: A numpy array of RGB values, indexed as
+                 (sample, trace, (R,G,B) )
+    :param colourmap: A lookup table (dict) that maps colour values to
+                      rock property structures.
+
+    :returns: a tuple of (labels, properties). labels is the smallest
+              unsigned integer array (usually uint8) that holds every
+              label, indexed as [sample, trace]. properties is a
+              record array with vp, vs and rho fields indexed by
+              label.
+    """
+
+    labels, colours = label_colours(data)
+
+    return labels, colour_properties(colours, colourmap)
+
+
+def label_colours(data):
+    """
+    Labels each distinct colour of an RGB earth model.
+
+    :param data: A numpy array of RGB values, indexed as
+                 (sample, trace, (R,G,B) )
+
+    :returns: a tuple of (labels, colours). labels is indexed as
+              [sample, trace] and colours holds the packed 0xRRGGBB
+              value of each label.
+    """
+
+    # Pack each pixel into a single integer so the unique colours can
+    # be found in one pass. The masking mirrors svgwrite.rgb.
+    rgb_data = np.asarray(data).astype(np.int64) & 255
+    codes = ((rgb_data[..., 0] << 16) | (rgb_data[..., 1] << 8) |
+             rgb_data[..., 2])
+
+    colours, inverse = np.unique(codes, return_inverse=True)
+
+    labels = inverse.reshape(codes.shape)\
+                    .astype(np.min_scalar_type(colours.size - 1))
+
+    return labels, colours
+
+
+def colour_properties(colours, colourmap):
+    """
+    Looks up the rock properties of each label.
+
+    :param colours: The packed colour of each label, from
+                    label_colours.
+    :param colourmap: A lookup table (dict) that maps colour values to
+                      rock property structures.
+
+    :returns: a record array with vp, vs and rho fields indexed by
+              label. Colours that are not in the colourmap are NaN.
+    """
+
+    properties = np.rec.array(
+        np.full(len(colours), np.nan,
+                dtype=[('vp', 'f8'), ('vs', 'f8'), ('rho', 'f8')]))
+
+    for i, code in enumerate(colours):
+        key = rgb((code >> 16) & 255, (code >> 8) & 255, code & 255)
+        rock = colourmap.get(key)
+
+        # Don't fill if not in the cmap. If the model was
+        # build properly this shouldn't happen.
+        if rock is None:
+            continue
+
+        properties.vp[i] = rock.vp
+        properties.vs[i] = rock.vs
+        properties.rho[i] = rock.rho
+
+    return properties
+
+
+def get_interfaces(labels):
+    """
+    Finds the interfaces in a labelled earth model and the unique
+    (upper rock, lower rock) pairs that make them.
+
+    :param labels: An integer array of rock labels, indexed as
+                   [sample, trace].
+
+    :returns: a tuple of (samples, traces, pair_index, pairs).
+              samples and traces index the upper pixel of each
+              interface, pair_index gives the row in pairs for each
+              interface and pairs is an array of (upper, lower)
+              labels.
+    """
+
+    upper = labels[:-1, ...]
+    lower = labels[1:, ...]
+
+    samples, traces = np.nonzero(upper != lower)
+
+    pair_codes = (upper[samples, traces].astype(np.int64) << 32 |
+                  lower[samples, traces])
+
+    codes, pair_index = np.unique(pair_codes, return_inverse=True)
+    pairs = np.column_stack((codes >> 32, codes & 0xffffffff))
+
+    return samples, traces, pair_index.ravel(), pairs
+
+
+def pair_reflectivity(properties, pairs, theta=0.0,
+                      method=reflection.zoeppritz):
+    """
+    Calculates the reflectivity of each rock pair for every angle.
+
+    :param properties: A record array of vp, vs, rho indexed by label.
+    :param pairs: An array of (upper, lower) labels.
+
+    :keyword theta: A single angle or an array of angles [deg].
+    :keyword method: The reflectivity method to use. See
+                     bruges.reflection for available functions.
+
+    :returns: an array of reflection coefficients indexed as
+              [pair, theta]. Pairs with unmapped rocks are zero.
+    """
+
+    coefficients = np.zeros((len(pairs), np.size(theta)))
+
+    for i, (upper, lower) in enumerate(pairs):
+
+        if (np.isnan(properties.vp[upper]) or
+                np.isnan(properties.vp[lower])):
+            continue
+
+        coefficients[i, :] = np.real(rock_reflectivity(
+            properties[upper], properties[lower], theta=theta,
+            method=method))
+
+    return coefficients
+
+
+class SparseReflectivity(object):
+    """
+    Reflectivity of a blocky earth model stored by interface.
+
+    Each interface is a (sample, trace, pair) triplet, and each rock
+    pair has one row of coefficients in a [pair, theta] table, so the
+    memory used grows with the number of interfaces rather than the
+    size of the model.
+
+    :param shape: The (samples, traces) shape of the model.
+    :param samples: The sample index of each interface.
+    :param traces: The trace index of each interface.
+    :param pair_index: The row in coefficients for each interface.
+    :param coefficients: Reflection coefficients indexed as
+                         [pair, theta].
+    :keyword pairs: The (upper, lower) labels of each pair, needed to
+                    update the coefficients of a single rock.
+    """
+
+    def __init__(self, shape, samples, traces, pair_index,
+                 coefficients, pairs=None):
+
+        self.samples = np.asarray(samples)
+        self.traces = np.asarray(traces)
+        self.pair_index = np.asarray(pair_index)
+        self.coefficients = np.atleast_2d(coefficients)
+        self.pairs = pairs
+
+        self.shape = (shape[0], shape[1], self.coefficients.shape[1])
+
+        self._order = None
+        self._bounds = None
+
+    @classmethod
+    def from_labels(cls, labels, properties, theta=0,
+                    reflectivity_method=reflection.zoeppritz):
+        """
+        Finds the interfaces of a labelled earth model. See
+        label_reflectivity for the parameters.
+        """
+
+        samples, traces, pair_index, pairs = get_interfaces(labels)
+
+        coefficients = pair_reflectivity(properties, pairs,
+                                         theta=theta,
+                                         method=reflectivity_method)
+
+        return cls(labels.shape, samples, traces, pair_index,
+                   coefficients, pairs=pairs)
+
+    @property
+    def nbytes(self):
+
+        return (self.samples.nbytes + self.traces.nbytes +
+                self.pair_index.nbytes + self.coefficients.nbytes)
+
+    def _index(self):
+
+        # Interfaces sorted by pair, and where each pair starts
+        if self._order is None:
+            order = np.argsort(self.pair_index, kind='stable')
+            self._bounds = np.searchsorted(
+                self.pair_index[order],
+                np.arange(len(self.coefficients) + 1))
+            self._order = order
+
+        return self._order, self._bounds
+
+    def interfaces(self, pair_ids):
+        """
+        Returns the positions in samples, traces and pair_index of
+        every interface made by the given pairs.
+
+        The interfaces are sorted by pair once, so later lookups
+        only touch the interfaces asked for.
+        """
+
+        order, bounds = self._index()
+
+        pair_ids = np.atleast_1d(pair_ids)
+        if pair_ids.size == 0:
+            return np.zeros(0, dtype=int)
+
+        return np.concatenate([order[bounds[p]:bounds[p + 1]]
+                               for p in pair_ids])
+
+    def select(self, pair_ids, coefficients=None):
+        """
+        Returns a SparseReflectivity holding only the interfaces of
+        the given pairs.
+
+        :param pair_ids: Rows of the coefficient table to keep.
+        :keyword coefficients: Coefficients to use for those pairs,
+                               indexed as [pair, theta]. Defaults to
+                               the current ones.
+        """
+
+        pair_ids = np.atleast_1d(pair_ids)
+        index = self.interfaces(pair_ids)
+
+        if coefficients is None:
+            coefficients = self.coefficients[pair_ids]
+
+        remap = np.zeros(len(self.coefficients), dtype=int)
+        remap[pair_ids] = np.arange(pair_ids.size)
+
+        pairs = self.pairs[pair_ids] if self.pairs is not None else None
+
+        return SparseReflectivity(
+            self.shape[:2], self.samples[index], self.traces[index],
+            remap[self.pair_index[index]],
+            np.reshape(coefficients, (pair_ids.size, self.shape[2])),
+            pairs=pairs)
+
+    def patch(self, pair_ids, coefficients):
+        """
+        Returns a copy with new coefficients for some pairs. The
+        interfaces and their index are shared with this one, so
+        anything handed out earlier is left alone.
+
+        :param pair_ids: Rows of the coefficient table to replace.
+        :param coefficients: The new rows, indexed as [pair, theta].
+        """
+
+        table = self.coefficients.copy()
+        table[pair_ids] = coefficients
+
+        patched = SparseReflectivity(self.shape[:2], self.samples,
+                                     self.traces, self.pair_index,
+                                     table, pairs=self.pairs)
+        patched._order, patched._bounds = self._index()
+
+        return patched
+
+    def todense(self):
+        """
+        Returns the reflectivity as an array indexed as
+        [sample, trace, theta].
+        """
+
+        dense = np.zeros(self.shape, dtype=self.coefficients.dtype)
+        dense[self.samples, self.traces, :] = \
+            self.coefficients[self.pair_index, :]
+
+        return dense
+
+
+def label_reflectivity(labels, properties, theta=0,
+                       reflectivity_method=reflection.zoeppritz,
+                       sparse=False):
+    """
+    Create reflectivities from a labelled earth model. The reflection
+    method is evaluated once for each unique rock pair, and the
+    results are scattered back onto the interfaces.
+
+    :param labels: An integer array of rock labels, indexed as
+                   [sample, trace].
+    :param properties: A record array of vp, vs, rho indexed by label.
+
+    :keyword theta: Angle of incidence to use reflectivity. Can be a
+                  float or an array of angles [deg].
+    :keyword reflectivity_method: The reflectivity algorithm to use.
+                                  See bruges.reflection for methods.
+    :keyword sparse: Return a SparseReflectivity instead of an array.
+
+    :returns: The vp reflectivity coefficients corresponding to the
+             earth model. Data will be indexed as
+             [sample, trace, theta]
+    """
+
+    reflectivity = SparseReflectivity.from_labels(
+        labels, properties, theta=theta,
+        reflectivity_method=reflectivity_method)
+
+    if sparse:
+        return reflectivity
+
+    return reflectivity.todense()
 
 
 def get_reflectivity(data,
                      colourmap,
                      theta=0,
-                     reflectivity_method=reflection.zoeppritz
+                     reflectivity_method=reflection.zoeppritz,
+                     sparse=False
                      ):
     '''
     Create reflectivities from an image of an earth model and a
@@ -97,6 +522,7 @@ def get_reflectivity(data,
                   float or an array of angles [deg].
     :keyword reflectivity_method: The reflectivity algorithm to use.
                                   See bruges.reflection for methods.
+    :keyword sparse: Return a SparseReflectivity instead of an array.
 
     :returns: The vp reflectivity coefficients corresponding to the
              earth model. Data will be indexed as
@@ -105,71 +531,152 @@ def get_reflectivity(data,
 
     # Check if we only have one trace of data, and reform the array
     if(data.ndim == 2):
-        reflect_data = np.zeros((data.size, 1, np.size(theta)))
         data = np.reshape(data, (data.shape[0], 1, 3))
-    else:
-        reflect_data = np.zeros((data.shape[0], data.shape[1],
-                                np.size(theta)))
 
-    # Make an array that only has the boundaries in it
-    boundaries = get_boundaries(data)
+    labels, properties = label_image(data, colourmap)
 
-    for i in boundaries:
+    return label_reflectivity(labels, properties, theta=theta,
+                              reflectivity_method=reflectivity_method,
+                              sparse=sparse)
 
-        # These are the indices in data
-        j = i.copy()
-        j[0] += 1
 
-        # Get the colourmap dictionary keys
-        c1 = rgb(data[i[0], i[1], 0], data[i[0], i[1], 1],
-                 data[i[0], i[1], 2])
-        c2 = rgb(data[j[0], j[1], 0], data[j[0], j[1], 1],
-                 data[j[0], j[1], 2])
+def wavelet_spectra(wavelets, nfft):
+    """
+    Computes the spectra of a bank of wavelets for FFT convolution.
 
-        # Don't calculate if not in the cmap. If the model was
-        # build properly this shouldn't happen.
-        if((c1 not in colourmap) or (c2 not in colourmap)):
-            continue
+    :param wavelets: An array of wavelets indexed as
+                     [samples, wavelet].
+    :param nfft: The padded FFT length.
+
+    :returns: the real FFT of each wavelet, indexed as
+              [frequency, wavelet].
+
+    .. seealso:: modelr.wavelets.WaveletBank.spectra, which caches the
+                 spectra of shared wavelet banks.
+    """
+
+    return np.fft.rfft(wavelets, n=nfft, axis=0)
+
+
+def sparse_convolve(wavelets, reflectivity, traces=None, theta=None,
+                    chunk_size=None):
+    """
+    Convolves wavelets against a SparseReflectivity by adding a scaled
+    copy of each wavelet at every interface. The output matches
+    do_convolve on the dense reflectivity.
+
+    :param wavelets: An array of wavelets indexed as
+                     [samples, wavelet].
+    :param reflectivity: A SparseReflectivity.
+
+    :keyword traces: Indexes of traces to convolve. Defaults to every
+                     trace.
+    :keyword chunk_size: The maximum number of interfaces to add at
+                         once. Defaults to about a million values per
+                         block.
+
+    :returns: an array of synthetic seismic traces, indexed as
+             [samples, traces, theta, wavelet].
+    """
+
+    nsamps, ntraces_total, nangles = reflectivity.shape
+
+    if traces is None:
+        traces = np.arange(ntraces_total)
+    traces = np.atleast_1d(traces)
+    ntraces = traces.size
+
+    ntheta = nangles if theta is None else np.size(theta)
+
+    if wavelets.ndim == 1:
+        wavelets = wavelets[:, np.newaxis]
+    nwave, n_wavelets = wavelets.shape
+
+    # Same alignment as fftconvolve(..., mode='same')
+    start = (nwave - 1) // 2
+    offsets = np.arange(nwave) - start
+
+    # Where each selected trace goes in the output
+    position = np.full(ntraces_total, -1)
+    position[traces] = np.arange(ntraces)
+
+    keep = position[reflectivity.traces] >= 0
+    samples = reflectivity.samples[keep]
+    columns = position[reflectivity.traces[keep]]
+    pair_index = reflectivity.pair_index[keep]
+
+    # The response of each pair to each wavelet, [pair, k, theta*wav]
+    responses = (reflectivity.coefficients[:, np.newaxis, :ntheta,
+                                           np.newaxis] *
+                 wavelets[np.newaxis, :, np.newaxis, :])
+    responses = responses.reshape(len(reflectivity.coefficients),
+                                  nwave, ntheta * n_wavelets)
+
+    output = np.zeros((nsamps * ntraces, ntheta * n_wavelets),
+                      dtype=np.result_type(responses, float))
 
-        # Get the reflectivity
-        reflect_data[i[0], i[1], :] = rock_reflectivity(
-            colourmap[c1], colourmap[c2], theta=theta,
-            method=reflectivity_method)
+    if chunk_size is None:
+        chunk_size = max(1, 2**20 // max(1, nwave * ntheta *
+                                         n_wavelets))
 
-    return reflect_data
+    for i in range(0, samples.size, chunk_size):
+
+        rows = (samples[i:i + chunk_size, np.newaxis] +
+                offsets[np.newaxis, :])
+        valid = (rows >= 0) & (rows < nsamps)
+
+        index = rows * ntraces + columns[i:i + chunk_size, np.newaxis]
+        values = responses[pair_index[i:i + chunk_size]]
+
+        np.add.at(output, index[valid], values[valid])
+
+    return output.reshape(nsamps, ntraces, ntheta, n_wavelets)
 
 
 def do_convolve(wavelets, data,
-                traces=None, theta=None):
+                traces=None, theta=None, chunk_size=None):
     """
     Convolves wavelets against a reflectivity dataset.
 
+    The whole reflectivity block is transformed along the sample axis
+    at once, multiplied against the spectra of every wavelet and
+    inverse transformed in a single call.
+
     :param wavelets: An array of wavelets to convolve with the
                      dataset. The array must be indexed as
                      [samples, wavelet].
     :param: data: An array of reflectivity data to convolve against.
-                  Must be indexed as [samples, traces ].
+                  Must be indexed as [samples, traces, theta]. A
+                  SparseReflectivity is passed on to sparse_convolve.
 
     :keyword traces: Indexes of of traces to convolve. If none are
                      specified, convolutions will be calculated for
                      every trace.
+    :keyword chunk_size: The maximum number of traces to transform at
+                         once. Use this to bound the peak memory for
+                         large models. Defaults to all the traces.
 
     :returns: an array of synthetic seismic traces, indexed as
-             [samples, traces, wavelet].
+             [samples, traces, theta, wavelet].
     """
 
+    if isinstance(data, SparseReflectivity):
+        return sparse_convolve(wavelets, data, traces=traces,
+                               theta=theta)
+
     if traces is None:
         traces = np.arange(data.shape[1])
+    traces = np.atleast_1d(traces)
     ntraces = np.size(traces)
 
-    if ntraces == 1:
-        traces = [traces]
-
     if theta is None:
         theta = np.arange(data.shape[2])
 
     ntheta = np.size(theta)
 
+    # Banks from modelr.wavelets have their spectra cached
+    bank = wavelets
+
     if (wavelets.ndim > 1):
         n_wavelets = wavelets.shape[1]
     else:
@@ -186,18 +693,253 @@ def do_convolve(wavelets, data,
     else:
         pad = 0
 
+    nsamps = data.shape[0]
+    nwave = wavelets.shape[0]
+
+    # Same alignment as fftconvolve(..., mode='same')
+    nfft = next_fast_len(nsamps + nwave - 1)
+    start = (nwave - 1) // 2
+
+    spectra = wavelet_bank.spectra(bank, nfft)[:, np.newaxis,
+                                               np.newaxis, :]
+
+    if chunk_size is None:
+        chunk_size = ntraces
+    chunk_size = max(int(chunk_size), 1)
+
     # Initialize the output
-    output = np.zeros((data.shape[0], ntraces, ntheta,
+    output = np.zeros((nsamps - pad, ntraces, ntheta,
                        n_wavelets))
 
-    # Loop through each combination of wavelet, trace, and theta
-    for iters in product(range(np.size(traces)),
-                         range(ntheta), range(n_wavelets)):
-
-        output[:, iters[0],
-               iters[1], iters[2]] = scipy.signal\
-            .fftconvolve(data[:, traces[iters[0]],
-                              iters[1]].flatten(),
-                         wavelets[:, iters[2]].flatten(),
-                         mode='same')
-    return output[pad:, :, :, :]
+    for i in range(0, ntraces, chunk_size):
+
+        chunk = traces[i:i + chunk_size]
+        block = np.fft.rfft(data[:, chunk, :ntheta], n=nfft, axis=0)
+
+        conv = np.fft.irfft(block[..., np.newaxis] * spectra,
+                            n=nfft, axis=0)
+
+        output[:, i:i + chunk_size, :, :] = \
+            conv[start + pad:start + nsamps, ...]
+
+    return output
+
+
+class InterfaceModel(object):
+    """
+    A labelled earth model that keeps its reflectivity and synthetics
+    up to date as the rock properties change.
+
+    When the properties are updated, only the pairs involving an
+    edited rock are evaluated again. Since the convolution is linear,
+    the cached synthetics are corrected by convolving the change in
+    those coefficients alone.
+
+    :param labels: An integer array of rock labels, indexed as
+                   [sample, trace].
+    :param properties: A record array of vp, vs, rho indexed by label.
+
+    :keyword theta: A single angle or an array of angles [deg].
+    :keyword reflectivity_method: The reflectivity algorithm to use.
+                                  See bruges.reflection for methods.
+    :keyword size: The number of wavelet banks to keep synthetics
+                   for.
+    """
+
+    def __init__(self, labels, properties, theta=0,
+                 reflectivity_method=reflection.zoeppritz, size=2):
+
+        self.theta = theta
+        self.reflectivity_method = reflectivity_method
+        self.size = size
+
+        self.properties = properties.copy()
+        self.reflectivity = SparseReflectivity.from_labels(
+            labels, self.properties, theta=theta,
+            reflectivity_method=reflectivity_method)
+
+        self._lock = threading.Lock()
+        self._synthetics = OrderedDict()
+
+        self.pair_updates = 0
+        self.delta_convolutions = 0
+
+    def changed_rocks(self, properties):
+        """
+        Returns the labels whose properties differ from the current
+        ones.
+        """
+
+        changed = np.zeros(len(self.properties), dtype=bool)
+
+        for name in ('vp', 'vs', 'rho'):
+            old = self.properties[name]
+            new = properties[name]
+            changed |= ~((old == new) | (np.isnan(old) & np.isnan(new)))
+
+        return np.nonzero(changed)[0]
+
+    def update(self, properties):
+        """
+        Sets new rock properties, patching the reflectivity and any
+        cached synthetics.
+
+        :param properties: A record array of vp, vs, rho indexed by
+                           label, for the same labels as before.
+
+        :returns: the rows of the coefficient table that changed.
+        """
+
+        with self._lock:
+            return self._update(properties)
+
+    def _update(self, properties):
+
+        rocks = self.changed_rocks(properties)
+        self.properties = properties.copy()
+
+        if rocks.size == 0:
+            return rocks
+
+        reflectivity = self.reflectivity
+        affected = np.nonzero(
+            np.isin(reflectivity.pairs, rocks).any(axis=1))[0]
+
+        coefficients = pair_reflectivity(
+            self.properties, reflectivity.pairs[affected],
+            theta=self.theta, method=self.reflectivity_method)
+
+        delta = coefficients - reflectivity.coefficients[affected]
+        self.reflectivity = reflectivity.patch(affected, coefficients)
+        self.pair_updates += affected.size
+
+        moved = np.any(delta != 0, axis=1)
+        if self._synthetics and np.any(moved):
+            change = reflectivity.select(affected[moved], delta[moved])
+            for wavelets, synthetic in self._synthetics.values():
+                synthetic += sparse_convolve(wavelets, change)
+                self.delta_convolutions += 1
+
+        return affected
+
+    def model(self, properties, wavelets):
+        """
+        Get the reflectivity and synthetic seismic for a set of rock
+        properties.
+
+        :param properties: A record array of vp, vs, rho indexed by
+                           label.
+        :param wavelets: An array of wavelets indexed as
+                         [samples, wavelet], or a single wavelet.
+                         Banks from modelr.wavelets are matched by
+                         identity.
+
+        :returns: a tuple of (reflectivity, synthetic). reflectivity
+                  is a SparseReflectivity and the synthetic is
+                  indexed as [samples, traces, theta, wavelet].
+        """
+
+        with self._lock:
+            self._update(properties)
+
+            key = id(wavelets)
+            cached = self._synthetics.get(key)
+
+            if cached is None or cached[0] is not wavelets:
+                cached = (wavelets,
+                          sparse_convolve(wavelets, self.reflectivity))
+                self._synthetics[key] = cached
+                while len(self._synthetics) > self.size:
+                    self._synthetics.popitem(last=False)
+            else:
+                self._synthetics.move_to_end(key)
+
+            return self.reflectivity, cached[1].copy()
+
+
+class InterfaceCache(object):
+    """
+    Keeps an InterfaceModel for each of the last few earth model
+    images, so changing the rocks mapped onto an image only updates
+    the interfaces of the edited rocks.
+
+    :keyword size: The number of images to keep.
+    """
+
+    def __init__(self, size=8):
+
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data, colourmap, theta=0,
+            reflectivity_method=reflection.zoeppritz):
+        """
+        Get the InterfaceModel for an image of an earth model. See
+        get_reflectivity for the parameters.
+
+        :returns: a tuple of (model, properties), where properties
+                  holds the rocks of the colourmap for each label of
+                  the model. Pass them to InterfaceModel.model.
+        """
+
+        data = np.ascontiguousarray(data)
+        key = (hashlib.sha1(data.tobytes()).hexdigest(), data.shape,
+               tuple(np.atleast_1d(theta).astype(float).tolist()),
+               np.ndim(theta), reflectivity_method)
+
+        with self._lock:
+            cached = self._models.get(key)
+            if cached is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if cached is not None:
+            colours, model = cached
+            return model, colour_properties(colours, colourmap)
+
+        labels, colours = label_colours(data)
+        properties = colour_properties(colours, colourmap)
+        model = InterfaceModel(labels, properties, theta=theta,
+                               reflectivity_method=reflectivity_method)
+
+        with self._lock:
+            self._models[key] = (colours, model)
+            while len(self._models) > self.size:
+                self._models.popitem(last=False)
+
+        return model, properties
+
+    def clear(self):
+        """
+        Drop all the models and reset the counters.
+        """
+
+        with self._lock:
+            self._models.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache counters.
+        """
+
+        with self._lock:
+            models = [model for _, model in self._models.values()]
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(models),
+                    "pair_updates": sum(m.pair_updates
+                                        for m in models),
+                    "delta_convolutions": sum(m.delta_convolutions
+                                              for m in models)}
+
+
+interface_cache = InterfaceCache()
@@ -0,0 +1,223 @@
+'''
+==============
+modelr.stats
+==============
+
+Summary statistics accumulated a batch at a time, so large numbers of
+realizations can be summarized without keeping them all.
+'''
+
+import numpy as np
+
+
+class StreamingStats(object):
+    '''
+    Running mean, standard deviation, extremes and percentiles of
+    arrays added in batches.
+
+    The mean and variance are exact, merged batch by batch. The
+    percentiles come from a histogram per element whose range is set
+    from the spread of the first batch, and are interpolated within a
+    bin, so they are accurate to about a bin width. Values outside
+    the range are counted in the end bins and the results are clipped
+    to the exact extremes.
+
+    Stats of parts of the samples can be merged. The parts must share
+    a histogram grid, so either give a range or start each part from
+    empty() of one that has seen a batch.
+
+    :param shape: The shape of one sample, e.g. [time, trace].
+    :keyword percentiles: The percentiles to report.
+    :keyword bins: The number of histogram bins per element.
+    :keyword range: Optional (low, high) histogram bounds for every
+                    element, instead of estimating them.
+    '''
+
+    def __init__(self, shape, percentiles=(10, 50, 90), bins=32,
+                 range=None):
+
+        self.shape = tuple(shape)
+        self.percentiles = tuple(percentiles)
+        self.bins = bins
+        self.range = range
+
+        self.count = 0
+        self._mean = np.zeros(self.shape)
+        self._m2 = np.zeros(self.shape)
+        self.min = np.full(self.shape, np.inf)
+        self.max = np.full(self.shape, -np.inf)
+
+        self._low = None
+        self._width = None
+        self._counts = None
+
+    def _set_range(self, batch):
+
+        if self.range is not None:
+            low = np.full(self.shape, float(self.range[0]))
+            high = np.full(self.shape, float(self.range[1]))
+        else:
+            # Leave room for later batches either side of the first
+            low = np.amin(batch, axis=0)
+            high = np.amax(batch, axis=0)
+            span = high - low
+            span[span == 0] = np.maximum(np.abs(low[span == 0]), 1.0)
+            low = low - span
+            high = high + span
+
+        self._low = low
+        self._width = (high - low) / self.bins
+        self._counts = np.zeros(self.shape + (self.bins,),
+                                dtype=np.uint32)
+
+    def add(self, batch):
+        '''
+        Add a batch of samples.
+
+        :param batch: An array indexed as [sample, ...] with the
+                      remaining axes matching shape. A single sample
+                      may be passed without the leading axis.
+        '''
+
+        batch = np.asarray(batch, dtype=float)
+        if batch.shape == self.shape:
+            batch = batch[np.newaxis]
+
+        n = batch.shape[0]
+        if n == 0:
+            return
+
+        mean = np.mean(batch, axis=0)
+        m2 = np.sum((batch - mean)**2, axis=0)
+        self._combine(n, mean, m2, np.amin(batch, axis=0),
+                      np.amax(batch, axis=0))
+
+        if self._counts is None:
+            self._set_range(batch)
+
+        index = np.floor((batch - self._low) / self._width)
+        index = np.clip(index, 0, self.bins - 1).astype(np.intp)
+
+        flat = (np.arange(self._mean.size).reshape(self.shape) *
+                self.bins + index)
+        self._counts += np.bincount(
+            flat.ravel(), minlength=self._counts.size)\
+            .reshape(self._counts.shape).astype(np.uint32)
+
+    def _combine(self, n, mean, m2, low, high):
+
+        # Combine a batch mean and variance with the running ones
+        total = self.count + n
+        delta = mean - self._mean
+        self._mean += delta * (n / float(total))
+        self._m2 += m2 + delta**2 * (self.count * n / float(total))
+        self.count = total
+
+        np.minimum(self.min, low, out=self.min)
+        np.maximum(self.max, high, out=self.max)
+
+    def empty(self):
+        '''
+        Returns empty stats with the same histogram grid, to collect
+        a part of the samples and merge back.
+        '''
+
+        part = StreamingStats(self.shape, self.percentiles, self.bins,
+                              self.range)
+
+        if self._counts is not None:
+            part._low = self._low
+            part._width = self._width
+            part._counts = np.zeros_like(self._counts)
+
+        return part
+
+    def merge(self, other):
+        '''
+        Add the samples summarized by other. Merging the stats of
+        consecutive batches gives exactly the stats of adding the
+        batches in turn.
+
+        :param other: A StreamingStats on the same histogram grid.
+
+        :returns: self.
+        '''
+
+        if other.count == 0:
+            return self
+
+        if other.shape != self.shape or other.bins != self.bins:
+            raise ValueError('stats have different shapes or bins')
+
+        if self._counts is None:
+            self._low = other._low
+            self._width = other._width
+            self._counts = np.zeros_like(other._counts)
+
+        elif not (np.array_equal(self._low, other._low) and
+                  np.array_equal(self._width, other._width)):
+            raise ValueError('stats have different histogram ranges')
+
+        self._combine(other.count, other._mean, other._m2, other.min,
+                      other.max)
+        self._counts += other._counts
+
+        return self
+
+    @property
+    def mean(self):
+
+        return self._mean.copy()
+
+    @property
+    def std(self):
+
+        if self.count == 0:
+            return np.full(self.shape, np.nan)
+
+        return np.sqrt(self._m2 / self.count)
+
+    def percentile(self, q):
+        '''
+        Returns the estimated q-th percentile of every element.
+        '''
+
+        if self.count == 0:
+            return np.full(self.shape, np.nan)
+
+        cumulative = np.cumsum(self._counts, axis=-1)
+        target = q / 100.0 * self.count
+
+        # The bin holding the target and the count before it
+        index = np.sum(cumulative < target, axis=-1)
+        index = np.minimum(index, self.bins - 1)
+        upto = np.take_along_axis(cumulative, index[..., np.newaxis],
+                                  axis=-1)[..., 0]
+        inside = np.take_along_axis(self._counts, index[..., np.newaxis],
+                                    axis=-1)[..., 0]
+        before = upto - inside
+
+        fraction = np.where(inside > 0,
+                            (target - before) / np.maximum(inside, 1),
+                            0.5)
+
+        value = self._low + (index + fraction) * self._width
+
+        return np.clip(value, self.min, self.max)
+
+    def summary(self):
+        '''
+        Returns a dict of the count, mean, std, min, max and each
+        percentile, named as p10, p50 and so on.
+        '''
+
+        result = {"count": self.count,
+                  "mean": self.mean,
+                  "std": self.std,
+                  "min": self.min.copy(),
+                  "max": self.max.copy()}
+
+        for q in self.percentiles:
+            result["p%g" % q] = self.percentile(q)
+
+        return result
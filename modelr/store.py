@@ -0,0 +1,497 @@
+'''
+==============
+modelr.store
+==============
+
+An HDF5 file holding the property grids and reflectivities of a model
+side by side, chunked and compressed so single angles, traces or
+windows can be read without loading the whole cube, and the directory
+those files are kept in.
+'''
+
+import contextlib
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from os.path import basename, join
+
+import h5py
+import numpy as np
+
+# Datasets are indexed as [sample, trace, theta]. A chunk holds a
+# window of samples for a few traces at one angle.
+CHUNK_SAMPLES = 256
+CHUNK_TRACES = 32
+
+# Files being written, skipped by the cache directory
+TEMP_PREFIX = '.tmp-'
+
+# Sidecar of each model file that writers lock
+LOCK_SUFFIX = '.lock'
+
+
+def chunk_shape(shape):
+    '''
+    Returns the chunk shape used for a dataset.
+
+    :param shape: The shape of the dataset, [sample, trace, ...].
+    '''
+
+    chunks = [max(1, min(shape[0], CHUNK_SAMPLES))]
+    if len(shape) > 1:
+        chunks.append(max(1, min(shape[1], CHUNK_TRACES)))
+    chunks += [1] * (len(shape) - 2)
+
+    return tuple(chunks)
+
+
+@contextlib.contextmanager
+def _write_lock(path):
+    '''
+    Holds an exclusive lock on the sidecar of a file. Each call opens
+    the sidecar itself, so it excludes other threads as well as other
+    processes.
+    '''
+
+    with open(path + LOCK_SUFFIX, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _selection(index):
+
+    if index is None:
+        return slice(None), None
+
+    if isinstance(index, slice) or np.ndim(index) == 0:
+        return index, None
+
+    # h5py wants increasing, unique indexes
+    index = np.asarray(index)
+    unique, inverse = np.unique(index, return_inverse=True)
+
+    return unique.tolist(), inverse
+
+
+class ModelStore(object):
+    '''
+    Reads and writes the fields of a model (vp, vs, rho, rpp, rpp_t,
+    ...) in one HDF5 file.
+
+    Writing a field replaces only that dataset, the others are kept.
+    Datasets are chunked along trace and theta and compressed.
+
+    A file is never changed once it is in place. Each write builds a
+    new file under a temporary name, with the other fields copied
+    across, and renames it over the old one, so readers in any thread
+    or process only ever see complete files and replaced fields don't
+    leave dead space behind. Writers hold an exclusive lock on a
+    sidecar of the file, so they never lose each other's fields. A
+    file that can't be read is a miss, and the next write starts it
+    again.
+
+    :param path: The HDF5 file. It is created on the first write.
+    :keyword compression: The h5py compression filter.
+    :keyword compression_opts: Options for the filter.
+    :keyword cache: A CacheDirectory to report reads and writes to.
+    '''
+
+    def __init__(self, path, compression='gzip', compression_opts=4,
+                 cache=None):
+
+        self.path = path
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.cache = cache
+
+    def _open(self, mode):
+
+        return h5py.File(self.path, mode)
+
+    def __contains__(self, name):
+
+        return name in self.fields()
+
+    def fields(self):
+        '''
+        Returns the names of the stored fields.
+        '''
+
+        try:
+            with self._open('r') as f:
+                return list(f.keys())
+        except (IOError, OSError):
+            return []
+
+    def attrs(self, name):
+        '''
+        Returns the attributes stored with a field as a dict.
+        '''
+
+        with self._open('r') as f:
+            return dict(f[name].attrs)
+
+    def write(self, name, data, **attrs):
+        '''
+        Store a field, replacing any earlier one of the same name.
+
+        :param name: The field name.
+        :param data: An array indexed as [sample, trace, ...].
+        :keyword attrs: Attributes to keep with the field, such as the
+                        angles or sample interval.
+        '''
+
+        data = np.asarray(data)
+        directory = os.path.dirname(os.path.abspath(self.path))
+
+        with _write_lock(self.path):
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+            os.close(fd)
+
+            try:
+                with h5py.File(tmp, 'w') as f:
+                    self._copy(f, skip=name)
+                    self._create(f, name, data, attrs)
+                os.replace(tmp, self.path)
+
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+        if self.cache is not None:
+            self.cache.evict(keep=self.path)
+
+    def _copy(self, f, skip):
+
+        # Whatever can still be read from the old file is kept
+        try:
+            with self._open('r') as old:
+                for key in old:
+                    if key == skip:
+                        continue
+                    try:
+                        old.copy(old[key], f)
+                    except (IOError, OSError, KeyError):
+                        if key in f:
+                            del f[key]
+        except (IOError, OSError):
+            pass
+
+    def _create(self, f, name, data, attrs):
+
+        if data.ndim:
+            dataset = f.create_dataset(
+                name, data=data,
+                chunks=chunk_shape(data.shape),
+                compression=self.compression,
+                compression_opts=self.compression_opts,
+                shuffle=True)
+        else:
+            dataset = f.create_dataset(name, data=data)
+
+        for key, value in attrs.items():
+            dataset.attrs[key] = value
+
+    def read(self, name, samples=None, traces=None, theta=None):
+        '''
+        Read all or part of a field. Only the chunks touching the
+        selection are read from disk.
+
+        :param name: The field name.
+        :keyword samples: An index, slice or list of sample indexes.
+        :keyword traces: An index, slice or list of trace indexes.
+        :keyword theta: An index, slice or list of angle indexes.
+                        Ignored for fields without an angle axis.
+
+        :returns: the selected part of the field. Integer indexes
+                  drop their axis, as with numpy.
+        '''
+
+        if self.cache is not None:
+            self.cache.touch(self.path)
+
+        with self._open('r') as f:
+            dataset = f[name]
+
+            indexes = [samples, traces, theta][:dataset.ndim]
+            selection = [_selection(i) for i in indexes]
+
+            # h5py takes one list per read, the rest are done here
+            lists = [axis for axis, (sel, _) in enumerate(selection)
+                     if isinstance(sel, list)]
+            slab = tuple(slice(None) if axis in lists[1:] else sel
+                         for axis, (sel, _) in enumerate(selection))
+
+            data = dataset[slab] if slab else dataset[()]
+
+        # Put the list axes back in the order asked for
+        axis = 0
+        for i, (sel, inverse) in enumerate(selection):
+
+            if i in lists[1:]:
+                data = np.take(data, sel, axis=axis)
+            if inverse is not None:
+                data = np.take(data, inverse, axis=axis)
+
+            if isinstance(sel, slice) or isinstance(sel, list):
+                axis += 1
+
+        return data
+
+    def get(self, name, compute, **attrs):
+        '''
+        Read a field, computing and storing it first if it is missing,
+        can't be read or was stored with different attributes.
+
+        :param name: The field name.
+        :param compute: Called with no arguments to make the field.
+        :keyword attrs: Attributes the stored field must match.
+        '''
+
+        try:
+            stored = self.attrs(name)
+            if all(np.array_equal(stored.get(key), value)
+                   for key, value in attrs.items()):
+                return self.read(name)
+        except (IOError, OSError, KeyError):
+            # Missing, or the file can't be read
+            pass
+
+        data = compute()
+
+        try:
+            self.write(name, data, **attrs)
+        except (IOError, OSError):
+            # The store is only a cache, so carry on without it if
+            # the disk is full or read only
+            pass
+
+        return data
+
+
+class CacheDirectory(object):
+    '''
+    A directory of model files bounded by size and age.
+
+    Recency is kept in the access time of each file, set explicitly
+    when it is used, so every process sharing the directory sees the
+    same order and the modification times are left alone. Once the
+    files take more than max_bytes the least recently used are
+    removed, and files unused for longer than ttl are removed
+    regardless.
+
+    :param directory: The directory to keep the files in. It is
+                      created if needed.
+    :keyword max_bytes: Size limit of the directory.
+    :keyword ttl: Time to keep unused files [s], or None to keep them
+                  until space is needed.
+    '''
+
+    def __init__(self, directory, max_bytes=2 * 2**30, ttl=None):
+
+        self._lock = threading.Lock()
+        self.configure(directory, max_bytes=max_bytes, ttl=ttl)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    @classmethod
+    def from_environ(cls):
+        '''
+        Makes the cache from MODELR_MODEL_CACHE (directory),
+        MODELR_MODEL_CACHE_SIZE [MB] and MODELR_MODEL_CACHE_TTL [s],
+        so worker processes use the same settings as the server.
+        '''
+
+        directory = os.environ.get('MODELR_MODEL_CACHE',
+                                   join(tempfile.gettempdir(),
+                                        'modelr-models'))
+        size = float(os.environ.get('MODELR_MODEL_CACHE_SIZE', 2048))
+        ttl = os.environ.get('MODELR_MODEL_CACHE_TTL')
+
+        return cls(directory, max_bytes=int(size * 2**20),
+                   ttl=float(ttl) if ttl else None)
+
+    def configure(self, directory, max_bytes=2 * 2**30, ttl=None):
+        '''
+        Change the directory and limits.
+        '''
+
+        with self._lock:
+            self.directory = directory
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+
+    def path(self, name):
+        '''
+        Returns the path of a file in the cache, marking it as used.
+        Only the base name is kept, so names from clients cannot
+        point outside the directory.
+        '''
+
+        name = basename(str(name))
+        if (not name or name.startswith(TEMP_PREFIX) or
+                name.endswith(LOCK_SUFFIX)):
+            raise ValueError('bad cache file name: %r' % name)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        path = join(self.directory, name)
+
+        hit = self.touch(path)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return path
+
+    def touch(self, path):
+        '''
+        Mark a file as used. Returns False if it doesn't exist.
+        '''
+
+        try:
+            stat = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    def remove(self, name):
+        '''
+        Remove a file from the cache if it is there.
+        '''
+
+        self._unlink(join(self.directory, basename(str(name))))
+
+    def _entries(self):
+
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except (IOError, OSError):
+            return entries
+
+        for name in names:
+            path = join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except (IOError, OSError):
+                continue
+
+            entries.append((name, path, stat))
+
+        return entries
+
+    def evict(self, keep=None):
+        '''
+        Remove expired files, then the least recently used ones until
+        the directory fits in max_bytes.
+
+        :keyword keep: A path that must not be removed, such as the
+                       file just written.
+        '''
+
+        now = time.time()
+        files = []
+
+        for name, path, stat in self._entries():
+
+            used = max(stat.st_atime, stat.st_mtime)
+
+            # Writes that were abandoned by a crashed process
+            if name.startswith(TEMP_PREFIX):
+                if now - stat.st_mtime > 3600:
+                    self._unlink(path)
+                continue
+
+            # Lock sidecars go with their file
+            if name.endswith(LOCK_SUFFIX):
+                if (now - stat.st_mtime > 3600 and
+                        not os.path.exists(path[:-len(LOCK_SUFFIX)])):
+                    self._unlink(path)
+                continue
+
+            if (self.ttl is not None and now - used > self.ttl and
+                    path != keep):
+                if self._unlink(path):
+                    with self._lock:
+                        self.expired += 1
+                continue
+
+            files.append((used, stat.st_size, path))
+
+        files.sort()
+        nbytes = sum(size for _, size, _ in files)
+
+        for _, size, path in files:
+            if nbytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+
+            if self._unlink(path):
+                nbytes -= size
+                with self._lock:
+                    self.evictions += 1
+
+    @staticmethod
+    def _unlink(path):
+
+        try:
+            os.remove(path)
+        except (IOError, OSError):
+            return False
+
+        # A writer still holding the old sidecar can at worst lose a
+        # field to a concurrent write, the files stay whole
+        try:
+            os.remove(path + LOCK_SUFFIX)
+        except (IOError, OSError):
+            pass
+
+        return True
+
+    def clear(self):
+        '''
+        Reset the counters. The files are left alone.
+        '''
+
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expired = 0
+
+    def stats(self):
+        '''
+        Returns a dictionary of the cache counters and the size of the
+        directory. The counters are for this process only.
+        '''
+
+        entries = [stat for name, _, stat in self._entries()
+                   if not (name.startswith(TEMP_PREFIX) or
+                           name.endswith(LOCK_SUFFIX))]
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expired": self.expired,
+                    "size": len(entries),
+                    "bytes": sum(stat.st_size for stat in entries)}
+
+
+model_cache = CacheDirectory.from_environ()
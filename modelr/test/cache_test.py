@@ -0,0 +1,204 @@
+import unittest
+import os
+import shutil
+import tempfile
+from argparse import Namespace
+
+import numpy as np
+
+from modelr.web.cache import ScriptCache, ScriptRegistry, \
+    ResultCache, result_key, script_version
+from modelr.rock_properties import RockProperties
+
+
+class ScriptCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'script.py')
+
+        with open(self.script, 'w') as f:
+            f.write("short_description = 'first'\n")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+
+        cache = ScriptCache()
+
+        namespace = cache.load(self.script)
+        self.assertEqual(namespace['short_description'], 'first')
+
+        # Second load comes from the cache
+        self.assertTrue(cache.load(self.script) is namespace)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1,
+                                         "size": 1})
+
+    def test_reload(self):
+
+        cache = ScriptCache()
+        cache.load(self.script)
+
+        with open(self.script, 'w') as f:
+            f.write("short_description = 'second'\n")
+
+        # Make sure the modification time changes
+        mtime = os.stat(self.script).st_mtime
+        os.utime(self.script, (mtime + 10, mtime + 10))
+
+        namespace = cache.load(self.script)
+        self.assertEqual(namespace['short_description'], 'second')
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 2,
+                                         "size": 1})
+
+
+class ScriptRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.scripts = os.path.join(self.tmpdir, 'scenario')
+        os.mkdir(self.scripts)
+
+        with open(os.path.join(self.scripts, 'one.py'), 'w') as f:
+            f.write("short_description = ('Wrapped ' +\n"
+                    "                     'description')\n"
+                    "raise RuntimeError('should not run')\n")
+
+        with open(os.path.join(self.scripts, '__init__.py'), 'w') as f:
+            f.write("")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def test_available(self):
+
+        registry = ScriptRegistry(self.tmpdir, ScriptCache())
+
+        scripts = registry.available('scenario')
+        self.assertEqual(scripts, [('one.py', 'Wrapped description')])
+
+        registry.available('scenario')
+        self.assertEqual(registry.hits, 1)
+        self.assertEqual(registry.misses, 1)
+        self.assertEqual(registry.cache.stats()["misses"], 0)
+
+        # Adding a script changes the directory and the listing
+        with open(os.path.join(self.scripts, 'two.py'), 'w') as f:
+            f.write("short_description = 'Two'.upper()\n")
+        mtime = os.stat(self.scripts).st_mtime
+        os.utime(self.scripts, (mtime + 10, mtime + 10))
+
+        scripts = registry.available('scenario')
+        self.assertEqual(sorted(scripts),
+                         [('one.py', 'Wrapped description'),
+                          ('two.py', 'TWO')])
+
+    def test_schema(self):
+
+        with open(os.path.join(self.scripts, 'args.py'), 'w') as f:
+            f.write("short_description = 'Args'\n"
+                    "def add_arguments(parser):\n"
+                    "    parser.add_argument('f', type=float, default=25)\n")
+
+        registry = ScriptRegistry(self.tmpdir, ScriptCache())
+        script_path = os.path.join(self.scripts, 'args.py')
+
+        schema = registry.schema(script_path)
+        self.assertTrue(registry.schema(script_path) is schema)
+        self.assertTrue('"name": "f"' in schema)
+        self.assertEqual(registry.hits, 1)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def test_result_key(self):
+
+        def args(vp):
+            return Namespace(f=25.0, wavelet=np.sinc,
+                             rock=RockProperties(vp=vp, vs=1200.,
+                                                 rho=2400.),
+                             theta=np.arange(3))
+
+        self.assertEqual(result_key('plot', args(2400.)),
+                         result_key('plot', args(2400.)))
+        self.assertNotEqual(result_key('plot', args(2400.)),
+                            result_key('plot', args(2500.)))
+
+        # Editing the script changes its version
+        script = os.path.join(self.tmpdir, 'script.py')
+        with open(script, 'w') as f:
+            f.write("x = 1\n")
+        version = script_version(script)
+        with open(script, 'w') as f:
+            f.write("x = 10\n")
+        self.assertNotEqual(script_version(script), version)
+        self.assertEqual(script_version(script + 'c'), None)
+
+    def test_lru(self):
+
+        cache = ResultCache(max_bytes=250)
+
+        cache.put('a', b'a' * 100, {"f": [1, 2]})
+        cache.put('b', b'b' * 100, {})
+        self.assertEqual(cache.get('a'), (b'a' * 100, {"f": [1, 2]}))
+
+        # 'b' is the least recently used
+        cache.put('c', b'c' * 100, {})
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a')[0], b'a' * 100)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"],
+                          stats["evictions"], stats["size"]),
+                         (2, 1, 1, 2))
+        self.assertTrue(stats["bytes"] <= 250)
+
+    def test_disk(self):
+
+        directory = os.path.join(self.tmpdir, 'results')
+        ResultCache(directory=directory).put('a', b'png', {"x": 1})
+
+        cache = ResultCache(directory=directory)
+        self.assertEqual(cache.get('a'), (b'png', {"x": 1}))
+        self.assertEqual(cache.get('a'), (b'png', {"x": 1}))
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_disk_budget(self):
+
+        directory = os.path.join(self.tmpdir, 'results')
+        cache = ResultCache(max_bytes=10**6, directory=directory,
+                            disk_bytes=2500)
+
+        for key in 'abcde':
+            cache.put(key, key.encode() * 1000, {})
+
+        # Only the newest results fit on disk
+        disk = cache.stats()["disk"]
+        self.assertEqual(disk["size"], 2)
+        self.assertEqual(disk["evictions"], 3)
+        self.assertTrue(disk["bytes"] <= 2500)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['d.result', 'e.result'])
+
+
+if __name__ == '__main__':
+
+    suite = unittest.TestSuite(
+        [unittest.TestLoader().loadTestsFromTestCase(ScriptCacheTest),
+         unittest.TestLoader().loadTestsFromTestCase(ScriptRegistryTest),
+         unittest.TestLoader().loadTestsFromTestCase(ResultCacheTest)])
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,108 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+from bruges.filters import ricker
+
+from modelr.api import ImageModel, ImageModelPersist, Rock
+
+
+class ImageModelTest(unittest.TestCase):
+
+    mapping = {"rgb(150,100,100)": Rock(2000, 1000, 2100, vp_std=50),
+               "rgb(100,150,100)": Rock(2600, 1300, 2300, rho_std=10)}
+
+    def make_image(self):
+
+        data = np.zeros((200, 30, 3), dtype=np.uint8)
+        data[:, :, :] = (150, 100, 100)
+        data[100:, :, :] = (100, 150, 100)
+
+        return Image.fromarray(data).convert('P',
+                                             palette=Image.ADAPTIVE,
+                                             colors=2)
+
+    def make_model(self, seed=None):
+
+        return ImageModel(self.make_image(), self.mapping, seed=seed)
+
+    def test_realization(self):
+
+        model = self.make_model(seed=42)
+
+        # The grids are drawn once and shared
+        self.assertTrue(model.vp is model.vp)
+        self.assertFalse(model.vp.flags.writeable)
+
+        self.assertAlmostEqual(np.mean(model.vp[:100]), 2000, delta=10)
+        self.assertAlmostEqual(np.std(model.vp[:100]), 50, delta=5)
+        self.assertTrue(np.all(model.vp[100:] == 2600))
+        self.assertTrue(np.all(model.rho[:100] == 2100))
+
+        # The same seed gives the same grids
+        other = self.make_model(seed=42)
+        self.assertTrue(np.array_equal(model.rho, other.rho))
+
+        self.assertFalse(np.array_equal(
+            model.realization(seed=1).vp, model.vp))
+
+    def test_seed(self):
+
+        model = self.make_model()
+        again = model.realization(seed=model.seed)
+
+        self.assertTrue(np.array_equal(model.vp, again.vp))
+
+    def test_ensemble(self):
+
+        model = self.make_model(seed=7)
+        ensemble = model.ensemble(12)
+
+        vp, vs, rho = ensemble.properties()
+        self.assertEqual(vp.shape, (12, 200, 30))
+        self.assertTrue(np.all(vs == model.vs))
+
+        wavelet = ricker(0.1, 0.001, 25.0)[0]
+        summary = ensemble.synthetic_stats(wavelet, 0.001, theta=0.0,
+                                           chunk_size=5)
+        whole = ensemble.synthetic_stats(wavelet, 0.001, theta=0.0,
+                                         chunk_size=12)
+
+        self.assertEqual(summary["count"], 12)
+        self.assertTrue(np.allclose(summary["mean"], whole["mean"]))
+        self.assertTrue(np.all(summary["p10"] <= summary["p90"]))
+        self.assertTrue(np.all(summary["std"] >= 0))
+
+        # Chunks shared between processes give the same statistics,
+        # however many CPUs this machine has
+        with mock.patch('os.cpu_count', return_value=4):
+            pooled = ensemble.synthetic_stats(wavelet, 0.001, theta=0.0,
+                                              chunk_size=5, workers=2)
+        for name, value in summary.items():
+            self.assertTrue(np.array_equal(pooled[name], value))
+
+        # Models kept in a store go to the pool the same way
+        tmpdir = tempfile.mkdtemp()
+        try:
+            persist = ImageModelPersist(os.path.join(tmpdir, 'model.h5'),
+                                        self.make_image(), self.mapping,
+                                        seed=7)
+            persist.vp
+            with mock.patch('os.cpu_count', return_value=4):
+                stored = persist.ensemble(12).synthetic_stats(
+                    wavelet, 0.001, theta=0.0, chunk_size=5, workers=2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        for name, value in summary.items():
+            self.assertTrue(np.array_equal(stored[name], value))
+
+
+if __name__ == '__main__':
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(ImageModelTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
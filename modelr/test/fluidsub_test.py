@@ -0,0 +1,117 @@
+import unittest
+
+import numpy as np
+from bruges.rockphysics import smith_fluidsub
+
+from modelr.api import Rock, Fluid, FluidSub1D
+from modelr.web.scripts.seismic.fluid_sub import run_script
+
+
+class FluidSub1DTest(unittest.TestCase):
+
+    brine = Fluid(1000., 800., 2.5e9, 1.0e9, 1.0)
+    gas = Fluid(1000., 200., 2.5e9, 0.05e9, 0.2)
+
+    shale = Rock(2400., 1000., 2300., porosity=.05, vclay=.8,
+                 kclay=2.1e10, kqtz=3.7e10)
+    sand = Rock(2800., 1500., 2200., porosity=.25, vclay=.1,
+                kclay=2.5e10, kqtz=3.6e10, fluid=brine, vp_std=10.)
+
+    def make_model(self):
+
+        return FluidSub1D(
+            [{"rock": self.shale, "thickness": 50., "subfluids": []},
+             {"rock": self.sand, "thickness": 30.5,
+              "subfluids": [{"fluid": self.gas, "thickness": 20.}]},
+             {"rock": self.shale, "thickness": 40., "subfluids": []}],
+            1.0)
+
+    def test_layers(self):
+
+        model = self.make_model()
+
+        self.assertEqual(model.vp.shape, (120,))
+        self.assertEqual(model.vp.dtype, np.float32)
+
+        # Layers take whole samples, the last is cut at the bottom
+        self.assertTrue(np.all(model.vs[:50] == 1000.))
+        self.assertTrue(np.all(model.vs[50:81] == 1500.))
+        self.assertTrue(np.all(model.vs[81:] == 1000.))
+
+        # Mineral moduli belong to each layer
+        self.assertTrue(np.all(model.Kclay[50:81] == np.float32(2.5e10)))
+        self.assertTrue(np.all(model.Kclay[81:] == np.float32(2.1e10)))
+
+        self.assertTrue(np.all(model.Sw[50:81] == 1.0))
+        self.assertTrue(np.all(model.Sw_sub[50:70] == np.float32(0.2)))
+        self.assertTrue(np.array_equal(np.flatnonzero(model.substituted),
+                                       np.arange(50, 70)))
+
+    def test_substitute(self):
+
+        model = self.make_model()
+        saturations = [0.1, 0.6, 1.0]
+
+        vp, vs, rho = model.substitute(Sw=saturations,
+                                       fluids=[self.gas, self.brine])
+        self.assertEqual(vp.shape, (6, 120))
+
+        # Scenario 4 is brine at Sw=0.6, one scenario at a time
+        expected = smith_fluidsub(
+            model.vp, model.vs, model.rho, model.phi, model.rhow,
+            model.rhohc, model.Sw, np.float32(0.6), model.Kw,
+            model.Khc, model.Kclay, model.Kqtz, vclay=model.vclay,
+            rhownew=np.float32(1000.), rhohcnew=np.float32(800.),
+            kwnew=np.float32(2.5e9), khcnew=np.float32(1.0e9))
+
+        self.assertTrue(np.allclose(vp[4, 50:70], expected[0][50:70]))
+        self.assertTrue(np.allclose(rho[4, 50:70], expected[2][50:70]))
+
+        # Samples without a substitution fluid are unchanged
+        self.assertTrue(np.array_equal(vp[:, 70:], model.vp[70:] +
+                                       np.zeros((6, 1), np.float32)))
+
+        # The single scenario of the model fluids
+        self.assertTrue(np.array_equal(model.smith_sub()[0],
+                                       model.substitute()[0][0]))
+
+    def test_run_script(self):
+
+        brine = {"rho_w": 1000., "rho_hc": 800., "k_w": 2.5e9,
+                 "k_hc": 1.0e9, "sw": 1.0}
+        gas = dict(brine, rho_hc=200., k_hc=0.05e9, sw=0.2)
+        shale = {"vp": 2400., "vs": 1000., "rho": 2300.,
+                 "porosity": .05, "vclay": .8, "kclay": 2.1e10,
+                 "kqtz": 3.7e10}
+        sand = dict(shale, vp=2800., vs=1500., rho=2200.,
+                    porosity=.25, vclay=.1, fluid=brine)
+
+        payload = {"earth_model": {"dz": 1.0, "layers": [
+            {"rock": shale, "thickness": 300., "subfluids": []},
+            {"rock": sand, "thickness": 60.,
+             "subfluids": [{"fluid": gas, "thickness": 40.}]},
+            {"rock": shale, "thickness": 300., "subfluids": []}]},
+            "seismic": {"wavelet": "ricker", "dt": 0.001,
+                        "frequency": 25., "theta": [0, 10, 20]},
+            "sw": [0.2, 0.9]}
+
+        output = run_script(payload)
+
+        # All the cases share one time axis
+        nt = output["rpp"].size
+        self.assertEqual(output["synth"].shape, (3, nt))
+        self.assertEqual(output["synth_sw"].shape, (2, 3, nt))
+        self.assertTrue(np.any(output["rpp_sub"] != output["rpp"]))
+
+        # The gas saturation as a scenario is the substituted case
+        self.assertTrue(np.array_equal(output["vp_sw"][0],
+                                       output["vp_sub"]))
+        self.assertTrue(np.array_equal(output["synth_sw"][0],
+                                       output["synth_sub"]))
+
+
+if __name__ == '__main__':
+
+    suite = \
+        unittest.TestLoader().loadTestsFromTestCase(FluidSub1DTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
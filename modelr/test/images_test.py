@@ -0,0 +1,102 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import numpy as np
+from PIL import Image
+
+from modelr.images import ImageFetcher
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+
+        QuietHandler.requests += 1
+
+
+class ImageFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+
+        data = np.zeros((20, 10, 3), dtype=np.uint8)
+        data[10:, :, :] = (100, 150, 100)
+        Image.fromarray(data).save(os.path.join(self.tmpdir, 'model.png'))
+
+        QuietHandler.requests = 0
+        handler = partial(QuietHandler, directory=self.tmpdir)
+        self.server = HTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%d/model.png' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_fresh(self):
+
+        fetcher = ImageFetcher(max_age=60)
+
+        first = fetcher.array(self.url)
+        second = fetcher.array(self.url)
+
+        self.assertTrue(first is second)
+        self.assertFalse(first.flags.writeable)
+        self.assertEqual(first.shape, (20, 10, 3))
+        self.assertTrue(np.array_equal(first[15, 0], (100, 150, 100)))
+
+        # Only one request was made
+        self.assertEqual(QuietHandler.requests, 1)
+        self.assertEqual(fetcher.stats()["hits"], 1)
+
+    def test_revalidate(self):
+
+        fetcher = ImageFetcher(max_age=0)
+
+        first = fetcher.array(self.url)
+        second = fetcher.array(self.url)
+
+        # The server was asked, but the image wasn't decoded again
+        self.assertTrue(first is second)
+        self.assertEqual(QuietHandler.requests, 2)
+        self.assertEqual(fetcher.stats()["revalidated"], 1)
+
+        # PIL images are copies
+        image = fetcher.open(self.url)
+        image.putpixel((0, 0), (1, 2, 3))
+        self.assertEqual(fetcher.open(self.url).getpixel((0, 0)),
+                         (0, 0, 0))
+
+    def test_version(self):
+
+        fetcher = ImageFetcher(max_age=0)
+        version = fetcher.version(self.url)
+        self.assertEqual(fetcher.version(self.url), version)
+
+        # A new image at the same URL has a new version
+        path = os.path.join(self.tmpdir, 'model.png')
+        Image.fromarray(np.ones((20, 10, 3), dtype=np.uint8)).save(path)
+        later = os.path.getmtime(path) + 10
+        os.utime(path, (later, later))
+
+        self.assertNotEqual(fetcher.version(self.url), version)
+        self.assertEqual(fetcher.open(self.url).getpixel((0, 0)),
+                         (1, 1, 1))
+
+
+if __name__ == '__main__':
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(ImageFetcherTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
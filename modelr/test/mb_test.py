@@ -77,6 +77,41 @@ class ModelBuilderTest( unittest.TestCase ):
                                          l2 ) )
     
        
+    def test_body_raster(self):
+
+        pad = 150
+        t1 = (50, 150)
+        t2 = (150, 250)
+        l1 = (150, 100, 100)
+        l2 = (100, 150, 100)
+        l3 = (100, 100, 150)
+
+        array = mb.body(pad, 0, t1, t2, 300, (l1, l2, l3))
+
+        self.assertTrue(np.array_equal(array[pad + t1[0] - 1, 0], l1))
+        self.assertTrue(np.array_equal(array[pad + t2[0] - 1, -1], l1))
+        self.assertTrue(np.array_equal(array[pad + t1[0], 0], l2))
+        self.assertTrue(np.array_equal(array[pad + t2[1] - 1, -1], l2))
+        self.assertTrue(np.array_equal(array[pad + t1[1], 0], l3))
+        self.assertTrue(np.array_equal(array[pad + t2[1], -1], l3))
+
+        # Only the layer colours, no anti-aliasing
+        labels = mb.body_labels(pad, 0, t1, t2, 300)
+        self.assertEqual(set(np.unique(labels)), set([0, 1, 2]))
+
+    def test_channel_raster(self):
+
+        pad = 150
+        labels = mb.channel_labels(pad, 50, 300)
+
+        self.assertEqual(labels.shape, (425, 300))
+        self.assertEqual(labels[pad - 1, 0], 0)
+        self.assertEqual(labels[pad, 0], 2)
+        self.assertEqual(labels[pad + 1, 150], 1)
+
+        # The ellipse is symmetric about the middle trace
+        self.assertTrue(np.array_equal(labels, labels[:, ::-1]))
+
     def test_web2array( self ):
 
         colours = ((255,0,0),(255,255,255),(0,0,255) )
@@ -0,0 +1,119 @@
+import os
+import unittest
+
+import numpy as np
+from bruges import reflection
+
+from modelr.rock_properties import RockProperties
+from modelr.montecarlo import correlated_normal, avo_monte_carlo, \
+    MonteCarloRunner, shared_pool
+
+
+class MonteCarloTest(unittest.TestCase):
+
+    upper = RockProperties(vp=2900., vs=1600., rho=2600.,
+                           vp_sig=29., vs_sig=16., rho_sig=26.)
+    lower = RockProperties(vp=3200., vs=1900., rho=2500.,
+                           vp_sig=32., vs_sig=19., rho_sig=25.)
+
+    def test_correlated_normal(self):
+
+        vp, vs, rho = correlated_normal(self.upper, 20000, 0.8,
+                                        np.random.default_rng(1))
+
+        self.assertAlmostEqual(np.mean(vp), 2900., delta=1.)
+        self.assertAlmostEqual(np.std(rho), 26., delta=1.)
+        self.assertAlmostEqual(np.corrcoef(vp, vs)[0, 1], 0.8, delta=0.02)
+
+    def test_avo_monte_carlo(self):
+
+        theta = np.arange(0, 90, 5)
+        n = 300
+
+        summary = avo_monte_carlo(self.upper, self.lower, n, theta,
+                                  reflection.zoeppritz,
+                                  rng=np.random.default_rng(3), keep=50)
+
+        # The same draws, one iteration at a time
+        rng = np.random.default_rng(3)
+        vp0, vs0, rho0 = correlated_normal(self.upper, n, 0.8, rng)
+        vp1, vs1, rho1 = correlated_normal(self.lower, n, 0.8, rng)
+        reflect = np.array([np.real(reflection.zoeppritz(
+            vp0[i], vs0[i], rho0[i], vp1[i], vs1[i], rho1[i], theta))
+            for i in range(n)])
+
+        self.assertEqual(summary.count, n)
+        self.assertTrue(np.allclose(summary.curves.mean,
+                                    np.mean(reflect, axis=0)))
+        self.assertTrue(np.allclose(summary.samples, reflect[:50]))
+
+        # Percentiles to within a histogram bin
+        self.assertTrue(np.allclose(summary.curves.percentile(90),
+                                    np.percentile(reflect, 90, axis=0),
+                                    atol=2. / 400))
+
+        critical = np.degrees(np.arcsin(vp0 / vp1)[vp1 > vp0])
+        self.assertAlmostEqual(summary.critical_angle, np.mean(critical))
+
+        # Every draw lands in a property histogram
+        self.assertTrue(np.all(summary.counts.sum(axis=1) == n))
+        density, edges = summary.density(0)
+        self.assertAlmostEqual(np.sum(density * np.diff(edges)), 1.0)
+
+    def test_chunks(self):
+
+        # Memory is bounded by the chunk size, not the iterations
+        summary = avo_monte_carlo(self.upper, self.lower, 5000,
+                                  chunk_size=512,
+                                  rng=np.random.default_rng(5))
+
+        self.assertEqual(summary.count, 5000)
+        self.assertEqual(summary.samples.shape, (200, 90))
+        self.assertEqual(summary.curves.mean.shape, (90,))
+
+    def test_seed(self):
+
+        runs = [avo_monte_carlo(self.upper, self.lower, 3000,
+                                np.arange(0, 90, 10), chunk_size=700,
+                                seed=11, workers=workers)
+                for workers in (1, 1, 2)]
+
+        # Bit-identical with the same seed, in a pool or not
+        for run in runs[1:]:
+            self.assertTrue(np.array_equal(run.curves.mean,
+                                           runs[0].curves.mean))
+            self.assertTrue(np.array_equal(run.curves.percentile(10),
+                                           runs[0].curves.percentile(10)))
+            self.assertTrue(np.array_equal(run.counts, runs[0].counts))
+            self.assertEqual(run.critical_angle, runs[0].critical_angle)
+
+        other = avo_monte_carlo(self.upper, self.lower, 3000,
+                                np.arange(0, 90, 10), chunk_size=700,
+                                seed=12)
+        self.assertFalse(np.array_equal(other.curves.mean,
+                                        runs[0].curves.mean))
+
+    def test_blocks(self):
+
+        blocks = MonteCarloRunner(block_size=400).blocks(1000, seed=1)
+
+        self.assertEqual([size for size, _ in blocks], [400, 400, 200])
+        self.assertEqual(len(set(seed.spawn_key for _, seed in blocks)),
+                         3)
+
+    def test_shared_pool(self):
+
+        # Runs reuse one pool per size instead of starting their own
+        self.assertTrue(shared_pool(2) is shared_pool(2))
+
+        # The worker count is a setting, capped at the CPUs
+        self.assertEqual(MonteCarloRunner().workers, 1)
+        self.assertTrue(MonteCarloRunner(10**6).workers <=
+                        max(1, os.cpu_count()))
+
+
+if __name__ == '__main__':
+
+    suite = \
+        unittest.TestLoader().loadTestsFromTestCase(MonteCarloTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,70 @@
+import unittest
+
+from modelr.pipeline import Pipeline, Stage
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.calls = []
+
+        def stage(name):
+            def func(*inputs, **params):
+                self.calls.append(name)
+                return (name, inputs, sorted(params.items()))
+            return func
+
+        self.pipeline = Pipeline([
+            Stage('image', stage('image'), params=('url',)),
+            Stage('reflectivity', stage('reflectivity'),
+                  inputs=('image',), params=('theta',)),
+            Stage('convolution', stage('convolution'),
+                  inputs=('reflectivity',), params=('f',)),
+            Stage('noise', stage('noise'), inputs=('convolution',),
+                  params=('snr',))])
+
+        self.params = {"url": "model.png", "theta": [0, 10],
+                       "f": 25.0, "snr": 10.0}
+
+    def test_downstream_only(self):
+
+        self.pipeline.run('noise', self.params)
+        self.assertEqual(self.calls, ['image', 'reflectivity',
+                                      'convolution', 'noise'])
+
+        # A wavelet change reuses the reflectivity
+        del self.calls[:]
+        self.pipeline.run('noise', dict(self.params, f=30.0))
+        self.assertEqual(self.calls, ['convolution', 'noise'])
+
+        # Only the noise
+        del self.calls[:]
+        self.pipeline.run('noise', dict(self.params, f=30.0, snr=20.0))
+        self.assertEqual(self.calls, ['noise'])
+
+        # Going back to earlier parameters hits the kept results
+        del self.calls[:]
+        self.pipeline.run('noise', dict(self.params, f=30.0))
+        self.assertEqual(self.calls, [])
+
+        stats = self.pipeline.stats()
+        self.assertEqual(stats["image"]["computed"], 1)
+        self.assertEqual(stats["convolution"]["computed"], 2)
+
+    def test_size(self):
+
+        pipeline = self.pipeline
+        pipeline.size = 1
+
+        pipeline.run('noise', self.params)
+        pipeline.run('noise', dict(self.params, snr=20.0))
+
+        del self.calls[:]
+        pipeline.run('noise', self.params)
+        self.assertEqual(self.calls, ['noise'])
+
+if __name__ == '__main__':
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(PipelineTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
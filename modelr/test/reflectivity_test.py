@@ -3,9 +3,12 @@ from bruges import reflection as avo
 import numpy as np
 from modelr.rock_properties import RockProperties
 from modelr.reflectivity import rock_reflectivity, get_reflectivity, \
-    do_convolve, get_boundaries
+    do_convolve, get_boundaries, label_image, get_interfaces, \
+    reflectivity_array, SparseReflectivity, InterfaceModel
 from bruges.filters import ricker
 
+from scipy.signal import fftconvolve
+
 from svgwrite import rgb
 
 
@@ -76,6 +79,158 @@ class ReflectivityTest(unittest.TestCase):
         self.assertTrue( np.array_equal( test, reflectivity ) )
 
 
+    def test_label_image(self):
+
+        cmap = {rgb(150, 100, 100): self.Rp0, rgb(100, 150, 100): self.Rp1}
+        data = np.zeros((100, 10, 3))
+
+        data[:50, :, :] += [150, 100, 100]
+        data[50:90, :, :] += [100, 150, 100]
+        data[90:, :, :] += [10, 10, 10]
+
+        labels, properties = label_image(data, cmap)
+
+        self.assertEqual(labels.dtype, np.uint8)
+        self.assertEqual(labels.shape, (100, 10))
+        self.assertEqual(properties.shape, (3,))
+
+        self.assertEqual(properties.vp[labels[0, 0]], self.vp0)
+        self.assertEqual(properties.rho[labels[60, 5]], self.rho1)
+        self.assertTrue(np.isnan(properties.vs[labels[-1, -1]]))
+
+    def test_get_interfaces(self):
+
+        labels = np.zeros((100, 10), dtype=np.uint8)
+        labels[50:, :] = 1
+        labels[70:, :5] = 2
+
+        samples, traces, pair_index, pairs = get_interfaces(labels)
+
+        self.assertEqual(samples.size, 15)
+        self.assertEqual(pairs.shape, (2, 2))
+        self.assertTrue(np.array_equal(pairs[pair_index[samples == 49]],
+                                       [[0, 1]] * 10))
+        self.assertTrue(np.array_equal(pairs[pair_index[samples == 69]],
+                                       [[1, 2]] * 5))
+
+    def test_reflectivity_array(self):
+
+        # Two layers with different rocks in each trace
+        vp = np.array([[self.vp0, self.vp1], [self.vp1, self.vp0]])
+        vs = np.array([[self.vs0, self.vs1], [self.vs1, self.vs0]])
+        rho = np.array([[self.rho0, self.rho1], [self.rho1, self.rho0]])
+        theta = np.linspace(0, 40, 5)
+
+        for method in (avo.zoeppritz_rpp, avo.akirichards,
+                       avo.shuey2, avo.bortfeld2):
+            rpp = reflectivity_array(vp, vs, rho, theta,
+                                     reflectivity_method=method)
+            self.assertEqual(rpp.shape, (1, 2, 5))
+
+            # Every trace uses both its own upper and lower rocks
+            for angle in range(theta.size):
+                expected = np.real(rock_reflectivity(
+                    self.Rp0, self.Rp1, theta[angle], method=method))
+                self.assertAlmostEqual(rpp[0, 0, angle], expected)
+
+                expected = np.real(rock_reflectivity(
+                    self.Rp1, self.Rp0, theta[angle], method=method))
+                self.assertAlmostEqual(rpp[0, 1, angle], expected)
+
+        # Chunking, dtype and a single angle
+        vp = np.random.uniform(1500, 3000, (50, 7))
+        full = reflectivity_array(vp, vp / 2, vp, theta)
+        chunked = reflectivity_array(vp, vp / 2, vp, theta,
+                                     dtype=np.float32, chunk_size=3)
+        self.assertEqual(chunked.dtype, np.float32)
+        self.assertTrue(np.allclose(full, chunked, atol=1e-6))
+        self.assertTrue(np.allclose(reflectivity_array(vp, vp / 2, vp,
+                                                       theta[2]),
+                                    full[..., 2]))
+
+    def test_sparse_convolve(self):
+
+        labels = np.zeros((200, 20), dtype=np.uint8)
+        labels[60:, :] = 1
+        labels[120:, :10] = 2
+        properties = np.rec.array(
+            np.array([(self.vp0, self.vs0, self.rho0),
+                      (self.vp1, self.vs1, self.rho1),
+                      (self.vp0, self.vs1, self.rho1)],
+                     dtype=[('vp', 'f8'), ('vs', 'f8'), ('rho', 'f8')]))
+        theta = [0.0, 15.0, 30.0]
+
+        sparse = SparseReflectivity.from_labels(labels, properties,
+                                                theta=theta)
+        dense = sparse.todense()
+
+        self.assertEqual(sparse.shape, (200, 20, 3))
+        self.assertEqual(sparse.samples.size, 30)
+        self.assertEqual(sparse.coefficients.shape, (2, 3))
+
+        wavelets = np.random.randn(41, 2)
+        for traces in (None, [3, 15]):
+            self.assertTrue(np.allclose(
+                do_convolve(wavelets, sparse, traces=traces),
+                do_convolve(wavelets, dense, traces=traces)))
+
+    def test_interface_update(self):
+
+        labels = np.zeros((200, 20), dtype=np.uint8)
+        labels[60:, :] = 1
+        labels[120:, :10] = 2
+        properties = np.rec.array(
+            np.array([(self.vp0, self.vs0, self.rho0),
+                      (self.vp1, self.vs1, self.rho1),
+                      (self.vp0, self.vs1, self.rho1)],
+                     dtype=[('vp', 'f8'), ('vs', 'f8'), ('rho', 'f8')]))
+        theta = [0.0, 15.0, 30.0]
+        wavelets = np.random.randn(41, 2)
+
+        model = InterfaceModel(labels, properties, theta=theta)
+        before, _ = model.model(properties, wavelets)
+
+        # Only the 1/2 pair involves rock 2
+        edited = properties.copy()
+        edited.vp[2] = 2500.0
+        reflectivity, synthetic = model.model(edited, wavelets)
+
+        self.assertEqual(model.pair_updates, 1)
+        self.assertEqual(model.delta_convolutions, 1)
+
+        full = SparseReflectivity.from_labels(labels, edited,
+                                              theta=theta)
+        self.assertTrue(np.allclose(reflectivity.todense(),
+                                    full.todense()))
+        self.assertTrue(np.allclose(synthetic,
+                                    do_convolve(wavelets, full)))
+
+        # Earlier results are left alone
+        self.assertFalse(np.allclose(before.todense(), full.todense()))
+
+    def test_get_reflectivity_unmapped(self):
+
+        cmap = {rgb(150, 100, 100): self.Rp0, rgb(100, 150, 100): self.Rp1}
+        theta = np.array([0.0, 15.0, 30.0])
+        data = np.zeros((100, 20, 3))
+
+        data[:50, :, :] += [150, 100, 100]
+        data[50:, :, :] += [100, 150, 100]
+        data[80:, :, :] += [10, 10, 10]
+
+        reflectivity = get_reflectivity(data, cmap, theta,
+                                        reflectivity_method=avo.akirichards)
+
+        truth = avo.akirichards(self.vp0, self.vs0, self.rho0,
+                                self.vp1, self.vs1, self.rho1,
+                                theta)
+
+        self.assertEqual(reflectivity.shape, (100, 20, 3))
+        self.assertTrue(np.allclose(reflectivity[49, :, :], truth))
+
+        # Unmapped colours don't produce a reflection
+        self.assertEqual(np.count_nonzero(reflectivity[50:, ...]), 0)
+
     def test_do_convolve( self ):
 
         # Make a spike dataset [samp, trace, theta]
@@ -102,6 +257,29 @@ class ReflectivityTest(unittest.TestCase):
     
         self.assertTrue( np.allclose( truth, con ) )
 
+    def test_do_convolve_chunked(self):
+
+        data = np.random.randn(300, 20, 4)
+        wavelets = np.random.randn(101, 3)
+
+        con = do_convolve(wavelets, data, chunk_size=7)
+
+        self.assertEqual(con.shape, (300, 20, 4, 3))
+        for trace, angle, wavelet in ((0, 0, 0), (13, 2, 1), (19, 3, 2)):
+            truth = fftconvolve(data[:, trace, angle],
+                                wavelets[:, wavelet], mode='same')
+            self.assertTrue(np.allclose(truth,
+                                        con[:, trace, angle, wavelet]))
+
+        # Wavelets longer than the data are zero padded
+        short = data[:50, ...]
+        con = do_convolve(wavelets, short, traces=5)
+
+        self.assertEqual(con.shape, (50, 1, 4, 3))
+        padded = np.concatenate((np.zeros(101), short[:, 5, 1]))
+        truth = fftconvolve(padded, wavelets[:, 0], mode='same')[101:]
+        self.assertTrue(np.allclose(truth, con[:, 0, 1, 0]))
+
 if __name__ == '__main__':
 
     suite = \
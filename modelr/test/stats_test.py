@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+from modelr.stats import StreamingStats
+
+
+class StreamingStatsTest(unittest.TestCase):
+
+    def test_moments(self):
+
+        data = np.random.default_rng(0).normal(3.0, 2.0, (500, 4, 5))
+
+        stats = StreamingStats((4, 5))
+        for i in range(0, 500, 64):
+            stats.add(data[i:i + 64])
+
+        self.assertEqual(stats.count, 500)
+        self.assertTrue(np.allclose(stats.mean, data.mean(axis=0)))
+        self.assertTrue(np.allclose(stats.std, data.std(axis=0)))
+        self.assertTrue(np.array_equal(stats.min, data.min(axis=0)))
+
+    def test_percentiles(self):
+
+        data = np.random.default_rng(1).normal(0.0, 1.0, (2000, 3))
+
+        stats = StreamingStats((3,), bins=64)
+        for i in range(0, 2000, 100):
+            stats.add(data[i:i + 100])
+
+        summary = stats.summary()
+        for q in (10, 50, 90):
+            self.assertTrue(np.allclose(summary["p%d" % q],
+                                        np.percentile(data, q, axis=0),
+                                        atol=0.1))
+
+        # Constant elements come back exactly
+        constant = StreamingStats((2,))
+        constant.add(np.ones((10, 2)))
+        self.assertTrue(np.array_equal(constant.percentile(90),
+                                       np.ones(2)))
+
+    def test_merge(self):
+
+        data = np.random.default_rng(2).normal(0.0, 1.0, (300, 4))
+
+        whole = StreamingStats((4,))
+        for i in range(0, 300, 100):
+            whole.add(data[i:i + 100])
+
+        # Parts from the grid of the first batch merge back exactly
+        merged = StreamingStats((4,))
+        merged.add(data[:100])
+        for i in (100, 200):
+            part = merged.empty()
+            part.add(data[i:i + 100])
+            merged.merge(part)
+
+        for name, value in whole.summary().items():
+            self.assertTrue(np.array_equal(merged.summary()[name], value))
+
+        # Parts with their own ranges can't be merged
+        other = StreamingStats((4,))
+        other.add(data[100:])
+        self.assertRaises(ValueError, merged.merge, other)
+
+
+if __name__ == '__main__':
+
+    suite = \
+        unittest.TestLoader().loadTestsFromTestCase(StreamingStatsTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,203 @@
+import unittest
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import h5py
+import numpy as np
+
+from modelr.store import ModelStore, CacheDirectory
+
+
+def write_field(path, name):
+
+    ModelStore(path).write(name, np.ones((50, 10)))
+
+
+class ModelStoreTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = ModelStore(os.path.join(self.tmpdir, 'model.h5'))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def test_fields(self):
+
+        vp = np.random.rand(100, 40)
+        rpp = np.random.rand(100, 40, 5)
+
+        self.store.write('vp', vp)
+        self.store.write('rpp', rpp, theta=np.arange(5))
+
+        # Writing a field keeps the others
+        self.assertEqual(set(self.store.fields()), set(['vp', 'rpp']))
+        self.assertTrue(np.array_equal(self.store.read('vp'), vp))
+        self.assertTrue(np.array_equal(self.store.attrs('rpp')['theta'],
+                                       np.arange(5)))
+
+        with h5py.File(self.store.path, 'r') as f:
+            self.assertEqual(f['rpp'].chunks, (100, 32, 1))
+            self.assertEqual(f['rpp'].compression, 'gzip')
+
+    def test_read(self):
+
+        rpp = np.random.rand(300, 40, 5)
+        self.store.write('rpp', rpp)
+
+        self.assertTrue(np.array_equal(self.store.read('rpp', theta=2),
+                                       rpp[:, :, 2]))
+        self.assertTrue(np.array_equal(self.store.read('rpp', traces=7),
+                                       rpp[:, 7, :]))
+        self.assertTrue(np.array_equal(
+            self.store.read('rpp', samples=slice(50, 80), theta=[4, 1]),
+            rpp[50:80, :, [4, 1]]))
+        self.assertTrue(np.array_equal(
+            self.store.read('rpp', traces=[3, 1, 3], theta=[0, 2]),
+            rpp[:, [3, 1, 3], :][:, :, [0, 2]]))
+
+    def test_concurrent_writes(self):
+
+        names = ['vp', 'vs', 'rho', 'rpp', 'rpp_t', 'phi']
+
+        # Separate stores on one path, as separate requests make them
+        def write(name):
+            ModelStore(self.store.path).write(name, np.ones((50, 10)))
+
+        threads = [threading.Thread(target=write, args=(name,))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(set(self.store.fields()), set(names))
+
+        # And from other processes, as the server workers do
+        pool = mp.get_context('spawn').Pool(2)
+        try:
+            pool.starmap(write_field, [(self.store.path, name + '_p')
+                                       for name in names])
+        finally:
+            pool.terminate()
+
+        self.assertEqual(set(self.store.fields()),
+                         set(names + [name + '_p' for name in names]))
+
+    def test_rewrite(self):
+
+        rpp = np.random.rand(200, 40, 5)
+        self.store.write('vp', np.random.rand(200, 40))
+        self.store.write('rpp', rpp)
+        size = os.path.getsize(self.store.path)
+
+        # Replaced fields don't leave dead space behind
+        for i in range(3):
+            self.store.write('rpp', rpp)
+        self.assertEqual(os.path.getsize(self.store.path), size)
+
+    def test_unreadable(self):
+
+        self.store.write('vp', np.random.rand(200, 40))
+        with open(self.store.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.store.path) // 2)
+
+        # A damaged file is a miss, and the next write replaces it
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return np.ones((10, 4))
+
+        self.assertTrue(np.array_equal(self.store.get('vs', compute),
+                                       np.ones((10, 4))))
+        self.assertTrue(np.array_equal(self.store.read('vs'),
+                                       np.ones((10, 4))))
+        self.store.get('vs', compute)
+        self.assertEqual(len(calls), 1)
+
+    def test_get(self):
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return np.ones((10, 4, 2))
+
+        self.store.get('rpp_t', compute, dt=0.001)
+        self.store.get('rpp_t', compute, dt=0.001)
+        self.assertEqual(len(calls), 1)
+
+        # A different sample interval is computed again
+        self.store.get('rpp_t', compute, dt=0.002)
+        self.assertEqual(len(calls), 2)
+
+
+class CacheDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, cache, name, used):
+
+        path = cache.path(name)
+        ModelStore(path, cache=cache).write('vp', np.zeros((100, 100)))
+        os.utime(path, (used, used))
+
+        return path
+
+    def test_lru(self):
+
+        cache = CacheDirectory(self.tmpdir, max_bytes=10**9)
+        now = time.time()
+
+        old = self.write(cache, 'old.h5', now - 30)
+        new = self.write(cache, 'new.h5', now - 20)
+
+        # Using the old file makes it the most recent
+        cache.path('old.h5')
+        cache.max_bytes = 2 * os.path.getsize(old) + 1
+        self.write(cache, 'third.h5', now - 10)
+
+        self.assertTrue(os.path.exists(old))
+        self.assertFalse(os.path.exists(new))
+
+        stats = cache.stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["size"], 2)
+
+        # Names can't leave the directory
+        self.assertEqual(os.path.dirname(cache.path('../../etc/x.h5')),
+                         self.tmpdir)
+
+    def test_ttl(self):
+
+        cache = CacheDirectory(self.tmpdir, ttl=60)
+        now = time.time()
+
+        stale = self.write(cache, 'stale.h5', now - 120)
+        fresh = self.write(cache, 'fresh.h5', now)
+        cache.evict()
+
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertEqual(cache.stats()["expired"], 1)
+
+
+if __name__ == '__main__':
+
+    suite = unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(ModelStoreTest),
+        unittest.TestLoader().loadTestsFromTestCase(CacheDirectoryTest)])
+    unittest.TextTestRunner(verbosity=2).run(suite)
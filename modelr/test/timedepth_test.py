@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+from bruges.transform import depth_to_time
+
+from modelr.timedepth import TimeMap, TimeMapCache
+
+
+class TimeMapTest(unittest.TestCase):
+
+    def setUp(self):
+
+        rng = np.random.default_rng(0)
+        self.vp = 2000 + rng.random((300, 40)) * 800
+        self.vs = self.vp / 2 + rng.random((300, 40))
+        self.labels = (np.arange(300) // 100)[:, np.newaxis] * \
+            np.ones((1, 40), dtype=np.uint8)
+
+    def test_bruges(self):
+
+        time_map = TimeMap(self.vp, 2.0, 0.001)
+        vpt, vst = time_map.apply(self.vp, self.vs)
+
+        self.assertTrue(np.array_equal(
+            vpt, depth_to_time(self.vp, self.vp, 2.0, 0.001)))
+        self.assertTrue(np.array_equal(
+            vst, depth_to_time(self.vs, self.vp, 2.0, time_map.times)))
+
+        # Labels keep their type
+        labels = time_map.apply(self.labels)
+        self.assertEqual(labels.dtype, self.labels.dtype)
+
+        linear = TimeMap(self.vp, 2.0, 0.001, mode='linear')
+        self.assertTrue(np.allclose(
+            linear.apply(self.vs),
+            depth_to_time(self.vs, self.vp, 2.0, 0.001, mode='linear')))
+
+        # A single trace
+        self.assertTrue(np.array_equal(
+            TimeMap(self.vp[:, 3], 2.0, 0.001).apply(self.vs[:, 3]),
+            depth_to_time(self.vs[:, 3], self.vp[:, 3], 2.0, 0.001)))
+
+    def test_cache(self):
+
+        cache = TimeMapCache(size=2)
+
+        first = cache.get(self.vp, 2.0, 0.001)
+        self.assertTrue(cache.get(self.vp.copy(), 2.0, 0.001) is first)
+        self.assertFalse(cache.get(self.vp, 2.0, 0.002) is first)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+if __name__ == '__main__':
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TimeMapTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,76 @@
+import unittest
+import json
+
+import numpy as np
+
+from modelr.web.transport import ArrayEncoder, encode_binary, \
+    decode_binary, negotiate, BINARY_TYPE
+
+
+class TransportTest(unittest.TestCase):
+
+    data = {"seismic": np.random.randn(35, 100).T,
+            "f": np.linspace(8, 100, 7),
+            "theta": [0, 15, 30],
+            "dt": 2.0,
+            "gathers": [np.arange(6).reshape(2, 3)]}
+
+    def test_json(self):
+
+        encoded = json.loads(json.dumps(self.data, cls=ArrayEncoder))
+
+        self.assertEqual(encoded["seismic"], self.data["seismic"].tolist())
+        self.assertEqual(encoded["gathers"], [[[0, 1, 2], [3, 4, 5]]])
+
+    def test_binary(self):
+
+        chunks = encode_binary(self.data)
+        body = b''.join(bytes(chunk) for chunk in chunks)
+
+        # Buffers are aligned for zero copy views
+        self.assertEqual(len(body) % 8, 0)
+
+        decoded = decode_binary(body)
+
+        self.assertEqual(decoded["theta"], [0, 15, 30])
+        self.assertEqual(decoded["dt"], 2.0)
+        self.assertEqual(decoded["seismic"].shape, (100, 35))
+        self.assertTrue(np.allclose(decoded["seismic"],
+                                    self.data["seismic"], atol=1e-6))
+        self.assertTrue(np.array_equal(decoded["gathers"][0],
+                                       self.data["gathers"][0]))
+
+    def test_quantized(self):
+
+        chunks = encode_binary(self.data, quantize=True)
+        body = b''.join(bytes(chunk) for chunk in chunks)
+        decoded = decode_binary(body)
+
+        peak = np.amax(np.abs(self.data["seismic"]))
+        self.assertTrue(np.allclose(decoded["seismic"],
+                                    self.data["seismic"],
+                                    atol=peak / 32767.0))
+
+        # Smaller than float32
+        self.assertTrue(len(body) <
+                        len(b''.join(bytes(chunk) for chunk in
+                                     encode_binary(self.data))))
+
+    def test_negotiate(self):
+
+        self.assertEqual(negotiate(None, {}), 'json')
+        self.assertEqual(negotiate(BINARY_TYPE, {}), 'float32')
+
+        parameters = {'format': ['int16']}
+        self.assertEqual(negotiate('application/json', parameters),
+                         'int16')
+        self.assertEqual(parameters, {})
+
+        self.assertRaises(ValueError, negotiate, None,
+                          {'format': ['xml']})
+
+if __name__ == '__main__':
+
+    suite = \
+      unittest.TestLoader().loadTestsFromTestCase(TransportTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from modelr.web.util import wiggle, draw_wiggles
+
+
+class WiggleTest(unittest.TestCase):
+
+    def tearDown(self):
+
+        plt.close('all')
+
+    def test_wiggle(self):
+
+        data = np.random.randn(100, 30)
+        original = data.copy()
+
+        fig, axes = plt.subplots()
+        wiggle(data, 0, dt=0.001, skipt=1, xax=np.arange(30),
+               quadrant=axes)
+
+        # The input is left alone and each drawn trace is one path
+        # in a single collection
+        self.assertTrue(np.array_equal(data, original))
+        self.assertEqual(len(axes.collections), 2)
+        self.assertEqual(len(axes.collections[1].get_paths()), 15)
+
+    def test_fill(self):
+
+        fig, axes = plt.subplots()
+        trace = np.array([0., 1., -1., 2., 0.])
+
+        lines, fills = draw_wiggles(axes, trace, np.arange(5.),
+                                    positions=3, scale=2)
+
+        vertices = fills.get_paths()[0].vertices
+        self.assertTrue(np.allclose(vertices[1:6, 0],
+                                    [3., 5., 3., 7., 3.]))
+        self.assertTrue(np.allclose(lines.get_segments()[0][:, 0],
+                                    3 + 2 * trace))
+
+if __name__ == '__main__':
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(WiggleTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+from bruges.filters import ricker
+
+from modelr.wavelets import WaveletBank, wavelet_bank
+from modelr.reflectivity import do_convolve
+
+
+class WaveletBankTest(unittest.TestCase):
+
+    def test_wavelets(self):
+
+        bank = WaveletBank()
+        f = np.logspace(3, 6, 10, base=2.0)
+
+        wavelets = bank.wavelets(ricker, 0.2, 0.002, f)
+        self.assertEqual(wavelets.shape[1], 10)
+        self.assertFalse(wavelets.flags.writeable)
+
+        # Same parameters come from the cache
+        self.assertTrue(bank.wavelets(ricker, 0.2, 0.002, f) is wavelets)
+        self.assertEqual((bank.hits, bank.misses), (1, 1))
+
+        # A single frequency gives a single wavelet
+        single = bank.wavelets(ricker, 0.2, 0.002, 25.0)
+        self.assertEqual(single.ndim, 1)
+
+        # Rotating the phase keeps the energy
+        rotated = bank.wavelets(ricker, 0.2, 0.002, 25.0, phase=np.pi / 2)
+        self.assertFalse(np.allclose(rotated, single))
+        self.assertAlmostEqual(np.sum(rotated**2), np.sum(single**2),
+                               places=2)
+
+    def test_spectra(self):
+
+        wavelets = wavelet_bank.wavelets(ricker, 0.1, 0.001, [20., 40.])
+        data = np.zeros((200, 3, 2))
+        data[100, :, :] = 1.0
+
+        before = wavelet_bank.stats()
+        first = do_convolve(wavelets, data)
+        second = do_convolve(wavelets, data)
+        after = wavelet_bank.stats()
+
+        self.assertTrue(np.array_equal(first, second))
+        self.assertEqual(after["spectrum_hits"] -
+                         before["spectrum_hits"], 1)
+
+        # Plain arrays still work and aren't cached
+        self.assertTrue(np.allclose(do_convolve(np.array(wavelets), data),
+                                    first))
+
+    def test_eviction(self):
+
+        bank = WaveletBank(max_bytes=8000)
+
+        for f in range(10, 20):
+            bank.wavelets(ricker, 0.2, 0.001, float(f))
+
+        stats = bank.stats()
+        self.assertTrue(stats["evictions"] > 0)
+        self.assertTrue(stats["bytes"] <= 8000)
+
+if __name__ == '__main__':
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(WaveletBankTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
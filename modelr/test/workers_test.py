@@ -0,0 +1,72 @@
+import unittest
+import threading
+import time
+
+from modelr.web.workers import WorkerPool, PoolFull, JobTimeout
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def test_apply(self):
+
+        pool = WorkerPool(processes=1, prewarm=())
+
+        try:
+            self.assertEqual(pool.apply(pow, (2, 10)), 1024)
+
+            # Exceptions from the job are raised again
+            self.assertRaises(ValueError, pool.apply, int, ('x',))
+
+            self.assertEqual(pool.stats()["jobs"], 2)
+        finally:
+            pool.close()
+
+    def test_recycle(self):
+
+        pool = WorkerPool(processes=1, max_jobs=2, prewarm=())
+
+        try:
+            for i in range(5):
+                self.assertEqual(pool.apply(abs, (-i,)), i)
+
+            self.assertEqual(pool.stats()["recycled"], 2)
+        finally:
+            pool.close()
+
+    def test_timeout(self):
+
+        pool = WorkerPool(processes=1, prewarm=())
+
+        try:
+            self.assertRaises(JobTimeout, pool.apply, time.sleep, (10,),
+                              timeout=0.5)
+
+            # The worker is replaced and the pool still works
+            self.assertEqual(pool.apply(abs, (-3,)), 3)
+            self.assertEqual(pool.stats()["timeouts"], 1)
+        finally:
+            pool.close()
+
+    def test_full(self):
+
+        pool = WorkerPool(processes=1, queue_size=0, prewarm=())
+
+        try:
+            busy = threading.Thread(target=pool.apply,
+                                    args=(time.sleep, (1,)))
+            busy.start()
+            time.sleep(0.1)
+
+            self.assertRaises(PoolFull, pool.apply, abs, (-1,))
+            busy.join()
+
+            self.assertEqual(pool.apply(abs, (-1,)), 1)
+            self.assertEqual(pool.stats()["rejected"], 1)
+        finally:
+            pool.close()
+
+if __name__ == '__main__':
+
+    suite = \
+      unittest.TestLoader().loadTestsFromTestCase(WorkerPoolTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,226 @@
+'''
+==================
+modelr.timedepth
+==================
+
+Depth to time conversion with one sample map per velocity model,
+shared by every property grid and label image of the model.
+'''
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TimeMap(object):
+    '''
+    The samples of a depth model that land on each time sample.
+
+    Times follow bruges.transform.depth_to_time: each depth sample
+    is placed at its depth divided by the average velocity above it,
+    doubled for two way time. The times are found for every trace at
+    once, and a single sorted search over all the traces gives the
+    map, so converting a grid is one gather.
+
+    :param vp: P-wave velocities, indexed as [sample, trace].
+    :param dz: The depth sample interval [m].
+    :param dt: The time sample interval [s], or an array of times to
+               sample at.
+
+    :keyword mode: 'nearest' for an integer sample map, or 'linear'
+                   to interpolate between samples.
+    :keyword twt: Use two way time.
+    '''
+
+    def __init__(self, vp, dz, dt, mode='nearest', twt=True):
+
+        if mode not in ('nearest', 'linear'):
+            raise ValueError('unknown mode: %s' % mode)
+
+        vp = np.asarray(vp, dtype=float)
+        self.single = vp.ndim == 1
+        if self.single:
+            vp = vp[:, np.newaxis]
+
+        nsamps, ntraces = vp.shape
+        self.shape = vp.shape
+        self.mode = mode
+
+        depth = np.arange(nsamps)[:, np.newaxis] * dz
+        average = np.cumsum(vp, axis=0) / \
+            np.arange(1, nsamps + 1)[:, np.newaxis]
+
+        times = depth / average * (2.0 if twt else 1.0)
+
+        if np.size(dt) == 1:
+            self.times = np.arange(np.amin(times), np.amax(times), dt)
+        else:
+            self.times = np.asarray(dt, dtype=float)
+
+        # Knots to search: the midpoints between samples for nearest,
+        # the samples themselves for linear
+        if mode == 'nearest':
+            knots = (times[1:] + times[:-1]) / 2.0
+        else:
+            knots = times
+
+        # Shift each trace by its own offset so all the traces can be
+        # searched as one sorted array
+        knots = np.maximum.accumulate(knots, axis=0)
+        low = min(np.amin(knots) if knots.size else 0.0,
+                  np.amin(self.times) if self.times.size else 0.0)
+        high = max(np.amax(knots) if knots.size else 0.0,
+                   np.amax(self.times) if self.times.size else 0.0)
+        spacing = (high - low) + 1.0
+
+        offsets = np.arange(ntraces) * spacing
+        flat = (knots - low + offsets).T.ravel()
+        targets = (self.times[:, np.newaxis] - low + offsets)
+
+        nknots = knots.shape[0]
+        start = np.arange(ntraces) * nknots
+
+        if mode == 'nearest':
+            index = np.searchsorted(flat, targets, side='left') - start
+            self.index = np.minimum(index, nsamps - 1)
+            self.weight = None
+
+            # Past the bottom of the trace takes the last sample
+            past = self.times[:, np.newaxis] > times[-1]
+            self.index[past] = nsamps - 1
+
+        else:
+            index = np.searchsorted(flat, targets, side='right') - \
+                start - 1
+            index = np.clip(index, 0, nsamps - 1)
+            upper = np.minimum(index + 1, nsamps - 1)
+
+            columns = np.arange(ntraces)
+            t0 = times[index, columns]
+            t1 = times[upper, columns]
+            gap = t1 - t0
+
+            weight = np.where(gap > 0, (self.times[:, np.newaxis] - t0) /
+                              np.where(gap > 0, gap, 1.0), 0.0)
+
+            # Past the bottom of the trace takes the last sample
+            past = self.times[:, np.newaxis] > times[-1]
+            index[past] = nsamps - 1
+            weight[past] = 0.0
+
+            self.index = index
+            self.weight = np.clip(weight, 0.0, 1.0)
+
+    @property
+    def nbytes(self):
+
+        return (self.times.nbytes + self.index.nbytes +
+                (self.weight.nbytes if self.weight is not None else 0))
+
+    def apply(self, *grids):
+        '''
+        Convert grids to time.
+
+        :param grids: Arrays indexed as [sample, trace], the same
+                      shape as the velocity model. They are gathered
+                      together, so pass a label image on its own to
+                      keep its type.
+
+        :returns: the converted grid, or a tuple of them, indexed as
+                  [time, trace].
+        '''
+
+        stacked = np.stack([np.asarray(grid).reshape(self.shape)
+                            for grid in grids])
+
+        columns = np.arange(self.shape[1])
+        output = stacked[:, self.index, columns]
+
+        if self.weight is not None:
+            upper = np.minimum(self.index + 1, self.shape[0] - 1)
+            output = output + (stacked[:, upper, columns] - output) * \
+                self.weight
+
+        if self.single:
+            output = output[..., 0]
+
+        if len(grids) == 1:
+            return output[0]
+
+        return tuple(output)
+
+
+class TimeMapCache(object):
+    '''
+    Keeps the TimeMap of the last few velocity models, keyed by the
+    velocities themselves, the sample intervals and the mode.
+
+    :keyword size: The number of maps to keep.
+    '''
+
+    def __init__(self, size=8):
+
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._maps = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, vp, dz, dt, mode='nearest', twt=True):
+        '''
+        Get the TimeMap of a velocity model. See TimeMap for the
+        parameters.
+        '''
+
+        vp = np.ascontiguousarray(vp, dtype=float)
+        times = np.atleast_1d(np.asarray(dt, dtype=float))
+
+        key = (hashlib.sha1(vp.tobytes()).hexdigest(), vp.shape,
+               float(dz), np.size(dt),
+               hashlib.sha1(times.tobytes()).hexdigest(), mode, twt)
+
+        with self._lock:
+            time_map = self._maps.get(key)
+            if time_map is not None:
+                self._maps.move_to_end(key)
+                self.hits += 1
+                return time_map
+
+            self.misses += 1
+
+        time_map = TimeMap(vp, dz, dt, mode=mode, twt=twt)
+
+        with self._lock:
+            self._maps[key] = time_map
+            while len(self._maps) > self.size:
+                self._maps.popitem(last=False)
+
+        return time_map
+
+    def clear(self):
+        '''
+        Drop the maps and reset the counters.
+        '''
+
+        with self._lock:
+            self._maps.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''
+        Returns a dictionary of the cache counters.
+        '''
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._maps),
+                    "bytes": sum(m.nbytes for m in self._maps.values())}
+
+
+time_maps = TimeMapCache()
@@ -0,0 +1,219 @@
+'''
+=================
+modelr.wavelets
+=================
+
+A process wide bank of wavelets and their spectra, so the banks used
+by the seismic models and plots are only built once.
+'''
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from bruges.filters import rotate_phase
+
+from modelr.constants import WAVELETS
+
+
+class _Entry(object):
+
+    def __init__(self, wavelets):
+
+        self.wavelets = wavelets
+        self.spectra = {}
+
+    @property
+    def nbytes(self):
+
+        return (self.wavelets.nbytes +
+                sum(s.nbytes for s in self.spectra.values()))
+
+
+def _generate(wavelet, duration, dt, f):
+    '''
+    Builds a bank of wavelets indexed as [samples, wavelet].
+    '''
+
+    f = np.atleast_1d(np.asarray(f, dtype=float))
+
+    if wavelet == WAVELETS['ormsby'] and f.size > 1:
+        columns = [_generate(wavelet, duration, dt, freq)[:, 0]
+                   for freq in f]
+        return np.column_stack(columns)
+
+    bank = wavelet(duration, dt, f if f.size > 1 else f[0])
+
+    # Newer releases of bruges return (amplitude, time) tuples and put
+    # the frequency axis first
+    if isinstance(bank, tuple):
+        bank = bank[0]
+    bank = np.asarray(bank, dtype=float)
+
+    if bank.ndim == 1:
+        bank = bank[:, np.newaxis]
+    elif bank.shape[1] != f.size:
+        bank = bank.T
+
+    return bank
+
+
+class WaveletBank(object):
+    '''
+    Caches banks of wavelets keyed by (wavelet, frequencies, dt,
+    duration, phase), with the real FFT of each bank at the padded
+    lengths asked for by the convolution.
+
+    Entries are dropped least recently used first once the wavelets
+    and spectra take more than max_bytes. The arrays handed out are
+    read only since they are shared.
+
+    :keyword max_bytes: Size limit of the bank.
+    '''
+
+    def __init__(self, max_bytes=64 * 2**20):
+
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_id = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.spectrum_hits = 0
+        self.spectrum_misses = 0
+        self.evictions = 0
+
+    def _evict(self):
+
+        nbytes = sum(e.nbytes for e in self._entries.values())
+
+        while nbytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            del self._by_id[id(entry.wavelets)]
+            nbytes -= entry.nbytes
+            self.evictions += 1
+
+    def wavelets(self, wavelet, duration, dt, f, phase=0.0):
+        '''
+        Get a bank of wavelets.
+
+        :param wavelet: A function from constants.WAVELETS.
+        :param duration: The length of the wavelets [s].
+        :param dt: The sample interval [s].
+        :param f: A frequency or an array of frequencies. Ormsby
+                  banks are built one frequency at a time.
+        :keyword phase: Phase rotation [radians].
+
+        :returns: the wavelets indexed as [samples, wavelet], or a
+                  single wavelet for a single frequency.
+        '''
+
+        single = np.ndim(f) == 0
+        key = (wavelet, tuple(np.atleast_1d(f).astype(float).tolist()),
+               float(dt), float(duration), float(phase), single)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.wavelets
+
+            self.misses += 1
+
+        bank = _generate(wavelet, duration, dt, f)
+
+        if phase:
+            rows = bank.T
+            bank = np.asarray(rotate_phase(rows, phase))\
+                     .reshape(rows.shape).T
+
+        if single and bank.shape[1] == 1:
+            bank = bank[:, 0]
+
+        bank = np.ascontiguousarray(bank)
+        bank.flags.writeable = False
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(bank)
+                self._entries[key] = entry
+                self._by_id[id(bank)] = key
+                self._evict()
+
+        return entry.wavelets
+
+    def spectra(self, wavelets, nfft):
+        '''
+        Get the real FFT of a bank of wavelets along the sample axis.
+        Spectra of banks from this cache are kept, others are
+        computed each time.
+
+        :param wavelets: Wavelets indexed as [samples, wavelet], or a
+                         single wavelet.
+        :param nfft: The padded FFT length.
+
+        :returns: the spectra indexed as [frequency, wavelet].
+        '''
+
+        with self._lock:
+            key = self._by_id.get(id(wavelets))
+            entry = self._entries.get(key) if key is not None else None
+
+            if entry is not None and entry.wavelets is wavelets:
+                spectrum = entry.spectra.get(nfft)
+                if spectrum is not None:
+                    self.spectrum_hits += 1
+                    return spectrum
+            else:
+                entry = None
+
+            self.spectrum_misses += 1
+
+        columns = wavelets if wavelets.ndim > 1 else \
+            wavelets[:, np.newaxis]
+        spectrum = np.fft.rfft(columns, n=nfft, axis=0)
+
+        if entry is not None:
+            spectrum.flags.writeable = False
+            with self._lock:
+                entry.spectra[nfft] = spectrum
+                self._evict()
+
+        return spectrum
+
+    def clear(self):
+        '''
+        Empty the bank and reset the counters.
+        '''
+
+        with self._lock:
+            self._entries.clear()
+            self._by_id.clear()
+            self.hits = 0
+            self.misses = 0
+            self.spectrum_hits = 0
+            self.spectrum_misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        '''
+        Returns a dictionary of the bank counters.
+        '''
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "spectrum_hits": self.spectrum_hits,
+                    "spectrum_misses": self.spectrum_misses,
+                    "evictions": self.evictions,
+                    "size": len(self._entries),
+                    "bytes": sum(e.nbytes
+                                 for e in self._entries.values())}
+
+
+wavelet_bank = WaveletBank()
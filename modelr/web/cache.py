@@ -0,0 +1,466 @@
+'''
+==================
+modelr.web.cache
+==================
+
+Process wide caches shared by the request threads of the web server.
+'''
+
+import ast
+import hashlib
+import json
+import os
+from os.path import dirname, join
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from modelr.store import CacheDirectory, TEMP_PREFIX
+from modelr.web.urlargparse import URLArgumentParser
+from modelr.web.transport import ArrayEncoder
+
+
+class ScriptCache(object):
+    '''
+    Caches the namespaces of executed scripts, keyed by path and
+    modification time. A script is only read, compiled and executed
+    again when the file changes on disk.
+
+    The cache is safe to share between the threads of
+    ThreadedHTTPServer.
+    '''
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._namespaces = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, script_path):
+        '''
+        Get the namespace for a script.
+
+        :param script_path: Path to the script file.
+
+        :returns: a dictionary of the globals defined by the script.
+        '''
+
+        stat = os.stat(script_path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self._namespaces.get(script_path)
+
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+            with open(script_path, 'r') as fd:
+                code = compile(fd.read(), script_path, 'exec')
+
+            namespace = {}
+            exec(code, namespace)
+
+            self._namespaces[script_path] = (key, namespace)
+
+        return namespace
+
+    def clear(self):
+        '''
+        Empty the cache and reset the counters.
+        '''
+
+        with self._lock:
+            self._namespaces.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''
+        Returns a dictionary of the cache counters.
+        '''
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._namespaces)}
+
+
+def _literal(node):
+    '''
+    Evaluates a constant expression, allowing the string
+    concatenation used to wrap long descriptions.
+    '''
+
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return _literal(node.left) + _literal(node.right)
+        raise
+
+
+def read_description(script_path):
+    '''
+    Reads the short_description of a script without running it.
+
+    :param script_path: Path to the script file.
+
+    :returns: the description, or 'No doc' if there isn't one.
+    :raises ValueError: if the description is not a constant
+                        expression.
+    '''
+
+    with open(script_path, 'r') as fd:
+        tree = ast.parse(fd.read(), script_path)
+
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+
+        for target in node.targets:
+            if (isinstance(target, ast.Name) and
+                    target.id == 'short_description'):
+                return _literal(node.value)
+
+    return 'No doc'
+
+
+class ScriptRegistry(object):
+    '''
+    Caches the listing of the scripts of each type and the argument
+    schema of each script.
+
+    Listings are rebuilt when the modification time of the script
+    directory changes. Descriptions are read from the syntax tree of
+    each script so listing a directory doesn't execute anything.
+    '''
+
+    def __init__(self, scripts_dir, cache):
+
+        self.scripts_dir = scripts_dir
+        self.cache = cache
+
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._schemas = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def available(self, script_type):
+        '''
+        Returns a list of (script, short_description) pairs for all
+        the scripts of a type.
+        '''
+
+        scripts_dir = join(self.scripts_dir, script_type)
+        key = os.stat(scripts_dir).st_mtime_ns
+
+        with self._lock:
+            entry = self._listings.get(script_type)
+
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return list(entry[1])
+
+            self.misses += 1
+
+        available_scripts = []
+        for script in os.listdir(scripts_dir):
+            try:
+                if script == '__init__.py':
+                    continue
+                elif not script.endswith('.py'):
+                    continue
+
+                script_path = join(scripts_dir, script)
+                try:
+                    short_doc = read_description(script_path)
+                except ValueError:
+                    # Fall back to running scripts that build their
+                    # description at import time
+                    short_doc = self.cache.load(script_path)\
+                                    .get('short_description', 'No doc')
+
+                available_scripts.append((script, short_doc))
+            except Exception as e:
+                print(script, e)
+
+        with self._lock:
+            self._listings[script_type] = (key, available_scripts)
+
+        return list(available_scripts)
+
+    def schema(self, script_path):
+        '''
+        Returns the JSON argument schema of a script.
+        '''
+
+        stat = os.stat(script_path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self._schemas.get(script_path)
+
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        namespace = self.cache.load(script_path)
+
+        add_arguments = namespace['add_arguments']
+        short_description = namespace.get('short_description',
+                                          'No description')
+
+        parser = URLArgumentParser(short_description)
+        add_arguments(parser)
+        json_data = parser.json_data
+
+        with self._lock:
+            self._schemas[script_path] = (key, json_data)
+
+        return json_data
+
+    def clear(self):
+        '''
+        Empty the registry and reset the counters.
+        '''
+
+        with self._lock:
+            self._listings.clear()
+            self._schemas.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''
+        Returns a dictionary of the registry counters.
+        '''
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._listings) + len(self._schemas)}
+
+
+def canonical(obj):
+    '''
+    Converts parsed script arguments into a structure that serializes
+    the same way for equal arguments.
+
+    Functions are named by module and qualified name, objects by class
+    and attributes and arrays by dtype, shape and a digest of the data.
+    '''
+
+    if isinstance(obj, dict):
+        return dict((str(key), canonical(value))
+                    for key, value in obj.items())
+
+    if isinstance(obj, (list, tuple)):
+        return [canonical(value) for value in obj]
+
+    if isinstance(obj, np.ndarray):
+        data = np.ascontiguousarray(obj)
+        return {"dtype": data.dtype.str, "shape": list(data.shape),
+                "sha1": hashlib.sha1(data.view(np.uint8)).hexdigest()}
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        return '%s.%s' % (obj.__module__, obj.__qualname__)
+
+    if hasattr(obj, '__dict__'):
+        state = canonical(vars(obj))
+        state['__class__'] = type(obj).__name__
+        return state
+
+    return repr(obj)
+
+
+def script_version(script_path):
+    '''
+    Returns the (mtime, size) of a script for result keys, so results
+    are not reused after the script is edited. None if it can't be
+    read.
+    '''
+
+    try:
+        stat = os.stat(script_path)
+    except (IOError, OSError):
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def result_key(*parts):
+    '''
+    Returns a hex digest of the canonical form of the parts.
+    '''
+
+    data = json.dumps(canonical(parts), sort_keys=True,
+                      cls=ArrayEncoder)
+
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResultCache(object):
+    '''
+    Caches the rendered image and metadata of plot requests, keyed by
+    result_key.
+
+    The memory tier is an LRU bounded by the total size of the stored
+    images and metadata. If a directory is given, results are also
+    written there and read back after they drop out of memory. The
+    directory is a modelr.store.CacheDirectory, bounded by disk_bytes
+    and disk_ttl with the least recently used results removed first.
+
+    :keyword max_bytes: Size limit of the memory tier.
+    :keyword directory: Optional directory for the disk tier.
+    :keyword disk_bytes: Size limit of the disk tier.
+    :keyword disk_ttl: Time to keep unused results on disk [s], or
+                       None to keep them until space is needed.
+    '''
+
+    def __init__(self, max_bytes=256 * 2**20, directory=None,
+                 disk_bytes=2**30, disk_ttl=None):
+
+        self.max_bytes = max_bytes
+        self.directory = directory
+
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.disk = CacheDirectory(directory, max_bytes=disk_bytes,
+                                       ttl=disk_ttl)
+        else:
+            self.disk = None
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _encode(image_data, metadata):
+
+        header = json.dumps(metadata, cls=ArrayEncoder).encode()
+
+        return struct.pack('<I', len(header)) + header + image_data
+
+    @staticmethod
+    def _decode(blob):
+
+        length, = struct.unpack('<I', blob[:4])
+        metadata = json.loads(blob[4:4 + length].decode())
+
+        return blob[4 + length:], metadata
+
+    def _path(self, key):
+
+        return join(self.directory, key + '.result')
+
+    def _store(self, key, blob):
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= len(self._entries.pop(key))
+
+            self._entries[key] = blob
+            self.nbytes += len(blob)
+
+            while self.nbytes > self.max_bytes and self._entries:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= len(old)
+                self.evictions += 1
+
+    def get(self, key):
+        '''
+        Returns the (image_data, metadata) stored for a key, or None.
+        '''
+
+        with self._lock:
+            blob = self._entries.get(key)
+
+            if blob is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._decode(blob)
+
+        if self.disk is not None:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    blob = f.read()
+            except (IOError, OSError):
+                blob = None
+
+            if blob is not None:
+                self.disk.touch(path)
+                self._store(key, blob)
+                with self._lock:
+                    self.disk_hits += 1
+                return self._decode(blob)
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, key, image_data, metadata):
+        '''
+        Store the image data and metadata of a result.
+        '''
+
+        blob = self._encode(image_data, metadata)
+        self._store(key, blob)
+
+        if self.disk is not None:
+            path = self._path(key)
+            fd, tmp = tempfile.mkstemp(dir=self.directory,
+                                       prefix=TEMP_PREFIX)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp, path)
+
+            self.disk.evict(keep=path)
+
+    def stats(self):
+        '''
+        Returns a dictionary of the cache counters.
+        '''
+
+        with self._lock:
+            stats = {"hits": self.hits,
+                     "disk_hits": self.disk_hits,
+                     "misses": self.misses,
+                     "evictions": self.evictions,
+                     "size": len(self._entries),
+                     "bytes": self.nbytes}
+
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+
+        return stats
+
+
+script_cache = ScriptCache()
+script_registry = ScriptRegistry(join(dirname(__file__), 'scripts'),
+                                 script_cache)
@@ -9,7 +9,7 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
 import numpy as np
-from modelr.web.util import get_figure_data
+from modelr.web.util import get_figure_data, draw_wiggles
 
 short_description = ('Spatial, theta, f cross-sections')
 
@@ -114,12 +114,8 @@ def run_script(earth_model, seismic_model,
     c = 20 # fractional denominator of cross section width
     gain1 = float(seismic_data.shape[1]/c)
 
-    axarr[0][0].plot(args.trace  + gain1 * trace1, x, 'k',
-                     alpha = 0.9)
-    axarr[0][0].fill_betweenx(x, args.trace+gain1 * trace1,
-                              args.trace, 
-                              gain1 * trace1 >= 0.01,
-                              color = 'k', alpha = 0.5)
+    draw_wiggles(axarr[0][0], trace1, x, positions=args.trace,
+                 scale=gain1, threshold=0.01, line_alpha=0.9)
 
 
     # Put colorbar legend on spatial cross section
@@ -183,11 +179,8 @@ def run_script(earth_model, seismic_model,
     
     gain2 = (float(width_ratios[0])/width_ratios[1]) * (seismic_data.shape[2] / gain1)
 
-    axarr[0][1].plot(args.theta + gain2 * trace2, x, 'k', alpha = 0.9)
-    axarr[0][1].fill_betweenx(x, args.theta + gain2 * trace2,
-                              args.theta, 
-                              gain2 * trace2 >= -0.01,
-                              color = 'k', alpha = 0.5)
+    draw_wiggles(axarr[0][1], trace2, x, positions=args.theta,
+                 scale=gain2, threshold=-0.01, line_alpha=0.9)
     axarr[0][1].set_xlim(left=0, right=seismic_data.shape[2])
     
     # line plot
@@ -243,10 +236,8 @@ def run_script(earth_model, seismic_model,
     gain3 = 2*(float(width_ratios[0])/width_ratios[2]) * (seismic_data.shape[3] / gain1)
 
     freq = seismic_model.wavelet_cf()[f]
-    axarr[0][2].plot(freq -1 + gain3 * trace3, x, 'k', alpha = 0.9)
-    axarr[0][2].fill_betweenx(x, freq -1 + gain3 * trace3, freq -1, 
-                              gain3 * trace3 -1 >= -1,
-                              color = 'k', alpha = 0.5)
+    draw_wiggles(axarr[0][2], trace3, x, positions=freq - 1,
+                 scale=gain3, line_alpha=0.9)
                               
     #
     axarr[0][2].set_xlim(left = 8, right = 99)
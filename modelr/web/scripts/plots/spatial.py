@@ -14,7 +14,7 @@ import matplotlib.gridspec as gridspec
 from argparse import ArgumentParser
 
 
-from modelr.web.util import get_figure_data
+from modelr.web.util import get_figure_data, draw_wiggles
 
 import modelr.modelbuilder as mb
 from modelr.web.defaults import default_parsers
@@ -126,19 +126,13 @@ def run_script(earth_model,
     c = 20 # fractional denominator of cross section width
     gain1 = float(seismic_data.shape[1]/c)
     
-    axarr[0].plot(args.trace  + gain1 * trace1, tt, 'k',alpha = 0.9)
-    axarr[0].fill_betweenx(tt, args.trace + gain1 * trace1,
-                            args.trace, 
-                            gain1 * trace1 > 0.01,
-                            color = 'k', alpha = 0.5)
+    draw_wiggles(axarr[0], trace1, tt, positions=args.trace,
+                 scale=gain1, threshold=0.01, line_alpha=0.9)
     
     # Put wiggle in right panel
     #get y-axis limits, so can reverse y-axis of wiggle plot
     a1ymin, a1ymax = axarr[1].get_ylim()
-    axarr[1].plot(trace1,tt,'k')
-    axarr[1].fill_betweenx(tt, trace1, 0, 
-                              trace1 > 0.01,
-                              color = 'k', alpha = 0.5)
+    draw_wiggles(axarr[1], trace1, tt, threshold=0.01)
     axarr[1].axvline(x=0, lw=1, color='k', alpha=0.25)
     axarr[1].yaxis.tick_right()
     axarr[1].set_xticks([-1.0, 0, 1.0])
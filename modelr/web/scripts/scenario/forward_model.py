@@ -7,8 +7,6 @@ import numpy as np
 import matplotlib
 from scipy.interpolate import interp1d
 
-from urllib.request import urlopen
-
 from argparse import ArgumentParser
 from modelr.web.defaults import default_parsers
 from modelr.web.urlargparse import earth_model_type
@@ -19,9 +17,7 @@ from bruges.reflection import zoeppritz
 from modelr.web.util import modelr_plot
 from bruges.filters import ricker
 
-from io import StringIO
-
-from PIL import Image
+from modelr.images import image_fetcher
 short_description = 'Spatial view of an image-based model'
 
 
@@ -99,9 +95,7 @@ def run_script(args):
     args.slice = 'spatial'
     args.trace = 0
     
-    model = urlopen(args.model["image"]).read()
-    model = Image.open(StringIO(model)).convert("RGB")
-    model = np.asarray(model)
+    model = image_fetcher.array(args.model["image"])
     
     # decimate the first dimension of the model (into sample rate: dt [ms])
     
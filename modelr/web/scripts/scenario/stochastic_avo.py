@@ -10,8 +10,8 @@ from modelr.web.urlargparse import rock_properties_type,\
 from modelr.constants import REFLECTION_MODELS as MODELS
 
 from modelr.web.util import get_figure_data
+from modelr.montecarlo import avo_monte_carlo, correlated_normal
 import numpy as np
-from scipy import arcsin
 
 short_description = (
     "Make a stochastic avo plot using monte carlo " +
@@ -45,6 +45,9 @@ def add_arguments(parser):
                         default='zoeppritz',
                         choices=MODELS.keys(),
                         ) 
+
+    parser.add_argument('seed', type=int, default=None,
+                        help='Random seed, to repeat a simulation')
                                 
 
  
@@ -63,26 +66,7 @@ def make_normal_dist( rock, sample_size, correlation=.8 ):
     :returns: distributions for vp, vs, rho
     """
 
-    #pid = mp.current_process()._identity[0]
-    #np.random.seed(pid)
-    
-    cor = correlation
-
-    # Make three normalized gaussian distributions
-    r = np.matrix( np.random.randn(3,sample_size ) )
-
-    # Define a covariance matrix
-    co_var = np.linalg.cholesky(np.matrix([[1.0,cor,cor],
-                                           [cor,1.0,cor],
-                                           [cor,cor,1.0]]))
-
-    # Apply it to the distributions to add dependence
-    data = co_var * r
-    d1 = (np.array(data[0,:].flat)) * rock.vp_sig  + rock.vp
-    d2 = (np.array(data[1,:].flat)) * rock.vs_sig + rock.vs
-    d3 = (np.array( data[2,:].flat)) * rock.rho_sig + rock.rho
-
-    return (d1,d2,d3)
+    return correlated_normal(rock, sample_size, correlation)
     
 def run_script(args): 
     
@@ -95,10 +79,15 @@ def run_script(args):
 
 
     theta = np.arange(0,90)
-    
-    vp0, vs0, rho0 = make_normal_dist( Rprop0, args.iterations )
-    vp1, vs1, rho1 = make_normal_dist( Rprop1, args.iterations )
-    reflect = []
+
+    # Only summaries and a sample of the curves are kept, so the
+    # iterations can run into the hundreds of thousands. The processes
+    # are the server's --monte-carlo-workers setting.
+    summary = avo_monte_carlo(Rprop0, Rprop1, args.iterations, theta,
+                              args.reflectivity_method, seed=args.seed,
+                              workers=None, bins=15)
+    reflect = summary.samples
+    vp0, vp1 = summary.properties[0], summary.properties[3]
                       
     hist_titles = [[r'$V_\mathrm{P}$' ,  r'$m/s$'],
                     [r'$V_\mathrm{S}$' ,  r'$m/s$'],
@@ -123,21 +112,11 @@ def run_script(args):
     limits = np.array([[ vp_lim, vs_lim, rho_lim ],
                        [ vp_lim, vs_lim, rho_lim ] ])                      
     
-    for i in range( args.iterations ):
-        
-        reflect.append(args.reflectivity_method(vp0[i], vs0[i],
-                                                rho0[i], vp1[i],
-                                                vs1[i], rho1[i],
-                                                theta))
-    reflect = np.array(reflect)
-    reflect = np.nan_to_num(reflect)
-    #temp = np.concatenate( (vp0, rho0, vs0, vp1, rho1, vs1,), axis=0)
-    
-    temp = np.concatenate((vp0, vs0, rho0, vp1, vs1, rho1), axis=0)
-    
-    prop_samples = np.reshape(temp, (6, args.iterations))
-    ave_reflect = np.mean(reflect,axis=0)
-    nbins = 15
+    ave_reflect = summary.curves.mean
+    p10, p90 = summary.curves.percentile(10), summary.curves.percentile(90)
+
+    # Line transparency scales with the number of curves drawn
+    n_drawn = max(len(reflect), 1)
     # DO PLOTTING
         
     plt.figure(figsize = (5,13))
@@ -152,11 +131,12 @@ def run_script(args):
     # histogram plots (ax_3, ax_4, ax_5, ax_6, ax_7, ax_8)
     hist_max = 0
     
-    for k in np.arange(len(prop_samples)):
+    densities = [summary.density(k) for k in range(6)]
+
+    for density, edges in densities:
         
         # find the max bar height of the histogram for scaling the plots
-        hist_max = max(hist_max,max(np.histogram(prop_samples[k],
-                                                 density=True)[0]))
+        hist_max = max(hist_max, np.amax(density))
     
     for j in np.arange(2):
         
@@ -167,15 +147,17 @@ def run_script(args):
                 
             plt.subplot(G[3+i+shift,0])
             
-            plt.hist( prop_samples[i], nbins, 
+            density, edges = densities[i]
+            plt.hist( edges[:-1], edges, weights = density,
                      facecolor = upper_color,
                      histtype='stepfilled', 
-                     alpha = 0.25, density = True
+                     alpha = 0.25
                      )
-            plt.hist( prop_samples[i+(3)], nbins, 
+            density, edges = densities[i+(3)]
+            plt.hist( edges[:-1], edges, weights = density,
                      facecolor = lower_color, 
                      histtype='stepfilled',
-                     alpha = 0.25,density = True
+                     alpha = 0.25
                      )
             temp = plt.gca()
             
@@ -236,21 +218,20 @@ def run_script(args):
     # ax_1 the AVO plot
     #
     plt.subplot(G[0:3,:])
-    critical_angles = []
-    for i in range( args.iterations -1):
-        # Do the AVO template as an underlay
-        # HERE        
-        
-        # Do the plots --> This step might not need to be in a loop
-        plt.plot( theta, reflect[i] ,color = 'grey', lw = 1.0, alpha = np.min((30./args.iterations, 0.08)))
-        if vp1[i] > vp0[i]:
-            theta_crit = arcsin( vp0[i] / vp1[i] )*180/np.pi
-            plt.axvline( x= theta_crit , color='black', lw = 1.0, alpha = np.min((30./args.iterations, 0.5)))
-            critical_angles.append(theta_crit)
 
-    if len(critical_angles) > 0:
-        critical_angle = np.mean(critical_angles)
-    else:
+    # The P10 to P90 band of every iteration, with the sampled curves
+    plt.fill_between( theta, p10, p90, color = 'grey', alpha = 0.25,
+                      lw = 0 )
+    if len(reflect):
+        plt.plot( theta, reflect.T, color = 'grey', lw = 1.0,
+                  alpha = np.min((30./n_drawn, 0.08)))
+
+    faster = vp1 > vp0
+    for theta_crit in np.degrees(np.arcsin(vp0[faster] / vp1[faster])):
+        plt.axvline( x= theta_crit , color='black', lw = 1.0, alpha = np.min((30./n_drawn, 0.5)))
+
+    critical_angle = summary.critical_angle
+    if critical_angle is None:
         critical_angle = 'N/A'
     
     plt.plot( theta, ave_reflect, color='black', alpha = 0.5, lw= 1.5 )
@@ -451,11 +432,9 @@ def run_script(args):
     
     max_ang = int(args.max_angle)  # Max ang for computing gradient
 
-    for i in range( args.iterations -1):
-
-        plt.scatter( reflect[i,0], (reflect[i,max_ang]-reflect[i,0] ),
-                     color = 'grey' , s = 20,
-                     alpha = np.max((30./args.iterations, 0.2)) )
+    plt.scatter( reflect[:,0], (reflect[:,max_ang]-reflect[:,0] ),
+                 color = 'grey' , s = 20,
+                 alpha = np.min((np.max((30./n_drawn, 0.2)), 1.0)) )
                      
     # Plot the average of the dots
     plt.scatter( ave_reflect[0], ave_reflect[max_ang]- ave_reflect[0],
@@ -478,10 +457,14 @@ def run_script(args):
     
     # axis limits
         
-    ylimits = (np.amin((-.3,np.nanmin(reflect[:,50]-reflect[:,0]))),
-              np.amax((.3,np.nanmax(reflect[:,50]-reflect[:,0]))))
-    xlimits = (np.amin((-.3,np.nanmin(reflect[:,0]))),
-              np.amax((.3,np.nanmax(reflect[:,0]))))
+    gradient = np.append(reflect[:,50]-reflect[:,0], 0)
+    intercept = np.append(reflect[:,0], summary.curves.min[0])
+    intercept = np.append(intercept, summary.curves.max[0])
+
+    ylimits = (np.amin((-.3,np.nanmin(gradient))),
+              np.amax((.3,np.nanmax(gradient))))
+    xlimits = (np.amin((-.3,np.nanmin(intercept))),
+              np.amax((.3,np.nanmax(intercept))))
     
     plt.ylim( ylimits )
     
@@ -1,13 +1,152 @@
-from modelr.reflectivity import do_convolve
+from modelr.reflectivity import do_convolve, reflectivity_array
 from modelr.api import ImageModelPersist, Seismic
+from modelr.pipeline import Pipeline, Stage
 from bruges.noise import noise_db
-from bruges.filters import rotate_phase
+from modelr.timedepth import time_maps
+from modelr.wavelets import wavelet_bank
+from modelr.images import image_fetcher
 
 import traceback
 
 import numpy as np
 import sys
 
+###########################################
+# Stages. The pipeline lives in the script namespace, which the server
+# keeps between requests, so a change to the seismic parameters only
+# reruns the convolution and the stages after it.
+
+def load_earth(earth_model, image_version, dt):
+    """
+    Fetch and decode the image and map its colours to rocks. The
+    image version only keys the stage, so a changed image at the same
+    URL is loaded again.
+    """
+    model = ImageModelPersist.from_json(earth_model)
+    if model.domain == 'time':
+        model.resample(dt)
+
+    return model
+
+
+def make_properties(model):
+    """
+    Realize the property grids of the model.
+    """
+    return model.vp, model.vs, model.rho
+
+
+def time_convert(model, properties, dt):
+    """
+    Convert the property grids to two way time.
+    """
+    vp, vs, rho = properties
+
+    if model.domain == 'time':
+        return vp, vs, rho
+
+    return time_maps.get(vp, model.dz, dt).apply(vp, vs, rho)
+
+
+def make_reflectivity(model, properties):
+    """
+    Reflectivity of the time converted grids, [sample, trace, theta].
+    """
+    vp, vs, rho = properties
+
+    return reflectivity_array(vp, vs, rho, model.theta)
+
+
+def convolve(rpp, seismic, trace, offset):
+    """
+    The cross section, wavelet gather and offset gather, without
+    noise.
+    """
+    seismic = Seismic.from_json(seismic)
+
+    data = do_convolve(seismic.src,
+                       rpp[..., offset][..., np.newaxis]).squeeze()
+
+    # Hard coded, could be changed to be part of the seismic object
+    f0 = 4.0
+    f1 = 100.0
+    f = np.logspace(max(np.log2(f0), np.log2(7)),
+                    np.log2(f1), 50,
+                    endpoint=True, base=2.0)
+
+    duration = .3
+    wavelets = wavelet_bank.wavelets(seismic.wavelet, duration,
+                                     seismic.dt, f,
+                                     phase=seismic.phase)
+
+    wavelet_gather = do_convolve(wavelets,
+                                 rpp[..., trace, offset]
+                                 [..., np.newaxis, np.newaxis]).squeeze()
+
+    offset_gather = do_convolve(
+        seismic.src, rpp[..., trace, :][..., np.newaxis, ...]).squeeze()
+
+    return data, wavelet_gather, offset_gather, f
+
+
+def add_noise(gathers, snr):
+    """
+    Add noise to copies of the gathers.
+    """
+    data, wavelet_gather, offset_gather, f = gathers
+
+    if snr:
+        wavelet_gather = wavelet_gather + noise_db(wavelet_gather, snr)
+        offset_gather = offset_gather + noise_db(offset_gather, snr)
+        data = data + noise_db(data, snr)
+
+    return data, wavelet_gather, offset_gather, f
+
+
+def render(model, gathers, dt):
+    """
+    Build the response.
+    """
+    data, wavelet_gather, offset_gather, f = gathers
+
+    # METADATA
+    metadata = {}
+    metadata["moduli"] = {}
+    for rock in model.get_rocks():
+        if rock.name not in metadata["moduli"]:
+            metadata["moduli"][rock.name] = rock.moduli
+
+    if model.domain == "time":
+        dt = model.zrange / float(data.shape[0])
+    else:
+        dt = dt * 1000.0
+
+    # Arrays are serialized by the server, see modelr.web.transport
+    return {"seismic": data.T, "dt": dt,
+            "min": float(np.amin(data)),
+            "max": float(np.amax(data)),
+            "dx": model.dx,
+            "wavelet_gather": wavelet_gather.T,
+            "offset_gather": offset_gather.T,
+            "f": f, "theta": model.theta,
+            "metadata": metadata}
+
+
+pipeline = Pipeline([
+    Stage('earth', load_earth,
+          params=('earth_model', 'image_version', 'dt')),
+    Stage('properties', make_properties, inputs=('earth',)),
+    Stage('time', time_convert, inputs=('earth', 'properties'),
+          params=('dt',)),
+    Stage('reflectivity', make_reflectivity, inputs=('earth', 'time')),
+    Stage('convolution', convolve, inputs=('reflectivity',),
+          params=('seismic', 'trace', 'offset')),
+    Stage('noise', add_noise, inputs=('convolution',),
+          params=('snr',)),
+    Stage('render', render, inputs=('earth', 'noise'),
+          params=('dt',))])
+
+
 def run_script(json_payload):
     """
     Calculates synthetic seismic data from a convolution model.
@@ -25,68 +164,25 @@ def run_script(json_payload):
     try:
 
         seismic = Seismic.from_json(json_payload["seismic"])
-        
-        # parse json
-        earth_model = ImageModelPersist.from_json(json_payload["earth_model"])
-        if earth_model.domain == 'time':
-            earth_model.resample(seismic.dt)
-       
-        trace = json_payload["trace"]
-        offset = json_payload["offset"]
-
-        # seismic
-        data = do_convolve(seismic.src,
-                           earth_model.rpp_t(seismic.dt)[..., offset]
-                           [..., np.newaxis]).squeeze()
-
-        # Hard coded, could be changed to be part of the seismic object
-        f0 = 4.0
-        f1 = 100.0
-        f = np.logspace(max(np.log2(f0), np.log2(7)),
-                        np.log2(f1), 50,
-                        endpoint=True, base=2.0)
-
-        duration = .3
-        wavelets = rotate_phase(seismic.wavelet(duration, seismic.dt, f),
-                                seismic.phase)
-
-        wavelet_gather = do_convolve(wavelets,
-                                     earth_model.rpp_t(seismic.dt)
-                                     [..., trace, offset]
-                                     [..., np.newaxis, np.newaxis]).squeeze()
-        
-        offset_gather = do_convolve(
-            seismic.src, earth_model.rpp_t(seismic.dt)[..., trace, :]
-            [..., np.newaxis, ...]).squeeze()
-
-        if seismic.snr:
-            wavelet_gather += noise_db(wavelet_gather, seismic.snr)
-            offset_gather += noise_db(offset_gather, seismic.snr)
-            data += noise_db(data, seismic.snr)
-
-        # METADATA
-        metadata = {}
-        metadata["moduli"] = {}
-        for rock in earth_model.get_rocks():
-            if rock.name not in metadata["moduli"]:
-                metadata["moduli"][rock.name] = rock.moduli
-
-        if earth_model.domain == "time":
-            dt = earth_model.zrange / float(data.shape[0])
-        else:
-            dt = seismic.dt * 1000.0
-            
-        payload = {"seismic": data.T.tolist(), "dt": dt,
-                   "min": float(np.amin(data)),
-                   "max": float(np.amax(data)),
-                   "dx": earth_model.dx,
-                   "wavelet_gather": wavelet_gather.T.tolist(),
-                   "offset_gather": offset_gather.T.tolist(),
-                   "f": f.tolist(), "theta": earth_model.theta,
-                   "metadata": metadata}
-
-        return payload
-    
+
+        # The noise is added in its own stage
+        wavelet_params = dict((key, value) for key, value
+                              in json_payload["seismic"].items()
+                              if key != 'snr')
+
+        # Revalidates the image, see modelr.images.ImageFetcher
+        version = image_fetcher.version(
+            json_payload["earth_model"]["image"])
+
+        params = {"earth_model": json_payload["earth_model"],
+                  "image_version": version,
+                  "dt": seismic.dt,
+                  "seismic": wavelet_params,
+                  "snr": seismic.snr,
+                  "trace": json_payload["trace"],
+                  "offset": json_payload["offset"]}
+
+        return pipeline.run('render', params)
+
     except Exception as e:
         traceback.print_exc(file=sys.stdout)
-        
@@ -1,78 +1,85 @@
 from modelr.api import Seismic, FluidSub1D
 from bruges.reflection import zoeppritz_rpp as zoep
-from bruges.transform import depth_to_time
-from modelr.reflectivity import do_convolve
+from modelr.reflectivity import do_convolve, reflectivity_array
+from modelr.timedepth import time_maps
 import numpy as np
 
 
 def run_script(json_payload):
+    """
+    Forward models a 1D log before and after fluid substitution.
+
+    json_payload = {"earth_model": See FluidSub1D in modelr.api,
+                    "seismic": See Seismic in modelr.api,
+                    "sw": Optional list of water saturations to
+                          substitute as extra scenarios}
+
+    Every case (original, substituted and each saturation) is
+    carried through time conversion, reflectivity and convolution
+    together as one array indexed as [sample, case, theta].
+    """
 
     # parse json
     fs_model = FluidSub1D.from_json(json_payload["earth_model"])
     seismic = Seismic.from_json(json_payload["seismic"])
+    sw = json_payload.get("sw")
+
+    # stack the cases, indexed as [case, sample]
+    vp, vs, rho = fs_model.substitute()
+    if sw:
+        vp_sw, vs_sw, rho_sw = fs_model.substitute(Sw=sw)
+        vp, vs, rho = (np.concatenate(cases) for cases in
+                       ((vp, vp_sw), (vs, vs_sw), (rho, rho_sw)))
 
-    # extract rock properties
-    vp, vs, rho = (fs_model.vp, fs_model.vs, fs_model.rho)
-    vp_sub, vs_sub, rho_sub = fs_model.smith_sub()
+    vp, vs, rho = (np.concatenate((prop[np.newaxis], cases))
+                   for prop, cases in ((fs_model.vp, vp),
+                                       (fs_model.vs, vs),
+                                       (fs_model.rho, rho)))
 
-    # convert to time
+    # convert to time, with the cases as traces of one map
     dt = seismic.dt
     dz = fs_model.dz
     z = fs_model.z
-    
-    # use indices so we only run the algorithm once
-    index = np.arange(vp.size, dtype=int)
-    t_index = depth_to_time(index, vp, dz, dt).astype(int)
-    sub_t_index = depth_to_time(index, vp_sub, dz, dt).astype(int)
-    vp_t, vs_t, rho_t = (vp[t_index], vs[t_index], rho[t_index])
-    vp_sub_t, vs_sub_t, rho_sub_t = (vp_sub[sub_t_index],
-                                     vs_sub[sub_t_index],
-                                     rho_sub[sub_t_index])
 
-    # calculate reflectivities
-    rpp = np.nan_to_num(np.array([zoep(vp_t[:-1], vs_t[:-1], rho_t[:-1],
-                                       vp_t[1:], vs_t[1:], rho_t[1:],
-                                       float(theta))
-                                  for theta in seismic.theta[::-1]]).T)
+    time_map = time_maps.get(vp.T, dz, dt)
+    vp_t, vs_t, rho_t = time_map.apply(vp.T, vs.T, rho.T)
 
-    rpp_sub = np.nan_to_num(np.array([zoep(vp_sub_t[:-1], vs_sub_t[:-1],
-                                           rho_sub_t[:-1],
-                                           vp_sub_t[1:], vs_sub_t[1:],
-                                           rho_sub_t[1:], float(theta))
-                                      for theta in seismic.theta[::-1]]).T)
+    # calculate reflectivities, indexed as [sample, case, theta]
+    rpp = reflectivity_array(vp_t, vs_t, rho_t,
+                             np.asarray(seismic.theta[::-1], dtype=float),
+                             zoep)
+    t = np.arange(rpp.shape[0]) * dt
 
-    # trim to be the same size
-    n = min(rpp.shape[0], rpp_sub.shape[0])
-    rpp = rpp[:n, :]
-    rpp_sub = rpp_sub[:n, :]
-    t = np.arange(n) * dt
+    # create synthetic seismic, indexed as [case, theta, sample]
+    synth = np.nan_to_num(do_convolve(seismic.src, rpp)[..., 0])
+    synth = np.moveaxis(synth, 0, -1)
+    if synth.shape[1] == 1:
+        synth = synth[:, 0]
 
-    # create synthetic seismic
-    traces = np.squeeze(do_convolve(seismic.src, rpp[:, np.newaxis, :]))
-    sub_traces = np.squeeze(do_convolve(seismic.src,
-                                        rpp_sub[:, np.newaxis, :]))
-
-    output = {"vp": vp.tolist(), "vs": vs.tolist(),
-              "rho": rho.tolist(), "vp_sub": vp_sub.tolist(),
-              "vs_sub": vs_sub.tolist(), "rho_sub": rho_sub.tolist(),
-              "synth": np.nan_to_num(traces).T.tolist(),
-              "synth_sub": np.nan_to_num(sub_traces).T.tolist(),
+    # Arrays are serialized by the server, see modelr.web.transport
+    output = {"vp": vp[0], "vs": vs[0],
+              "rho": rho[0], "vp_sub": vp[1],
+              "vs_sub": vs[1], "rho_sub": rho[1],
+              "synth": synth[0],
+              "synth_sub": synth[1],
               "theta": seismic.theta,
-              "rpp": rpp[:, 0].tolist(),
-              "rpp_sub": rpp_sub[:, 0].tolist(),
+              "rpp": rpp[:, 0, 0],
+              "rpp_sub": rpp[:, 1, 0],
               "t_lim": [float(np.amin(t)), float(np.amax(t))],
               "z_lim": [float(np.amin(z)), float(np.amax(z))],
-              "vp_lim": [float(np.amin((vp, vp_sub))),
-                         float(np.amax((vp, vp_sub)))],
-              "vs_lim": [float(np.amin((vs, vs_sub))),
-                         float(np.amax((vs, vs_sub)))],
-              "rho_lim": [float(np.amin((rho, rho_sub))),
-                          float(np.amax((rho, rho_sub)))],
-              "rpp_lim": [float(np.amin((rpp, rpp_sub))),
-                          float(np.amax((rpp, rpp_sub)))],
-              "synth_lim": [float(np.amin((traces, sub_traces))),
-                            float(np.amax((traces, sub_traces)))],
+              "vp_lim": [float(np.amin(vp)), float(np.amax(vp))],
+              "vs_lim": [float(np.amin(vs)), float(np.amax(vs))],
+              "rho_lim": [float(np.amin(rho)), float(np.amax(rho))],
+              "rpp_lim": [float(np.amin(rpp)), float(np.amax(rpp))],
+              "synth_lim": [float(np.amin(synth)), float(np.amax(synth))],
               "dt": dt,
               "dz": dz}
 
+    if sw:
+        output.update({"sw": list(sw),
+                       "vp_sw": vp[2:], "vs_sw": vs[2:],
+                       "rho_sw": rho[2:],
+                       "synth_sw": synth[2:],
+                       "rpp_sw": rpp[:, 2:, 0].T})
+
     return output
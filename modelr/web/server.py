@@ -1,7 +1,6 @@
 from jinja2 import Environment, PackageLoader
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from argparse import ArgumentParser
-from os import listdir
 from os.path import isfile, join, dirname
 
 import os
@@ -11,16 +10,21 @@ from modelr.web.urlargparse import SendHelp, ArgumentError, \
     URLArgumentParser
 import traceback
 import json
-import multiprocessing as mp
 import ssl
 import socket
 from socketserver import ThreadingMixIn
 
-from modelr.EarthModel import EarthModel
-from modelr.SeismicModel import SeismicModel
-from modelr.ModelrPlot import ModelrPlot
-from modelr.ForwardModel import ForwardModel
-from modelr.ModelrScript import ModelrScript
+from modelr.web.cache import script_cache, script_registry, \
+    ResultCache, result_key, script_version
+from modelr.web import workers
+from modelr.web.workers import WorkerPool, PoolFull, JobTimeout
+from modelr.wavelets import wavelet_bank
+from modelr.reflectivity import interface_cache
+from modelr.store import model_cache
+from modelr.images import image_fetcher
+from modelr.timedepth import time_maps
+from modelr.web.transport import ArrayEncoder, BINARY_TYPE, \
+    encode_binary, negotiate
 
 import base64
 
@@ -65,9 +69,9 @@ class MyHandler(BaseHTTPRequestHandler):
 
         self.server._BaseServer__shutdown_request = True
 
-    def eval_script(self, script, script_type):
+    def script_path(self, script, script_type):
         '''
-        Get the the namespace for a script.
+        Get the path to a script, or send an error if it isn't valid.
         '''
         # If no script was passed, then tell the user
         if not script or len(script) != 1:
@@ -82,7 +86,6 @@ class MyHandler(BaseHTTPRequestHandler):
                                    "or malformed (got %r)" % (script))
             return
 
-        # Otherwise, run the script
         dirn = dirname(__file__)
         script_path = join(dirn, 'scripts', script_type[0], script[0])
 
@@ -91,11 +94,7 @@ class MyHandler(BaseHTTPRequestHandler):
                                    "valid script " % (script[0],))
             return
 
-        namespace = {}
-        with open(script_path, 'r') as fd:
-            exec(fd.read(), namespace)
-
-        return namespace
+        return script_path
 
     def do_OPTIONS(self):
         self.send_response(200)
@@ -126,10 +125,11 @@ class MyHandler(BaseHTTPRequestHandler):
                 script = parameters.pop('script', None)
                 script_type = parameters.pop('type', None)
 
-                namespace = self.eval_script(script, script_type)
-                if namespace is None:
-                    self.send_response(400)
-                    self.end_headers()
+                script_path = self.script_path(script, script_type)
+                if script_path is None:
+                    return
+
+                json_data = script_registry.schema(script_path)
 
                 self.send_response(200)
                 self.send_header('Access-Control-Allow-Origin', '*')
@@ -138,16 +138,32 @@ class MyHandler(BaseHTTPRequestHandler):
                 self.send_header('Content-type', 'application/json')
                 self.end_headers()
 
-                script_main = namespace['run_script']
-                add_arguments = namespace['add_arguments']
-                short_description = namespace.get('short_description',
-                                                  'No description')
+                self.wfile.write(json_data.encode())
+
+                return
+
+            # report the server cache counters
+            if uri.path == '/cache_stats.json':
+                self.send_response(200)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+
+                stats = {"scripts": script_cache.stats(),
+                         "registry": script_registry.stats(),
+                         "wavelets": wavelet_bank.stats(),
+                         "interfaces": interface_cache.stats(),
+                         "models": model_cache.stats(),
+                         "images": image_fetcher.stats(),
+                         "time_maps": time_maps.stats()}
 
-                parser = URLArgumentParser(short_description)
-                add_arguments(parser)
+                results = getattr(self.server, 'result_cache', None)
+                if results is not None:
+                    stats["results"] = results.stats()
 
-                self.wfile.write(parser.json_data)
+                data = json.dumps(stats)
 
+                self.wfile.write(data.encode())
                 return
 
             # list the available scripts
@@ -175,19 +191,17 @@ class MyHandler(BaseHTTPRequestHandler):
                 script = parameters.pop("script", None)
                 script_type = parameters.pop("type", None)
 
-                # Get the namespace
-                namespace = self.eval_script(script, script_type)
-                if namespace is None:
+                script_path = self.script_path(script, script_type)
+                if script_path is None:
                     return
 
-                plot_generator = ModelrScript(parameters, namespace)
+                key = result_key('plot', script_path,
+                                 script_version(script_path),
+                                 self.parse_args(script_path,
+                                                 parameters))
 
-                # Run in sub-process to prevent memory hogging
-                # p = mp.Process(target=self.run_script_jpg_json,
-                #                args=(plot_generator,))
-                # p.start()
-                # p.join()
-                self.run_script_jpg_json(plot_generator)
+                self.run_script_jpg_json(key, workers.script_jpg_json,
+                                         script_path, parameters)
 
             # Outputs json data
             elif uri.path == '/data.json':
@@ -197,49 +211,35 @@ class MyHandler(BaseHTTPRequestHandler):
 
                 print("running", script, script_type)
                 payload = json.loads(parameters.pop("payload")[0])
+                fmt = negotiate(self.headers.get('Accept'), parameters)
 
-                # Get the namespace
-                namespace = self.eval_script(script, script_type)
-                if namespace is None:
+                script_path = self.script_path(script, script_type)
+                if script_path is None:
                     return
 
-                # payload = json.parse(parameters["payload"])
-                script_main = namespace["run_script"]
-
-                # Run in sub-process to prevent memory hogging
-                # p = mp.Process(target=self.run_script_json,
-                #                args=(script_main, payload))
-                # p.start()
-                # p.join()
-                self.run_script_json(script_main, payload)
+                self.run_script_json(script_path, payload, fmt)
 
             # Output only an image
             elif uri.path == '/plot.jpeg':
                 script = parameters.pop('script', None)
                 script_type = parameters.pop('type', None)
-                namespace = self.eval_script(script, script_type)
-                if namespace is None:
+
+                script_path = self.script_path(script, script_type)
+                if script_path is None:
                     return
 
-                script_main = namespace['run_script']
-                add_arguments = namespace['add_arguments']
-                short_description = namespace.get('short_description',
-                                                  'No description')
-                # "parameters", parameters
-                # p = mp.Process(target=self.run_script_jpg,
-                #                args=(script[0], script_main,
-                #                      add_arguments, short_description,
-                #                      parameters))
-                # p.start()
-                # p.join()
-                self.run_script_jpg(script[0], script_main,
-                                     add_arguments, short_description,
-                                     parameters)
+                self.run_script_jpg(script[0], script_path, parameters)
 
             else:
                 self.send_error(404, 'File Not Found: %s' % self.path)
                 return
 
+        except PoolFull:
+            self.send_error(503, 'Server busy, try again later')
+
+        except JobTimeout:
+            self.send_error(504, 'Request took too long: %s' % self.path)
+
         except Exception:
             self.send_response(400)
             self.send_header('Content-type', 'text/html')
@@ -255,20 +255,58 @@ class MyHandler(BaseHTTPRequestHandler):
             self.wfile.write('</div>'.encode())
             raise
 
-    def run_script_jpg(self, script, script_main, add_arguments,
-                       short_description, parameters):
+    def run_job(self, job, *args):
+        '''
+        Run a job in the worker pool, or in this thread if the server
+        doesn't have one.
+
+        :param job: A job function from modelr.web.workers
+        '''
+
+        pool = getattr(self.server, 'pool', None)
+        if pool is None:
+            return job(*args)
+
+        return pool.apply(job, args)
+
+    def parse_args(self, script_path, parameters):
+        '''
+        Parse the parameters of a request with the arguments of a
+        script, leaving the parameters untouched.
+
+        :param script_path: the path to the script
+        :param parameters: the parameters for the script
+
+        :returns: the parsed Namespace.
+        '''
+        namespace = script_cache.load(script_path)
+
+        parser = URLArgumentParser(namespace.get('short_description',
+                                                 'No description'))
+        namespace['add_arguments'](parser)
+
+        return parser.parse_params(dict(parameters))
+
+    def run_script_jpg(self, script, script_path, parameters):
         '''
         Run a script that returns a jpeg
 
-        :param script_main: the main method of the script
-        :param add_arguments: poplate an argument parser
-        :param short_description: a short description of the script
+        :param script: the name of the script
+        :param script_path: the path to the script
         :param parameters: the parameters from the get request
         '''
+        namespace = script_cache.load(script_path)
+
+        add_arguments = namespace['add_arguments']
+        short_description = namespace.get('short_description',
+                                          'No description')
+
         parser = URLArgumentParser(short_description)
         add_arguments(parser)
         try:
-            args = parser.parse_params(parameters)
+            # Check the arguments here so help and errors don't take
+            # up a worker
+            parser.parse_params(dict(parameters))
         except SendHelp:
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
@@ -291,7 +329,8 @@ class MyHandler(BaseHTTPRequestHandler):
             self.wfile.write(parser.help_html.encode())
             return
 
-        jpeg_data = script_main(args)[0]
+        jpeg_data = self.run_job(workers.script_jpg, script_path,
+                                 parameters)
 
         self.send_response(200)
         self.send_header('Content-type', 'image/png')
@@ -301,35 +340,70 @@ class MyHandler(BaseHTTPRequestHandler):
 
         del jpeg_data
 
-    def run_script_json(self, script, payload):
+    def run_script_json(self, script_path, payload, fmt='json'):
+        '''
+        Run a script that returns data and write it out as JSON, or
+        as a binary frame of arrays.
+
+        :param script_path: the path to the script
+        :param payload: the json payload for the script
+        :keyword fmt: 'json', or 'float32' or 'int16' for a binary
+                      frame. See modelr.web.transport.
+        '''
+
+        data = self.run_job(workers.script_json, script_path, payload)
+
+        if fmt == 'json':
+            content_type = 'application/json'
+            chunks = [json.dumps(data, cls=ArrayEncoder).encode()]
+        else:
+            content_type = BINARY_TYPE
+            chunks = encode_binary(data, quantize=(fmt == 'int16'))
 
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Headers',
-                         'X-Request, X-Requested-With')
-        self.send_header('Content-type', 'application/json')
+                         'X-Request, X-Requested-With, Accept')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length',
+                         str(sum(len(chunk) for chunk in chunks)))
+        self.send_header('Vary', 'Accept')
         self.end_headers()
 
-        data = script(payload)
-
         # Write response
-        self.wfile.write(json.dumps(data).encode())
+        for chunk in chunks:
+            self.wfile.write(chunk)
 
-    def run_script_jpg_json(self, plot_generator):
+    def run_script_jpg_json(self, key, job, *args):
         """
         Runs a script and writes out a JSON response with
         a base64 encoded jpeg and json metadata
+
+        :param key: The result_key of the request, or None if the
+                    result can't be cached.
+        :param job: A job function from modelr.web.workers
         """
+        results = getattr(self.server, 'result_cache', None)
+
+        cached = None
+        if results is not None and key is not None:
+            cached = results.get(key)
+
+        if cached is not None:
+            image_data, metadata = cached
+        else:
+            # Run the script
+            image_data, metadata = self.run_job(job, *args)
 
-        # Run the script
-        image_data, metadata = plot_generator.go()
+            if results is not None and key is not None:
+                results.put(key, image_data, metadata)
 
         # Encode for http send
-        encoded_image = base64.b64encode(image_data)
+        encoded_image = base64.b64encode(image_data).decode()
 
         # convert to json
         data = json.dumps({'data': encoded_image,
-                           'metadata': metadata})
+                           'metadata': metadata}, cls=ArrayEncoder)
 
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -341,6 +415,41 @@ class MyHandler(BaseHTTPRequestHandler):
         # Write response
         self.wfile.write(data.encode())
 
+    def forward_model_key(self, parameters, earth_path, seismic_path,
+                          plot_path):
+        '''
+        Returns the result_key of a forward model request, or None if
+        the request can't be cached.
+
+        Requests that update the model write the reflectivity data
+        file as a side effect, so they always run. The others read the
+        data file, which is part of the key along with the version of
+        each script.
+        '''
+        earth_structure = parameters["earth_model"]
+
+        if earth_structure.get('update_model', None):
+            return None
+
+        try:
+            stat = os.stat(model_cache.path(earth_structure["datafile"]))
+            datafile = (stat.st_mtime_ns, stat.st_size)
+        except (KeyError, ValueError, OSError):
+            datafile = None
+
+        earth = dict((name, value) for name, value
+                     in earth_structure.items() if name != 'arguments')
+
+        return result_key(
+            'forward_model', earth, datafile,
+            earth_path, script_version(earth_path),
+            self.parse_args(earth_path, earth_structure["arguments"]),
+            seismic_path, script_version(seismic_path),
+            self.parse_args(seismic_path,
+                            parameters["seismic_model"]["args"]),
+            plot_path, script_version(plot_path),
+            self.parse_args(plot_path, parameters["plots"]["args"]))
+
     def get_available_scripts(self, script_type=None):
         '''
         Returns a list of all the scripts in the scripts directory.
@@ -350,30 +459,7 @@ class MyHandler(BaseHTTPRequestHandler):
             # "++++++++++++++++++++++++++++++++++++"
             return
 
-        scripts_dir = join(dirname(__file__), 'scripts',
-                           script_type[0])
-
-        available_scripts = []
-        for script in listdir(scripts_dir):
-            try:
-                if script == '__init__.py':
-                    continue
-                elif not script.endswith('.py'):
-                    continue
-
-                namespace = {}
-                with open(join(scripts_dir, script), 'r') as fd:
-                    exec(fd.read(), namespace)
-
-
-                short_doc = namespace.get('short_description',
-                                          'No doc')
-                # script, namespace
-                available_scripts.append((script, short_doc))
-            except Exception as e:
-                print(script, e)
-
-        return available_scripts
+        return script_registry.available(script_type[0])
 
     def send_script_error(self, msg):
         '''
@@ -398,49 +484,38 @@ class MyHandler(BaseHTTPRequestHandler):
 
         if uri.path == '/forward_model.json':
 
-            content_len = int(self.headers.getheader('content-length'))
+            content_len = int(self.headers.get('content-length'))
             raw_json = self.rfile.read(content_len)
 
             parameters = json.loads(raw_json)
 
             earth_script = parameters["earth_model"].pop("script",
                                                          None)
-            earth_namespace = self.eval_script([earth_script],
-                                               ['earth'])
-
-            earth_model = EarthModel(parameters["earth_model"],
-                                     earth_namespace)
+            earth_path = self.script_path([earth_script], ['earth'])
 
             seismic_script = parameters["seismic_model"].pop("script",
                                                              None)
-
-            seismic_namespace = self.eval_script([seismic_script],
-                                                 ['seismic'])
-
-            seismic_model = SeismicModel(parameters["seismic_model"]["args"],
-                                         seismic_namespace)
+            seismic_path = self.script_path([seismic_script],
+                                            ['seismic'])
 
             plot_script = parameters["plots"].pop("script", None)
-            plot_namespace = self.eval_script([plot_script],
-                                              ['plots'])
-
-            plots = ModelrPlot(parameters["plots"]["args"],
-                               plot_namespace)
-
-            forward_model = ForwardModel(earth_model, seismic_model,
-                                         plots)
+            plot_path = self.script_path([plot_script], ['plots'])
 
-            # prof.runctx('self.run_json(forward_model)',
-            #            {'self': self, 'forward_model':forward_model},
-            #            {},
-            #            'profile.test')
-
-            # p = mp.Process(target=self.run_script_jpg_json,
-            #                args=(forward_model,))
+            if None in (earth_path, seismic_path, plot_path):
+                return
 
-            # p.start()
-            # p.join()
-            self.run_script_jpg_json(forward_model)
+            try:
+                key = self.forward_model_key(parameters, earth_path,
+                                             seismic_path, plot_path)
+
+                self.run_script_jpg_json(key, workers.forward_model,
+                                         parameters, earth_path,
+                                         seismic_path, plot_path)
+            except PoolFull:
+                self.send_error(503, 'Server busy, try again later')
+            except JobTimeout:
+                self.send_error(504, 'Request took too long: %s'
+                                % self.path)
 
             return
 
@@ -450,11 +525,11 @@ class MyHandler(BaseHTTPRequestHandler):
             self.send_header("Access-Control-Allow-Origin", "*")
             self.end_headers()
 
-            content_len = int(self.headers.getheader('content-length'))
+            content_len = int(self.headers.get('content-length'))
             raw_json = self.rfile.read(content_len)
 
             parameters = json.loads(raw_json)
-            os.remove(str(parameters["filename"]))
+            model_cache.remove(parameters["filename"])
 
             return
 
@@ -481,6 +556,43 @@ def main():
     parser.add_argument('-p', '--port', type=int, default=80)
 
     parser.add_argument('--local', type=bool, default=False)
+
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes for the '
+                        'modelling scripts, 0 to run them in the '
+                        'request threads')
+    parser.add_argument('--monte-carlo-workers', type=int, default=1,
+                        help='processes shared by the Monte Carlo '
+                        'simulations of each server process, 1 to run '
+                        'them in the request')
+    parser.add_argument('--worker-jobs', type=int, default=100,
+                        help='jobs a worker runs before it is replaced')
+    parser.add_argument('--worker-rss', type=float, default=1024,
+                        help='replace a worker above this memory [MB]')
+    parser.add_argument('--job-timeout', type=float, default=120,
+                        help='time limit for a single job [s]')
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='jobs that can wait for a worker before '
+                        'the server answers 503')
+    parser.add_argument('--result-cache', type=float, default=256,
+                        help='memory for cached plot results [MB], '
+                        '0 to disable')
+    parser.add_argument('--result-cache-dir', type=str, default=None,
+                        help='directory to keep plot results in')
+    parser.add_argument('--result-cache-disk', type=float, default=1024,
+                        help='disk space for plot results [MB]')
+    parser.add_argument('--result-cache-ttl', type=float, default=None,
+                        help='remove plot results unused for this '
+                        'long [s]')
+    parser.add_argument('--model-cache-dir', type=str,
+                        default=model_cache.directory,
+                        help='directory to keep model data files in')
+    parser.add_argument('--model-cache-size', type=float,
+                        default=model_cache.max_bytes / 2**20,
+                        help='disk space for model data files [MB]')
+    parser.add_argument('--model-cache-ttl', type=float, default=None,
+                        help='remove model data files unused for this '
+                        'long [s]')
     args = parser.parse_args()
     try:
         # This provides SSL, serving over HTTPS.
@@ -512,6 +624,39 @@ def main():
         server.jenv = Environment(loader=PackageLoader('modelr',
                                                        'web/templates'))
 
+        # Workers read the model cache and Monte Carlo settings from
+        # the environment
+        os.environ['MODELR_MONTE_CARLO_WORKERS'] = \
+            str(args.monte_carlo_workers)
+        os.environ['MODELR_MODEL_CACHE'] = args.model_cache_dir
+        os.environ['MODELR_MODEL_CACHE_SIZE'] = str(args.model_cache_size)
+        if args.model_cache_ttl is not None:
+            os.environ['MODELR_MODEL_CACHE_TTL'] = \
+                str(args.model_cache_ttl)
+        model_cache.configure(args.model_cache_dir,
+                              max_bytes=int(args.model_cache_size *
+                                            2**20),
+                              ttl=args.model_cache_ttl)
+        model_cache.evict()
+
+        if args.workers > 0:
+            server.pool = WorkerPool(processes=args.workers,
+                                     max_jobs=args.worker_jobs,
+                                     max_rss=args.worker_rss * 2**20,
+                                     timeout=args.job_timeout,
+                                     queue_size=args.queue_size)
+        else:
+            server.pool = None
+
+        if args.result_cache > 0:
+            server.result_cache = ResultCache(
+                max_bytes=int(args.result_cache * 2**20),
+                directory=args.result_cache_dir,
+                disk_bytes=int(args.result_cache_disk * 2**20),
+                disk_ttl=args.result_cache_ttl)
+        else:
+            server.result_cache = None
+
         print('started httpserver...')
         server.serve_forever()
 
@@ -519,6 +664,9 @@ def main():
         print('^C received, shutting down server')
         server.socket.close()
 
+        if server.pool is not None:
+            server.pool.close()
+
 
 if __name__ == '__main__':
     main()
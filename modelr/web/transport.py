@@ -0,0 +1,186 @@
+'''
+======================
+modelr.web.transport
+======================
+
+Encoding of script results that hold NumPy arrays, either as plain
+JSON or as a framed binary body.
+
+The binary frame is laid out as::
+
+    b'MRA1' | header length (uint32 LE) | JSON header | buffers
+
+The JSON header is the script result with every array replaced by a
+descriptor {"__array__": [offset, nbytes], "dtype": "<f4",
+"shape": [...]} and, for quantized arrays, a "scale" to multiply the
+integers by. Offsets are from the start of the buffers section, which
+starts and is padded on 8 byte boundaries so clients can view each
+buffer without copying.
+'''
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'MRA1'
+BINARY_TYPE = 'application/x-modelr-arrays'
+FORMATS = ('json', 'float32', 'int16')
+
+_ALIGN = 8
+
+
+class ArrayEncoder(json.JSONEncoder):
+    '''
+    JSON encoder that writes NumPy arrays and scalars as lists and
+    numbers.
+    '''
+
+    def default(self, obj):
+
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+
+        return json.JSONEncoder.default(self, obj)
+
+
+def negotiate(accept, parameters):
+    '''
+    Choose the response format of a request.
+
+    :param accept: The Accept header of the request.
+    :param parameters: The parsed query string. A 'format' entry is
+                       removed and takes precedence over the header.
+
+    :returns: one of 'json', 'float32' or 'int16'.
+    '''
+
+    fmt = parameters.pop('format', [None])[0]
+
+    if fmt is None:
+        fmt = 'float32' if BINARY_TYPE in (accept or '') else 'json'
+
+    if fmt not in FORMATS:
+        raise ValueError('format must be one of %r (got %r)'
+                         % (FORMATS, fmt))
+
+    return fmt
+
+
+def _pad(n):
+    return -n % _ALIGN
+
+
+def _prepare(obj, buffers, offset, quantize):
+    '''
+    Replace the arrays in obj by descriptors, collecting the buffers.
+    '''
+
+    if isinstance(obj, dict):
+        out = {}
+        for key, value in obj.items():
+            out[key], offset = _prepare(value, buffers, offset, quantize)
+        return out, offset
+
+    if isinstance(obj, (list, tuple)):
+        out = []
+        for value in obj:
+            value, offset = _prepare(value, buffers, offset, quantize)
+            out.append(value)
+        return out, offset
+
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in 'biuf':
+
+        descriptor = {"shape": list(obj.shape)}
+
+        if quantize and obj.dtype.kind == 'f':
+            data = np.nan_to_num(obj)
+            peak = float(np.amax(np.abs(data))) if data.size else 0.0
+            scale = peak / 32767.0 if peak > 0 else 1.0
+
+            array = np.ascontiguousarray(np.round(data / scale),
+                                         dtype='<i2')
+            descriptor["scale"] = scale
+        else:
+            array = np.ascontiguousarray(obj, dtype='<f4')
+
+        descriptor["dtype"] = array.dtype.str
+        descriptor["__array__"] = [offset, array.nbytes]
+
+        buffers.append(array)
+        return descriptor, offset + array.nbytes + _pad(array.nbytes)
+
+    if isinstance(obj, np.generic):
+        return obj.item(), offset
+
+    return obj, offset
+
+
+def encode_binary(data, quantize=False):
+    '''
+    Encode a result holding NumPy arrays as a binary frame.
+
+    :param data: A JSON serializable structure that may contain
+                 NumPy arrays.
+    :keyword quantize: Store float arrays as int16 with a scale
+                       rather than float32.
+
+    :returns: a list of bytes-like chunks to write out in order. The
+              array chunks are views of NumPy memory.
+    '''
+
+    buffers = []
+    header, _ = _prepare(data, buffers, 0, quantize)
+
+    header = json.dumps(header).encode()
+    length = len(MAGIC) + 4 + len(header)
+
+    chunks = [MAGIC, struct.pack('<I', len(header)),
+              header + b' ' * _pad(length)]
+
+    for array in buffers:
+        chunks.append(memoryview(array).cast('B'))
+        if _pad(array.nbytes):
+            chunks.append(b'\0' * _pad(array.nbytes))
+
+    return chunks
+
+
+def decode_binary(body):
+    '''
+    Decode a binary frame made by encode_binary.
+
+    :param body: The bytes of the frame.
+
+    :returns: the result with float64 NumPy arrays in place of the
+              array descriptors.
+    '''
+
+    if body[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a modelr array frame')
+
+    length, = struct.unpack('<I', body[len(MAGIC):len(MAGIC) + 4])
+    start = len(MAGIC) + 4
+    header = json.loads(body[start:start + length].decode())
+
+    start += length
+    start += _pad(start)
+
+    def restore(obj):
+        if isinstance(obj, dict):
+            if "__array__" in obj:
+                offset, nbytes = obj["__array__"]
+                array = np.frombuffer(body, dtype=obj["dtype"],
+                                      count=nbytes // np.dtype(
+                                          obj["dtype"]).itemsize,
+                                      offset=start + offset)
+                array = array.reshape(obj["shape"]).astype(float)
+                return array * obj.get("scale", 1.0)
+            return {key: restore(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [restore(value) for value in obj]
+        return obj
+
+    return restore(header)
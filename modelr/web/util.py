@@ -13,7 +13,8 @@ import matplotlib.pyplot as plt
 from bruges.filters import ricker
 import numpy as np
 from scipy.signal import hilbert
-from modelr.reflectivity import get_reflectivity, do_convolve
+from modelr.reflectivity import interface_cache
+from modelr.wavelets import wavelet_bank
 
 import tempfile
 import io
@@ -51,6 +52,68 @@ def get_figure_data(transparent=False):
     return data
 
 
+def draw_wiggles(axes, data, t, positions=0, scale=1.0, threshold=0.0,
+                 line_colour='black', fill_colour='black',
+                 line_alpha=1.0, fill_alpha=0.5, lwidth=None):
+    """
+    Draws wiggle traces as one line collection and one collection of
+    fill polygons.
+
+    Each trace is drawn at position + scale * trace and filled back to
+    its position where scale * trace > threshold.
+
+    :param axes: The axes to draw on.
+    :param data: as a 2D array indexed as [samples, traces], or a
+                 single trace. Not modified.
+    :param t: The vertical coordinate of each sample.
+    :param positions: The horizontal position of each trace.
+    :param scale: Scaling factor for the traces.
+    :param threshold: Fill where the scaled trace is above this.
+    :param lwidth: width of line
+
+    :returns: the LineCollection and PolyCollection.
+    """
+    from matplotlib.collections import LineCollection, PolyCollection
+
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+
+    t = np.asarray(t, dtype=float)
+    ntraces = data.shape[1]
+
+    base = np.broadcast_to(np.asarray(positions, dtype=float),
+                           (ntraces,))
+    scaled = scale * data.T
+    x = base[:, np.newaxis] + scaled
+    tt = np.broadcast_to(t, x.shape)
+
+    lines = np.stack((x, tt), axis=-1)
+
+    # Close each trace back to its position at both ends, with the
+    # samples outside the fill moved onto the position
+    fill_x = np.where(scaled > threshold, x, base[:, np.newaxis])
+    polygons = np.empty((ntraces, t.size + 2, 2))
+    polygons[:, 1:-1, 0] = fill_x
+    polygons[:, 1:-1, 1] = tt
+    polygons[:, 0, 0] = polygons[:, -1, 0] = base
+    polygons[:, 0, 1] = t[0]
+    polygons[:, -1, 1] = t[-1]
+
+    line_collection = LineCollection(lines, colors=line_colour,
+                                     linewidths=lwidth,
+                                     alpha=line_alpha)
+    fill_collection = PolyCollection(polygons, facecolors=fill_colour,
+                                     edgecolors='none',
+                                     alpha=fill_alpha)
+
+    axes.add_collection(fill_collection, autolim=False)
+    axes.add_collection(line_collection)
+    axes.autoscale_view()
+
+    return line_collection, fill_collection
+
+
 def wiggle(data, tstart, dt=1, line_colour='black',
            fill_colour='blue',
            opacity=0.5, skipt=0, gain=1, lwidth=.5, xax=1,
@@ -67,27 +130,27 @@ def wiggle(data, tstart, dt=1, line_colour='black',
     """
     t = (np.arange(data.shape[0]) * dt * 1000) + tstart
 
-    # Need to resample this time axis to the same size as data.shape[1]
+    index = np.arange(0, data.shape[1], skipt + 1)
 
-    for i in range(0, data.shape[1], skipt + 1):
+    # make the traces start and end at zero
+    traces = np.array(data[:, index], dtype=float)
+    traces[0] = 0
+    traces[-1] = 0
 
-        trace = data[:, i]
+    scaler = ((np.amax(xax) - np.amin(xax)) /
+              float(np.size(xax))) # scale for window
 
-        trace[0] = 0      # make trace start at zero
-        trace[-1] = 0     # make trace end at zero
-        new_trace = gain * (trace / np.amax(data))   # gain
+    axes = quadrant.gca() if quadrant is plt else quadrant
 
-        scaler = ((np.amax(xax) - np.amin(xax)) /
-                  float(len(xax))) # scale for window
+    draw_wiggles(axes, traces, t,
+                 positions=index * scaler + np.amin(xax),
+                 scale=gain * scaler / np.amax(data),
+                 line_colour=line_colour, fill_colour=fill_colour,
+                 line_alpha=opacity, fill_alpha=opacity,
+                 lwidth=lwidth)
 
-        quadrant.plot((i + new_trace) * scaler + min(xax),
-                      t, color=line_colour,
-                      linewidth=lwidth, alpha=opacity)
+    axes.axis('tight')
 
-        quadrant.fill_betweenx(t, ((i + new_trace) * scaler)+min(xax), (i * scaler)+min(xax) ,  new_trace > 0,
-                         color=fill_colour, alpha=opacity, lw=0)
-                
-        quadrant.axis('tight')
 
 def modelr_plot(model, colourmap, args):
     """
@@ -167,22 +230,21 @@ model to physical rock properties.
 
     
     ############################
-    # Get reflectivities
-    reflectivity = get_reflectivity( data=model,
-                                     colourmap=colourmap,
-                                     theta=theta,
-                                     reflectivity_method = \
-                                       args.reflectivity_method
-                                    )
+    # Get reflectivities. Only the interfaces of rocks that changed
+    # since the last request for this model are computed again.
+    earth, properties = interface_cache.get( model, colourmap,
+                                             theta=theta,
+                                             reflectivity_method = \
+                                               args.reflectivity_method
+                                            )
 
     # Do convolution
-    if ( ( duration / dt ) > ( reflectivity.shape[0] ) ):
-        duration = reflectivity.shape[0] * dt
-    wavelet = args.wavelet( duration, dt, f, return_t=False )
-    if( wavelet.ndim == 1 ): wavelet = \
-      wavelet.reshape( ( wavelet.size, 1 ) )
-     
-    warray_amp = do_convolve( wavelet, reflectivity )
+    if ( ( duration / dt ) > ( model.shape[0] ) ):
+        duration = model.shape[0] * dt
+    wavelet = wavelet_bank.wavelets( args.wavelet, duration, dt, f )
+
+    reflectivity, warray_amp = earth.model( properties, wavelet )
+    reflectivity = reflectivity.todense()
 
     nsamps, ntraces, ntheta, n_wavelets = warray_amp.shape
 
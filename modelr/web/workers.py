@@ -0,0 +1,317 @@
+'''
+====================
+modelr.web.workers
+====================
+
+A pool of prewarmed worker processes for running the CPU bound
+modelling scripts outside of the request threads.
+'''
+
+import os
+import queue
+import threading
+import traceback
+from importlib import import_module
+import multiprocessing as mp
+
+from modelr.web.cache import script_cache
+from modelr.web.urlargparse import URLArgumentParser
+
+# Modules imported by each worker before it takes any jobs
+PREWARM = ('numpy', 'scipy.signal', 'h5py', 'bruges',
+           'modelr.ForwardModel', 'matplotlib.pyplot',
+           'modelr.web.util', 'modelr.api')
+
+
+class PoolFull(Exception):
+    '''
+    Raised when the job queue of the pool is full.
+    '''
+
+
+class JobTimeout(Exception):
+    '''
+    Raised when a job runs longer than the pool timeout.
+    '''
+
+
+class WorkerError(Exception):
+    '''
+    Raised when a worker dies while running a job.
+    '''
+
+
+###########################################
+# Jobs. These run inside the worker processes, so they take script
+# paths and raw parameters rather than namespaces.
+
+def script_json(script_path, payload):
+    '''
+    Run a script that returns a JSON serializable structure.
+    '''
+
+    namespace = script_cache.load(script_path)
+
+    return namespace['run_script'](payload)
+
+
+def script_jpg(script_path, parameters):
+    '''
+    Run a script that returns an image.
+    '''
+
+    namespace = script_cache.load(script_path)
+
+    parser = URLArgumentParser(namespace.get('short_description',
+                                             'No description'))
+    namespace['add_arguments'](parser)
+    args = parser.parse_params(parameters)
+
+    return namespace['run_script'](args)[0]
+
+
+def script_jpg_json(script_path, parameters):
+    '''
+    Run a script that returns an image and metadata.
+    '''
+    from modelr.ModelrScript import ModelrScript
+
+    namespace = script_cache.load(script_path)
+
+    return ModelrScript(parameters, namespace).go()
+
+
+def forward_model(parameters, earth_path, seismic_path, plot_path):
+    '''
+    Run the forward model pipeline and return an image and metadata.
+    '''
+    from modelr.EarthModel import EarthModel
+    from modelr.SeismicModel import SeismicModel
+    from modelr.ModelrPlot import ModelrPlot
+    from modelr.ForwardModel import ForwardModel
+
+    earth_model = EarthModel(parameters["earth_model"],
+                             script_cache.load(earth_path))
+
+    seismic_model = SeismicModel(parameters["seismic_model"]["args"],
+                                 script_cache.load(seismic_path))
+
+    plots = ModelrPlot(parameters["plots"]["args"],
+                       script_cache.load(plot_path))
+
+    return ForwardModel(earth_model, seismic_model, plots).go()
+
+
+###########################################
+# Pool
+
+def _rss():
+    '''
+    Returns the resident memory of this process in bytes.
+    '''
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _worker_main(conn, prewarm):
+    '''
+    Main loop of a worker process.
+    '''
+
+    for name in prewarm:
+        try:
+            import_module(name)
+        except ImportError:
+            pass
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+
+        if job is None:
+            break
+
+        func, args = job
+        try:
+            result = ('ok', func(*args))
+        except Exception as e:
+            traceback.print_exc()
+            result = ('error', e)
+
+        try:
+            conn.send(result + (_rss(),))
+        except Exception:
+            # The result or exception couldn't be pickled
+            conn.send(('error', WorkerError(traceback.format_exc()),
+                       _rss()))
+
+
+class _Worker(object):
+
+    def __init__(self, process, conn):
+
+        self.process = process
+        self.conn = conn
+        self.jobs = 0
+
+    def stop(self):
+
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(1)
+
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+        self.conn.close()
+
+    def kill(self):
+
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool(object):
+    '''
+    A fixed number of prewarmed worker processes.
+
+    Jobs are module level functions that are called in a worker with
+    picklable arguments. Workers are recycled after max_jobs jobs or
+    once their resident memory goes over max_rss bytes, and killed if
+    a job runs longer than the timeout. At most processes + queue_size
+    jobs can be pending at once.
+
+    :keyword processes: The number of worker processes.
+    :keyword max_jobs: The number of jobs a worker runs before it is
+                       replaced.
+    :keyword max_rss: Replace a worker when its resident memory is
+                      over this many bytes. None to disable.
+    :keyword timeout: Default time limit for a job [s].
+    :keyword queue_size: Jobs that can wait for a free worker.
+    :keyword prewarm: Modules to import in each worker at start up.
+    '''
+
+    def __init__(self, processes=2, max_jobs=100, max_rss=None,
+                 timeout=120.0, queue_size=16, prewarm=PREWARM):
+
+        self.processes = processes
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.prewarm = prewarm
+
+        self._context = mp.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(processes + queue_size)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+
+        self.jobs = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.recycled = 0
+
+        for i in range(processes):
+            self._idle.put(self._start())
+
+    def _start(self):
+
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main,
+                                        args=(child_conn, self.prewarm))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+
+        return _Worker(process, conn)
+
+    def _count(self, counter):
+
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def apply(self, func, args=(), timeout=None):
+        '''
+        Run a job in a worker and return its result. Exceptions raised
+        by the job are raised again here.
+
+        :param func: A module level function.
+        :keyword args: Arguments for the function.
+        :keyword timeout: Time limit for this job [s]. Defaults to the
+                          pool timeout.
+        '''
+
+        if timeout is None:
+            timeout = self.timeout
+
+        if not self._slots.acquire(False):
+            self._count('rejected')
+            raise PoolFull('all %d workers are busy' % self.processes)
+
+        try:
+            worker = self._idle.get()
+
+            try:
+                worker.conn.send((func, args))
+                if not worker.conn.poll(timeout):
+                    worker.kill()
+                    self._idle.put(self._start())
+                    self._count('timeouts')
+                    raise JobTimeout('job took longer than %ss'
+                                     % timeout)
+
+                status, value, rss = worker.conn.recv()
+
+            except (EOFError, IOError, OSError):
+                worker.kill()
+                self._idle.put(self._start())
+                raise WorkerError('worker exited while running a job')
+
+            self._count('jobs')
+            worker.jobs += 1
+
+            if (worker.jobs >= self.max_jobs or
+                    (self.max_rss and rss > self.max_rss)):
+                worker.stop()
+                self._idle.put(self._start())
+                self._count('recycled')
+            else:
+                self._idle.put(worker)
+
+        finally:
+            self._slots.release()
+
+        if status == 'error':
+            raise value
+
+        return value
+
+    def close(self):
+        '''
+        Stop all the workers.
+        '''
+
+        for i in range(self.processes):
+            self._idle.get().stop()
+
+    def stats(self):
+        '''
+        Returns a dictionary of the pool counters.
+        '''
+
+        with self._lock:
+            return {"processes": self.processes,
+                    "jobs": self.jobs,
+                    "rejected": self.rejected,
+                    "timeouts": self.timeouts,
+                    "recycled": self.recycled}